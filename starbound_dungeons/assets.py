@@ -0,0 +1,288 @@
+from .pak import PakFile
+
+from collections import namedtuple
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath
+
+import builtins
+import os
+
+
+# The source from which asset files are read, or None to read them
+# directly from the filesystem. Asset paths are always expressed as
+# filesystem paths under the source folder given to the indexer; a
+# source maps them to the files actually read. See set_source.
+source = None
+
+
+# The subset of os.stat_result provided for files in archives.
+FileStat = namedtuple('FileStat', ['st_size', 'st_mtime_ns'])
+
+
+class DirectorySource:
+    '''
+    The asset files in a folder, such as the unpacked base assets or a
+    mod folder. Paths are relative to the folder.
+    '''
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def file_path(self, relative_path):
+        return self.root / relative_path
+
+    def identity(self, relative_path):
+        return self.root / relative_path
+
+    def exists(self, relative_path):
+        return (self.root / relative_path).exists()
+
+    def is_dir(self, relative_path):
+        return (self.root / relative_path).is_dir()
+
+    def glob(self, relative_path, pattern):
+        folder = self.root / relative_path
+        for match in folder.glob(pattern):
+            yield match.relative_to(self.root)
+
+    def open(self, relative_path):
+        return builtins.open(self.root / relative_path, 'rb')
+
+    def stat(self, relative_path):
+        return os.stat(self.root / relative_path)
+
+
+class PakSource:
+    '''
+    The asset files in an SBAsset6 archive, such as Starbound's
+    packed.pak or a mod's .pak file, read without unpacking it. Paths are
+    relative to the root of the archive.
+    '''
+    def __init__(self, root):
+        self.root = Path(root)
+        self.pak = PakFile(self.root)
+        self.mtime_ns = os.stat(self.root).st_mtime_ns
+        self.dirs = set()
+        for name in self.pak.files:
+            parent = PurePosixPath(name).parent
+            while str(parent) not in self.dirs:
+                self.dirs.add(str(parent))
+                if parent == parent.parent: break
+                parent = parent.parent
+
+    def member_name(self, relative_path):
+        name = Path(relative_path).as_posix()
+        return '/' if name == '.' else '/' + name
+
+    def file_path(self, relative_path):
+        # Files in archives cannot be read by path.
+        return None
+
+    def identity(self, relative_path):
+        return (str(self.root), self.member_name(relative_path))
+
+    def exists(self, relative_path):
+        name = self.member_name(relative_path)
+        return name in self.pak.files or name in self.dirs
+
+    def is_dir(self, relative_path):
+        return self.member_name(relative_path) in self.dirs
+
+    def glob(self, relative_path, pattern):
+        '''
+        Supports patterns matching file names in a folder, optionally
+        prefixed with **/ to match them in its subfolders too.
+        '''
+        prefix = self.member_name(relative_path).rstrip('/') + '/'
+        recursive = pattern.startswith('**/')
+        if recursive: pattern = pattern[3:]
+        for name in sorted(self.pak.files):
+            if not name.startswith(prefix): continue
+            rest = name[len(prefix):]
+            if not recursive and '/' in rest: continue
+            if fnmatchcase(rest.rsplit('/', 1)[-1], pattern):
+                yield Path(name[1:])
+
+    def open(self, relative_path):
+        return self.pak.open(self.member_name(relative_path))
+
+    def stat(self, relative_path):
+        name = self.member_name(relative_path)
+        try:
+            offset, length = self.pak.files[name]
+        except KeyError as e:
+            raise FileNotFoundError(name) from None
+        # The archive's modification time stands in for that of its
+        # files; if it changes, their contents are compared.
+        return FileStat(length, self.mtime_ns)
+
+
+def is_pak(path):
+    return Path(path).is_file()
+
+
+def make_source(root):
+    '''
+    Returns the source of the asset files in root: a PakSource if it is
+    a .pak archive, otherwise a DirectorySource.
+    '''
+    if is_pak(root): return PakSource(root)
+    return DirectorySource(root)
+
+
+class OverlaySource:
+    '''
+    An ordered stack of asset folders or .pak archives, such as the base
+    game's assets followed by those of mods, read as a single folder. A
+    file in an upper layer shadows the file with the same relative path
+    in the layers below it, as in Starbound's own asset overlay.
+
+    layers is a list of sources, as returned by make_source, lowest first.
+    Asset paths are expressed under the root of the highest.
+    '''
+    def __init__(self, layers):
+        self.layers = list(layers)
+        self.root = self.layers[-1].root
+        self.located = {}
+
+    def relative_path(self, path):
+        return Path(path).relative_to(self.root)
+
+    def forget(self):
+        '''
+        Discards the layers found to provide asset paths, after files have
+        been added to or removed from the layers.
+        '''
+        self.located.clear()
+
+    def locate(self, path):
+        '''
+        Returns a tuple of the index of the layer providing the given
+        asset path and the path relative to it, or (None, path) if no
+        layer provides it.
+        '''
+        path = Path(path)
+        location = self.located.get(path)
+        if location is None:
+            location = (None, path)
+            try:
+                relative_path = self.relative_path(path)
+            except ValueError as e:
+                relative_path = None
+            if relative_path is not None:
+                for layer in range(len(self.layers) - 1, -1, -1):
+                    if self.layers[layer].exists(relative_path):
+                        location = (layer, relative_path)
+                        break
+            self.located[path] = location
+        return location
+
+    def file_path(self, path):
+        layer, relative_path = self.locate(path)
+        if layer is None: return path
+        return self.layers[layer].file_path(relative_path)
+
+    def identity(self, path):
+        layer, relative_path = self.locate(path)
+        if layer is None: return Path(path)
+        return self.layers[layer].identity(relative_path)
+
+    def open(self, path):
+        layer, relative_path = self.locate(path)
+        if layer is None:
+            raise FileNotFoundError('asset not found: {}'.format(path))
+        return self.layers[layer].open(relative_path)
+
+    def stat(self, path):
+        layer, relative_path = self.locate(path)
+        if layer is None:
+            raise FileNotFoundError('asset not found: {}'.format(path))
+        return self.layers[layer].stat(relative_path)
+
+    def glob(self, path, pattern):
+        relative_path = self.relative_path(path)
+        seen = set()
+        for layer in reversed(self.layers):
+            if not layer.is_dir(relative_path): continue
+            for match in layer.glob(relative_path, pattern):
+                path = self.root / match
+                if path in seen: continue
+                seen.add(path)
+                yield path
+
+    def is_dir(self, path):
+        relative_path = self.relative_path(path)
+        return any(layer.is_dir(relative_path) for layer in self.layers)
+
+
+def set_source(new_source):
+    '''
+    Sets the source from which asset files are read: None, to read them
+    directly from the filesystem, or an OverlaySource.
+    '''
+    global source
+    source = new_source
+
+
+def file_path(path):
+    '''
+    Returns the filesystem path of the file read for the given asset
+    path, or None if it is in an archive.
+    '''
+    if source is None: return path
+    return source.file_path(path)
+
+
+def layer(path):
+    '''
+    Returns the index of the layer of an OverlaySource which provides the
+    given asset path, or 0 when reading directly from the filesystem.
+    '''
+    if source is None: return 0
+    return source.locate(path)[0]
+
+
+def identity(path):
+    '''
+    Returns a hashable identity of the file read for the given asset
+    path, for use as the key of caches shared by several sources.
+    '''
+    if source is None: return Path(path)
+    return source.identity(path)
+
+
+def open_file(path):
+    '''
+    Opens the file read for the given asset path in binary mode.
+    '''
+    if source is None: return builtins.open(path, 'rb')
+    return source.open(path)
+
+
+def exists(path):
+    if source is None: return Path(path).exists()
+    return source.locate(path)[0] is not None
+
+
+def is_dir(path):
+    if source is None: return Path(path).is_dir()
+    return source.is_dir(path)
+
+
+def stat(path):
+    '''
+    Returns the size and modification time of the file read for the given
+    asset path, as st_size and st_mtime_ns.
+    '''
+    if source is None: return os.stat(path)
+    return source.stat(path)
+
+
+def glob(path, pattern):
+    '''
+    Returns the asset paths under the given folder matching the given
+    glob pattern, sorted by path, so that they are listed in the same order
+    whatever the source and filesystem.
+    '''
+    if source is None: matches = Path(path).glob(pattern)
+    else: matches = source.glob(path, pattern)
+    return sorted(matches, key=lambda match: Path(match).as_posix())
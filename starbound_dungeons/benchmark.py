@@ -0,0 +1,228 @@
+from . import assets, jsonloader
+from .assets import OverlaySource, make_source
+from .common import caches
+from .indexer import group_work_items, index_all_dungeons, index_all_ships, \
+                     plan_all_dungeons, plan_all_ships
+from .sinks import make_sink, output_formats
+from .stats import peak_memory
+from .synthetic import add_corpus_arguments, generate
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+from PIL import Image
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def part_pixels(item):
+    '''
+    Returns the number of pixels of a PNG part, or of tiles of a Tiled
+    part, without decoding it.
+    '''
+    path = item['partpath'] / item['partfile']
+    if item['type'] == 'png':
+        with assets.open_file(path) as fh, Image.open(fh) as image:
+            width, height = image.size
+        return width * height
+    dungeon_json = jsonloader.load(path)
+    return dungeon_json['width'] * dungeon_json['height']
+
+
+def measure_workload(items):
+    '''
+    Returns a dict giving the number of indexed parts in a plan, and the
+    total number of pixels or tiles read to index them.
+    '''
+    groups = group_work_items(items)
+    return {
+        'parts': len(groups),
+        'pixels': sum(part_pixels(group[0]) for group in groups)
+    }
+
+
+def index_dungeons(src_dir, dst_dir, jobs, tiled_parser, sink):
+    index_all_dungeons(
+        src_dir, dst_dir, jobs, tiled_parser=tiled_parser, sink=sink
+    )
+
+
+def index_ships(src_dir, dst_dir, jobs, tiled_parser, sink):
+    index_all_ships(src_dir, dst_dir, jobs, sink=sink)
+
+
+# The stages benchmarked, in order.
+stages = {'dungeons': index_dungeons, 'ships': index_ships}
+
+
+def run_stage_once(
+    name, src_dir, jobs, tiled_parser, output_format, asset_source
+):
+    '''
+    Runs a stage once into an empty destination folder. Run in a process
+    of its own, so that its peak memory use is that of the stage alone.
+
+    Returns a tuple of the time taken and the peak memory use of the
+    process and its workers.
+    '''
+    assets.set_source(asset_source)
+    # Each run of a stage does the same work.
+    caches.clear()
+    # Silences the output of the workers too, which do not share
+    # sys.stdout when spawned rather than forked.
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), sys.stdout.fileno())
+    dst_dir = Path(tempfile.mkdtemp(prefix='pystarbound-benchmark-'))
+    try:
+        start = time.perf_counter()
+        sink = make_sink(output_format, dst_dir)
+        stages[name](src_dir, dst_dir, jobs, tiled_parser, sink)
+        sink.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(dst_dir)
+    return elapsed, peak_memory()
+
+
+def run_stage(name, src_dir, workload, repeat, jobs, tiled_parser,
+              output_format):
+    '''
+    Runs a stage repeatedly, each time in a new process, and returns its
+    statistics: the time of the fastest run, and the highest peak memory
+    use of any run.
+    '''
+    best = None
+    peak = None
+    for i in range(repeat):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, memory = executor.submit(
+                run_stage_once, name, src_dir, jobs, tiled_parser,
+                output_format, assets.source
+            ).result()
+        if best is None or elapsed < best: best = elapsed
+        if memory is not None: peak = max(peak or 0, memory)
+    return {
+        'stage': name,
+        'seconds': best,
+        'parts': workload['parts'],
+        'pixels': workload['pixels'],
+        'parts_per_second': workload['parts'] / best if best else None,
+        'pixels_per_second': workload['pixels'] / best if best else None,
+        'peak_memory': peak
+    }
+
+
+def run_benchmark(src_dir, jobs=1, repeat=1, tiled_parser='native',
+                  output_format='csv'):
+    '''
+    Benchmarks index_all_dungeons and index_all_ships on the assets in
+    src_dir. Returns a list of per-stage statistics.
+    '''
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        workloads = {
+            'dungeons': measure_workload(plan_all_dungeons(src_dir)),
+            'ships': measure_workload(plan_all_ships(src_dir))
+        }
+    return [
+        run_stage(name, src_dir, workloads[name], repeat, jobs,
+                  tiled_parser, output_format)
+        for name in stages
+    ]
+
+
+def format_results(results):
+    lines = ['{:<10} {:>8} {:>8} {:>10} {:>12} {:>14} {:>10}'.format(
+        'stage', 'parts', 'seconds', 'parts/s', 'pixels', 'pixels/s',
+        'peak MiB'
+    )]
+    for result in results:
+        peak = result['peak_memory']
+        lines.append(
+            '{:<10} {:>8} {:>8.3f} {:>10.1f} {:>12} {:>14.0f} {:>10}'.format(
+                result['stage'], result['parts'], result['seconds'],
+                result['parts_per_second'] or 0, result['pixels'],
+                result['pixels_per_second'] or 0,
+                '-' if peak is None else '{:.1f}'.format(peak / (1 << 20))
+            )
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Starbound dungeon indexer, by default "
+                    "on a generated synthetic asset tree."
+    )
+    parser.add_argument(
+        '--format', choices=output_formats, default='csv',
+        help='the format of the indices (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='the number of worker processes to use; 0 uses one per CPU'
+    )
+    parser.add_argument(
+        '--json', metavar='PATH',
+        help='also write the results as JSON to the given file'
+    )
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='the number of times to run each stage, reporting the '
+             'fastest (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-s', '--src',
+        help='benchmark an existing asset folder or .pak archive instead of '
+             'generating one'
+    )
+    parser.add_argument(
+        '--tiled-parser', choices=['native', 'pytiled', 'validate'],
+        default='native',
+        help='how to read Tiled maps (default: %(default)s)'
+    )
+    add_corpus_arguments(parser.add_argument_group(
+        'synthetic assets', 'options for the generated asset tree'
+    ))
+    args = parser.parse_args()
+
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    tmp_dir = None
+    if args.src:
+        src_dir = Path(args.src).resolve(strict=True)
+        if src_dir.is_file():
+            assets.set_source(OverlaySource([make_source(src_dir)]))
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='pystarbound-assets-')
+        src_dir = Path(tmp_dir).resolve()
+        generate(src_dir, args)
+    try:
+        results = run_benchmark(
+            src_dir, jobs, max(1, args.repeat), args.tiled_parser,
+            args.format
+        )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({
+                'jobs': jobs,
+                'format': args.format,
+                'tiled_parser': args.tiled_parser,
+                'results': results
+            }, fh, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,164 @@
+from collections import namedtuple
+
+
+class FileCaches:
+    '''
+    The parsed forms of asset files, and other state, kept in memory by
+    this process between parts and between runs, so that files shared by
+    many parts are read only once. Files are keyed by their identity (see
+    assets.identity), so that they are also shared by the layers of a mod
+    stack.
+    '''
+    def __init__(self):
+        # Dungeon files, with their compiled brushes; see
+        # indexer.read_dungeon.
+        self.dungeons = {}
+        # Block keys and their compiled brushes, keyed by the identity of
+        # their file and their key in it.
+        self.block_keys = {}
+        self.brush_tables = {}
+        # Compiled external tilesets; see tiled.load_external_tileset.
+        self.tilesets = {}
+        # Gid tables, keyed by the tileset layout of the maps using them;
+        # see tiled.make_gid_table.
+        self.gid_tables = {}
+        # The SHA-256 hashes of the contents of files; see
+        # store.content_hash.
+        self.content_hashes = {}
+        # Tiled parts referenced by multiple dungeons are indexed once per
+        # run.
+        self.seen_tiled_parts = set()
+        # The color scan of the last PNG part indexed; see
+        # png.index_png_dungeon_part.
+        self.last_png_part = {'key': None, 'scan': None, 'fingerprint': None}
+        # The destination directories already made.
+        self.made_dst_dirs = set()
+
+    def clear(self):
+        '''
+        Discards everything kept, so that all files are read again.
+        '''
+        self.__init__()
+
+    def forget(self, paths):
+        '''
+        Discards the parsed forms of the given asset files, given as paths
+        in the filesystem, so that they are read again. If paths is None,
+        everything kept is discarded.
+        '''
+        if paths is None:
+            self.clear()
+            return
+        for path in paths:
+            self.dungeons.pop(path, None)
+            self.content_hashes.pop(path, None)
+            if self.tilesets.pop(path, None) is not None:
+                # Tables are keyed by the ids of the tilesets' tiles.
+                self.gid_tables.clear()
+        for cache in [self.block_keys, self.brush_tables]:
+            for key in [key for key in cache if key[0] in paths]:
+                del cache[key]
+        self.last_png_part.update(key=None, scan=None, fingerprint=None)
+        # Folders left empty by deleted parts are removed.
+        self.made_dst_dirs.clear()
+
+
+# The caches of this process.
+caches = FileCaches()
+
+
+def get_dst_dir(src_dir, dst_dir, partpath):
+    '''
+    Returns the absolute path to the destination directory corresponding
+    to the given source directory, without creating it.
+
+    partpath is a string containing the absolute path to the directory
+    containing the part.
+    '''
+    assert str(partpath).find(str(src_dir)) == 0
+    assert len(str(partpath)) > len(str(src_dir))
+    dst_relative_path = str(partpath)[len(str(src_dir)) + 1:]
+    return dst_dir / dst_relative_path
+
+
 def make_dst_dir(src_dir, dst_dir, partpath):
     '''
     Makes a destination directory corresponding to the given source
-    directory. If the directory already exists, this is a no-op.
+    directory. If the directory already exists, this is a no-op, and
+    directories made once are not checked again.
 
     partpath is a string containing the absolute path to the directory
     containing the part.
 
     Returns the absolute path to the destination directory.
     '''
-    assert str(partpath).find(str(src_dir)) == 0
-    assert len(str(partpath)) > len(str(src_dir))
-    dst_relative_path = str(partpath)[len(str(src_dir)) + 1:]
-    dst_path = dst_dir / dst_relative_path
-    dst_path.mkdir(parents=True, exist_ok=True)
+    dst_path = get_dst_dir(src_dir, dst_dir, partpath)
+    if dst_path not in caches.made_dst_dirs:
+        dst_path.mkdir(parents=True, exist_ok=True)
+        caches.made_dst_dirs.add(dst_path)
     return dst_path
+
+
+# The entity type under which the treasure pools of objects are counted;
+# see row_entities.
+treasure_pool_type = 'treasurePool'
+
+
+def row_entities(row):
+    '''
+    Returns the entities of an index row, as (type, name) tuples: its own
+    entity, e.g., ('object', 'woodenchest'), followed by the treasure
+    pools given by its modifiers, as entities of type treasure_pool_type.
+    '''
+    if len(row) < 9: return []
+    entities = [(row[7], row[8])]
+    for modifier in row[9:]:
+        key, _, value = str(modifier).partition('=')
+        if key == 'treasurePools':
+            entities.extend(
+                (treasure_pool_type, pool) for pool in value.split(';')
+            )
+    return entities
+
+
+class IndexRecord(namedtuple('IndexRecord', [
+    'layer', 'color_or_gid', 'x', 'y', 'tileset_name', 'tileset_firstgid',
+    'tileset_offset', 'entity_type', 'entity_name', 'modifiers'
+])):
+    '''
+    One row of an index. Fields which are blank in the CSV index are
+    None, and modifiers is a tuple of strings, e.g., "species=human".
+    See the Index Format section of the README.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        return cls._make(
+            [None if field == '' else field for field in row[:9]]
+            + [tuple(row[9:])]
+        )
+
+    def row(self):
+        '''
+        Returns the record as a row of a CSV index. Blank fields remain
+        None, which csv writers write as empty strings.
+        '''
+        return self[:9] + self.modifiers
+
+
+class RowRecorder:
+    '''
+    Wraps a csv writer, additionally appending each row written to a
+    list.
+    '''
+    def __init__(self, writer, rows):
+        self.writer = writer
+        self.rows = rows
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.rows.append(row)
+
+    def writerows(self, rows):
+        for row in rows: self.writerow(row)
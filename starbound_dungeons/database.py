@@ -0,0 +1,268 @@
+from pathlib import Path
+
+import json
+import sqlite3
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS parts (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    part_id INTEGER NOT NULL REFERENCES parts(id),
+    layer TEXT NOT NULL,
+    color_or_gid TEXT NOT NULL,
+    x INTEGER,
+    y INTEGER,
+    tileset_name TEXT,
+    tileset_firstgid INTEGER,
+    tileset_offset INTEGER,
+    entity_type TEXT NOT NULL,
+    entity_name TEXT NOT NULL,
+    modifiers TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS modifiers (
+    entry_id INTEGER NOT NULL REFERENCES entries(id),
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_type_name
+    ON entries(entity_type, entity_name);
+CREATE INDEX IF NOT EXISTS entries_name ON entries(entity_name);
+CREATE INDEX IF NOT EXISTS entries_part ON entries(part_id);
+CREATE INDEX IF NOT EXISTS entries_layer ON entries(layer);
+CREATE INDEX IF NOT EXISTS modifiers_key_value ON modifiers(key, value);
+CREATE INDEX IF NOT EXISTS modifiers_entry ON modifiers(entry_id);
+'''
+
+# The number of pending rows at which they are written to the database.
+batch_size = 50000
+
+
+def null_if_blank(value):
+    return None if value == '' else value
+
+
+def split_modifiers(modifiers):
+    '''
+    Splits index row modifiers, e.g., "treasurePools=a;b", into (key,
+    value) pairs, one per value.
+    '''
+    for modifier in modifiers:
+        key, _, values = str(modifier).partition('=')
+        for value in values.split(';'):
+            yield key, value
+
+
+class IndexDatabase:
+    '''
+    A single SQLite database holding the rows of every index, keyed by
+    the path of the indexed part relative to the source folder.
+
+    Changes are buffered, and written in batches, each in one
+    transaction: the deletion of the rows of the parts replaced or
+    removed, then the insertion of their new rows.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(schema)
+        self.next_entry_id = self.connection.execute(
+            'SELECT COALESCE(MAX(id), 0) + 1 FROM entries'
+        ).fetchone()[0]
+        self.next_part_id = self.connection.execute(
+            'SELECT COALESCE(MAX(id), 0) + 1 FROM parts'
+        ).fetchone()[0]
+        # The ids of the parts, keyed by path, including those pending.
+        self.part_ids = dict(
+            (path, part_id) for part_id, path in self.connection.execute(
+                'SELECT id, path FROM parts'
+            )
+        )
+        self.reset_pending()
+
+    def reset_pending(self):
+        self.pending_deletes = []
+        self.pending_removals = []
+        self.pending_inserts = []
+        self.pending_entries = []
+        self.pending_modifiers = []
+        self.pending_parts = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def flush(self):
+        if self.pending_deletes or self.pending_inserts\
+           or self.pending_entries:
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM modifiers WHERE entry_id IN '
+                    '(SELECT id FROM entries WHERE part_id = ?)',
+                    self.pending_deletes
+                )
+                self.connection.executemany(
+                    'DELETE FROM entries WHERE part_id = ?',
+                    self.pending_deletes
+                )
+                self.connection.executemany(
+                    'DELETE FROM parts WHERE id = ?', self.pending_removals
+                )
+                self.connection.executemany(
+                    'INSERT INTO parts (id, path) VALUES (?,?)',
+                    self.pending_inserts
+                )
+                self.connection.executemany(
+                    'INSERT INTO entries VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                    self.pending_entries
+                )
+                self.connection.executemany(
+                    'INSERT INTO modifiers VALUES (?,?,?)',
+                    self.pending_modifiers
+                )
+        self.reset_pending()
+
+    def part_paths(self):
+        return set(self.part_ids)
+
+    def delete_part(self, part):
+        '''
+        Queues the deletion of the rows of the given part. Returns the id
+        of the part, or None if the database does not contain it.
+        '''
+        if part in self.pending_parts:
+            # Its pending rows must be written before they are deleted.
+            self.flush()
+        part_id = self.part_ids.get(part)
+        if part_id is not None:
+            self.pending_deletes.append((part_id,))
+        return part_id
+
+    def replace_part(self, part, rows):
+        '''
+        Replaces the rows of the given part. rows is an iterable of index
+        rows, as written to the CSV index of the part.
+        '''
+        part_id = self.delete_part(part)
+        if part_id is None:
+            part_id = self.part_ids[part] = self.next_part_id
+            self.next_part_id += 1
+            self.pending_inserts.append((part_id, part))
+        self.pending_parts.add(part)
+        for row in rows:
+            entry_id = self.next_entry_id
+            self.next_entry_id += 1
+            modifiers = row[9:]
+            self.pending_entries.append((
+                entry_id, part_id, row[0], str(row[1]),
+                null_if_blank(row[2]), null_if_blank(row[3]),
+                null_if_blank(row[4]), null_if_blank(row[5]),
+                null_if_blank(row[6]), row[7], row[8],
+                json.dumps([str(m) for m in modifiers])
+            ))
+            for key, value in split_modifiers(modifiers):
+                self.pending_modifiers.append((entry_id, key, value))
+        if len(self.pending_entries) >= batch_size:
+            self.flush()
+
+    def remove_part(self, part):
+        part_id = self.delete_part(part)
+        if part_id is not None:
+            self.pending_removals.append((part_id,))
+            del self.part_ids[part]
+
+    def sync(self, dst_dir, index_keys, sink, prefix=''):
+        '''
+        Makes the database contain exactly the parts of the given indices,
+        loading those that it does not already contain from the sink to
+        which they were written.
+
+        index_keys is an iterable of index paths relative to dst_dir. If
+        prefix is given, part paths are prefixed with it, and only the
+        parts whose path starts with it are considered.
+        '''
+        self.flush()
+        existing = set(
+            part for part in self.part_paths() if part.startswith(prefix)
+        )
+        parts = set()
+        for key in index_keys:
+            part = prefix + sink.part_key(key)
+            parts.add(part)
+            if part in existing: continue
+            rows = sink.read_rows(dst_dir / key)
+            if rows is not None:
+                self.replace_part(part, rows)
+        for part in existing - parts:
+            self.remove_part(part)
+
+    def query(
+        self, name=None, prefix=None, entity_type=None, layer=None,
+        modifiers=(), part_prefix=None
+    ):
+        '''
+        Finds index rows matching all of the given criteria:
+        * name: the exact entity name.
+        * prefix: a prefix of the entity name.
+        * entity_type: the entity type, e.g., object or material.
+        * layer: the layer.
+        * modifiers: (key, value) pairs, e.g., ('treasurePools',
+          'basicTreasure'). A value of None matches any value.
+        * part_prefix: a prefix of the part path.
+
+        Yields lists of the part path followed by the fields of the
+        index row.
+        '''
+        self.flush()
+        clauses = []
+        params = []
+        if name is not None:
+            clauses.append('e.entity_name = ?')
+            params.append(name)
+        if prefix:
+            # A range comparison, unlike LIKE, can use the index.
+            clauses.append('e.entity_name >= ? AND e.entity_name < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        if entity_type is not None:
+            clauses.append('e.entity_type = ?')
+            params.append(entity_type)
+        if layer is not None:
+            clauses.append('e.layer = ?')
+            params.append(layer)
+        for key, value in modifiers:
+            if value is None:
+                clauses.append(
+                    'e.id IN (SELECT entry_id FROM modifiers WHERE key = ?)'
+                )
+                params.append(key)
+            else:
+                clauses.append(
+                    'e.id IN (SELECT entry_id FROM modifiers '
+                    'WHERE key = ? AND value = ?)'
+                )
+                params.extend([key, value])
+        if part_prefix:
+            clauses.append('p.path >= ? AND p.path < ?')
+            params.extend([part_prefix, part_prefix + '\U0010ffff'])
+        sql = 'SELECT p.path, e.layer, e.color_or_gid, e.x, e.y, '\
+              'e.tileset_name, e.tileset_firstgid, e.tileset_offset, '\
+              'e.entity_type, e.entity_name, e.modifiers '\
+              'FROM entries e JOIN parts p ON p.id = e.part_id'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY p.path, e.id'
+        for row in self.connection.execute(sql, params):
+            row = ['' if field is None else field for field in row]
+            row.extend(json.loads(row.pop()))
+            yield row
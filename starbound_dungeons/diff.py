@@ -0,0 +1,204 @@
+from .common import row_entities, treasure_pool_type
+from .manifest import read_manifest
+from .sinks import make_sink, output_formats, rows_digest
+
+from collections import Counter
+from pathlib import Path
+
+import argparse
+import json
+import sys
+
+
+class Destination:
+    '''
+    The indices written to a destination folder by the indexer, as listed
+    by its manifest. The indices of a mod stack are those of all of its
+    layer folders, under part paths prefixed with the layer's name.
+    '''
+    def __init__(self, dst_dir):
+        self.dst_dir = Path(dst_dir)
+        # Maps each part path to a tuple of the sink of its index, the
+        # index's path and its digest, if recorded.
+        self.parts = {}
+        if read_manifest(self.dst_dir) is not None:
+            self.add_folder(self.dst_dir, '')
+        elif self.dst_dir.is_dir():
+            for layer_dir in sorted(self.dst_dir.iterdir()):
+                if read_manifest(layer_dir) is not None:
+                    self.add_folder(layer_dir, layer_dir.name + '/')
+
+    def add_folder(self, dst_dir, prefix):
+        manifest = read_manifest(dst_dir)
+        output_format = manifest.get('format', 'csv')
+        if output_format not in output_formats:
+            print('WARNING: unknown index format: {}: {}'.format(
+                dst_dir, output_format))
+            return
+        sink = make_sink(output_format, dst_dir)
+        for key, entry in manifest.get('outputs', {}).items():
+            self.parts[prefix + sink.part_key(key)] = (
+                sink, dst_dir / key, entry.get('digest')
+            )
+
+    def read_rows(self, part):
+        sink, path, digest = self.parts[part]
+        return sink.read_rows(path) or []
+
+
+def part_entities(rows, types=None):
+    '''
+    Counts the entities in the rows of an index, keyed by a tuple of
+    their type and name, e.g., ('object', 'woodenchest'). The treasure
+    pools of objects are counted as entities of type treasure_pool_type.
+    If types is given, only entities of those types are counted.
+    '''
+    entities = Counter()
+    for row in rows:
+        entities.update(row_entities(row))
+    if types is not None:
+        for entity in list(entities):
+            if entity[0] not in types: del entities[entity]
+    return entities
+
+
+def entity_changes(old, new):
+    '''
+    Returns the changes between two Counters returned by part_entities,
+    as a sorted list of dicts giving the type and name of each entity
+    whose count differs, and its old and new counts.
+    '''
+    return [
+        {
+            'type': entity[0], 'name': entity[1],
+            'old': old[entity], 'new': new[entity]
+        }
+        for entity in sorted(set(old) | set(new))
+        if old[entity] != new[entity]
+    ]
+
+
+def diff_part(old, new, part, types=None):
+    '''
+    Compares the indices of a part in two destinations. Returns a dict
+    giving the part's status, 'added', 'removed' or 'changed', and its
+    entity changes, or None if the indices have the same rows.
+
+    The indices are compared by the digests recorded in their manifests
+    if both are known, and are only read if they differ.
+    '''
+    old_digest = old.parts[part][2] if part in old.parts else None
+    new_digest = new.parts[part][2] if part in new.parts else None
+    if old_digest is not None and old_digest == new_digest:
+        return None
+    old_rows = old.read_rows(part) if part in old.parts else []
+    new_rows = new.read_rows(part) if part in new.parts else []
+    if part not in old.parts:
+        status = 'added'
+    elif part not in new.parts:
+        status = 'removed'
+    else:
+        status = 'changed'
+        if (old_digest is None or new_digest is None)\
+           and rows_digest(old_rows) == rows_digest(new_rows):
+            return None
+    return {
+        'part': part,
+        'status': status,
+        'changes': entity_changes(
+            part_entities(old_rows, types), part_entities(new_rows, types)
+        )
+    }
+
+
+def diff_destinations(old, new, types=None):
+    '''
+    Compares two Destinations. Returns a dict giving the number of parts
+    compared and of those added, removed, changed and unchanged, the
+    result of diff_part for each part that differs, and the entity
+    changes across all parts, listing for each entity the parts in which
+    its count increased or decreased.
+    '''
+    summary = Counter()
+    parts = []
+    entities = {}
+    for part in sorted(set(old.parts) | set(new.parts)):
+        summary['parts'] += 1
+        result = diff_part(old, new, part, types)
+        if result is None:
+            summary['unchanged'] += 1
+            continue
+        summary[result['status']] += 1
+        parts.append(result)
+        for change in result['changes']:
+            key = (change['type'], change['name'])
+            entity = entities.get(key)
+            if entity is None:
+                entity = entities[key] = {
+                    'type': change['type'], 'name': change['name'],
+                    'old': 0, 'new': 0, 'increased': [], 'decreased': []
+                }
+            entity['old'] += change['old']
+            entity['new'] += change['new']
+            if change['new'] > change['old']:
+                entity['increased'].append(part)
+            else:
+                entity['decreased'].append(part)
+    return {
+        'summary': {
+            status: summary[status] for status in
+            ['parts', 'unchanged', 'changed', 'added', 'removed']
+        },
+        'parts': parts,
+        'entities': [entities[key] for key in sorted(entities)]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the indices of two destination folders of "
+                    "pystarbound-dungeons-indexer, such as those of two "
+                    "releases, reporting the entities added to and removed "
+                    "from each part as JSON."
+    )
+    parser.add_argument(
+        'old', help='the destination folder of the older indices'
+    )
+    parser.add_argument(
+        'new', help='the destination folder of the newer indices'
+    )
+    parser.add_argument(
+        '-o', '--output', metavar='PATH',
+        help='write the report to the given file rather than to standard '
+             'output'
+    )
+    parser.add_argument(
+        '--type', action='append', dest='types', metavar='TYPE',
+        help='compare only entities of the given type, e.g., object, '
+             'monster, npc or {}; may be given more than once'.format(
+                 treasure_pool_type)
+    )
+    args = parser.parse_args()
+
+    destinations = []
+    for dst_dir in [args.old, args.new]:
+        destination = Destination(dst_dir)
+        if not destination.parts and read_manifest(Path(dst_dir)) is None:
+            print('ERROR: no indices found: {}'.format(dst_dir),
+                  file=sys.stderr)
+            sys.exit(1)
+        destinations.append(destination)
+
+    report = diff_destinations(
+        *destinations, types=args.types and set(args.types)
+    )
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
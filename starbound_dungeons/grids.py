@@ -0,0 +1,169 @@
+from . import stats
+from .common import get_dst_dir, make_dst_dir
+from .sinks import link_or_copy
+
+from pathlib import Path
+
+import json
+import numpy as np
+import os
+
+
+# Whether the grids of parts are exported along with their indices.
+enabled = False
+
+# The suffixes of the grid of a part, and of its legend, appended to the
+# name of the part file.
+grid_suffix = '.grid.npy'
+legend_suffix = '.grid.json'
+
+# Bump this whenever the layout of grids or legends changes.
+grid_version = 1
+
+
+def legend_path(path):
+    '''
+    Returns the path of the legend of the grid at the given path.
+    '''
+    path = Path(path)
+    return path.with_name(path.name[:-len(grid_suffix)] + legend_suffix)
+
+
+def brush_id_dtype(count):
+    '''
+    Returns the smallest signed integer type holding the ids of the given
+    number of brushes, and -1.
+    '''
+    for dtype in (np.int8, np.int16, np.int32):
+        if count <= np.iinfo(dtype).max + 1: return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+class GridWriter:
+    '''
+    Writes the grid of a part to a .npy file, and its legend to a JSON
+    file beside it. Both replace the previous files only once complete,
+    when the writer is closed without an exception.
+
+    The grid is either given whole to save, or written in place, for
+    instance one row at a time, to the memory-mapped array returned by
+    open.
+    '''
+    def __init__(self, path, legend):
+        self.path = Path(path)
+        self.legend = dict(legend, version=grid_version)
+        self.tmp_path = self.path.with_name(
+            '{}.{}.tmp'.format(self.path.name, os.getpid()))
+        self.array = None
+        self.written = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.array is not None:
+            self.array.flush()
+            # Unmapped only once the last reference is dropped.
+            self.array = None
+            self.written = True
+        if not self.written: return
+        if exc_type is not None:
+            self.tmp_path.unlink()
+            return
+        os.replace(self.tmp_path, self.path)
+        path = legend_path(self.path)
+        tmp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(self.legend, fh, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        stats.count('grids')
+
+    def open(self, shape, dtype):
+        self.array = np.lib.format.open_memmap(
+            self.tmp_path, mode='w+', dtype=dtype, shape=shape
+        )
+        return self.array
+
+    def save(self, array):
+        with open(self.tmp_path, 'wb') as fh:
+            np.save(fh, array)
+        self.written = True
+
+
+def grid_path(src_dir, dst_dir, partpath, partfile):
+    '''
+    Returns the path of the grid of the given part, in the folder of its
+    index.
+    '''
+    return get_dst_dir(src_dir, dst_dir, partpath) / (partfile + grid_suffix)
+
+
+def part_grid(src_dir, dst_dir, partpath, partfile, legend):
+    '''
+    Returns a GridWriter for the grid of the given part, or None if grids
+    are not exported.
+    '''
+    if not enabled: return None
+    make_dst_dir(src_dir, dst_dir, partpath)
+    return GridWriter(grid_path(src_dir, dst_dir, partpath, partfile), legend)
+
+
+def store_grid(path, stored_path):
+    '''
+    Saves the grid at the given path, and its legend, to stored_path, for
+    store.ResultStore, by hard-linking them if possible. Returns False
+    if there is no grid.
+    '''
+    if not os.path.isfile(path): return False
+    for src, dst in [(legend_path(path), legend_path(stored_path)),
+                     (path, stored_path)]:
+        tmp_path = dst.with_name('{}.{}.tmp'.format(dst.name, os.getpid()))
+        link_or_copy(src, tmp_path)
+        os.replace(tmp_path, dst)
+    return True
+
+
+def restore_grid(stored_path, path):
+    '''
+    Writes the grid at the given path, and its legend, from those saved
+    by store_grid, by hard-linking them if possible. Raises
+    FileNotFoundError if they were not saved.
+    '''
+    for src, dst in [(stored_path, path),
+                     (legend_path(stored_path), legend_path(path))]:
+        remove_file(dst)
+        link_or_copy(src, dst)
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError as e:
+        pass
+
+
+def remove_grid(path):
+    '''
+    Deletes the grid at the given path and its legend, if they exist.
+    '''
+    remove_file(path)
+    remove_file(legend_path(path))
+
+
+def load_grid(path, mmap=True):
+    '''
+    Loads the grid of a part exported by the indexer, given the path of
+    its .npy file. Returns a tuple of the grid, memory-mapped read-only
+    unless mmap is false, and its legend.
+
+    The grid of a PNG part is a (height, width) array of the brush id of
+    each pixel, an index into the legend's list of colors, or -1 for
+    pixels without a brush. The grid of a Tiled part is a (layers,
+    height, width) array of the gid of each tile of each of its tile
+    layers, without flip bits, or 0 for no tile, the layers being named
+    by the legend's list of layers. Both are indexed by the y and x
+    coordinates of the index rows.
+    '''
+    with open(legend_path(path), encoding='utf-8') as fh:
+        legend = json.load(fh)
+    return np.load(path, mmap_mode='r' if mmap else None), legend
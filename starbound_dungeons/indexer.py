@@ -1,14 +1,27 @@
-from .png import BrushParseError, index_png_dungeon_part, process_brushes, \
-                 process_ship_brushes
-from .tiled import index_tiled_dungeon_part, process_external_tilesets
+from . import assets, grids, jsonloader, png, spatial, stats, watch
+from .assets import DirectorySource, OverlaySource, PakSource, make_source
+from .common import caches
+from .database import IndexDatabase
+from .manifest import Manifest
+from .pak import PakError
+from .png import BrushParseError, compile_brushes, index_png_dungeon_part, \
+                 process_brushes, process_ship_brushes, read_png_scan
+from .sinks import CsvSink, make_sink, output_formats
+from .store import ResultStore, manifest_store_keys, store_name
+from .spatial import SpatialBuilder, remove_spatial, spatial_path
+from .summary import SummaryTally, TallySink, manifest_parts, \
+                     tally_missing, write_summary
+from .tiled import index_tiled_dungeon_part, read_tiled_json
 
-from json_minify import json_minify
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                               as_completed
 from pathlib import Path
 
 import argparse
-import json
 import os
 import sys
+import time
 
 
 # Exclude dungeons that are known to contain errors such that they are
@@ -29,64 +42,456 @@ def check_allowed_path(path):
     return True
 
 
-def index_all_dungeons(src_dir, dst_dir):
-    ddir = src_dir / 'dungeons'
-    if not ddir.is_dir():
-        # These assets do not contain any dungeon files.
-        return
+class PartIndexError(Exception):
+    '''
+    Raised when indexing a dungeon part fails. Carries the path of the
+    failed part so that errors raised in worker processes can be traced
+    back to their source.
+    '''
+    def __init__(self, path, message):
+        super(PartIndexError, self).__init__(path, message)
+        self.path = path
+        self.message = message
 
-    external_tilesets = process_external_tilesets(src_dir)
-    for relative_path in ddir.glob('**/*.dungeon'):
-        if not check_allowed_path(relative_path): continue
+    def __str__(self):
+        return '{}: {}'.format(self.path, self.message)
 
-        full_dungeon_path = ddir / relative_path
-        full_dungeon_dir = full_dungeon_path.parent
-        dungeon = None
-        print(full_dungeon_path)
-        with open(full_dungeon_path, 'rb') as fh:
-            # json_minify is incredibly slow. Invoking it only in cases
-            # in which the JSON contains comments provides a significant
-            # performance improvement.
-            try:
-                dungeon = json.loads(fh.read())
-            except json.decoder.JSONDecodeError as e:
-                fh.seek(0)
-                dungeon = json.loads(json_minify(fh.read().decode('utf-8')))
 
-        brushes = None
+# The number of parts read and decoded ahead of the part being indexed,
+# when indexing in a single process, and the maximum number of threads
+# doing so. See prefetch_groups.
+prefetch_depth = 4
+prefetch_threads = 2
+
+
+# The options used by the work items of the current process. Set once
+# per worker process, rather than once per work item, to avoid
+# repeatedly pickling them.
+worker_tiled_parser = 'native'
+worker_collect_rows = False
+worker_sink = None
+worker_store = None
+
+
+def init_worker(
+    tiled_parser='native', cache_dir=None, collect_rows=False,
+    sink=None, profiling=None, asset_source=None,
+    png_stream_min_pixels=None, store=None, export_grids=False,
+    export_spatial=False
+):
+    global worker_tiled_parser, worker_collect_rows, worker_sink
+    global worker_store
+    worker_tiled_parser = tiled_parser
+    worker_collect_rows = collect_rows
+    worker_sink = sink
+    worker_store = store
+    assets.set_source(asset_source)
+    png.stream_min_pixels = png_stream_min_pixels
+    grids.enabled = export_grids
+    spatial.enabled = export_spatial
+    jsonloader.set_cache_dir(cache_dir)
+    if profiling is not None:
+        stats.configure_profiling(*profiling)
+
+
+def init_pool_worker(*args):
+    # Worker processes may be forked after the main process has collected
+    # statistics, which must not be returned again.
+    stats.take()
+    init_worker(*args)
+
+
+def resolve_part(src_dir, partpath, partfile):
+    '''
+    Resolves a part file reference, which is either relative to the
+    folder containing the referencing file or absolute within the
+    assets, to its folder and file name. If the referenced file does not
+    exist, but a file with the lowercased name does, the latter is used.
+    '''
+    if partfile[0] == '/':
+        partpath = src_dir / os.path.dirname(partfile)[1:]
+        partfile = os.path.basename(partfile)
+    assert partfile == os.path.basename(partfile)
+    if not assets.exists(partpath / partfile)\
+       and assets.exists(partpath / partfile.lower()):
+        # BETA - incorrect file case.
+        partfile = partfile.lower()
+    return partpath, partfile
+
+
+def read_dungeon(path):
+    '''
+    Returns a dict containing the parts of a dungeon file and its brushes,
+    compiled once to be shared by all of the dungeon's parts.
+    '''
+    key = assets.identity(path)
+    dungeon = caches.dungeons.get(key)
+    if dungeon is None:
+        dungeon_json = jsonloader.load(path)
         try:
-            brushes = process_brushes(dungeon)
+            brushes = compile_brushes(process_brushes(dungeon_json))
         except BrushParseError as e:
-            print('ERROR: invalid brush: {}'.format(full_dungeon_path, str(e)))
+            print('ERROR: invalid brush: {}: {}'.format(path, str(e)))
             sys.exit(1)
+        dungeon = {
+            'parts': dungeon_json.get('parts', []),
+            'brushes': brushes
+        }
+        caches.dungeons[key] = dungeon
+    return dungeon
+
+
+def plan_all_dungeons(src_dir):
+    '''
+    Parses all dungeon files and returns the list of work items needed
+    to index their parts, in the order in which they would be indexed
+    sequentially. Tiled parts referenced by multiple dungeons appear only
+    once.
+    '''
+    items = []
+    ddir = src_dir / 'dungeons'
+    seen_tiled = {}
+    for relative_path in assets.glob(ddir, '**/*.dungeon'):
+        if not check_allowed_path(relative_path): continue
 
-        for part in dungeon.get('parts', []):
+        full_dungeon_path = ddir / relative_path
+        full_dungeon_dir = full_dungeon_path.parent
+        print(full_dungeon_path)
+        dungeon = read_dungeon(full_dungeon_path)
+        brushes = dungeon['brushes']
+
+        for part in dungeon['parts']:
             partdef = part.get('def', [])
             if len(partdef) > 1:
                 if partdef[0] == 'tmx':
                     partfile = partdef[1]
                     if isinstance(partfile, list):
                         partfile = partfile[0]
-                    partpath = full_dungeon_dir
-                    if partfile[0] == '/':
-                        partpath = src_dir / os.path.dirname(partfile)[1:]
-                        partfile = os.path.basename(partfile)
-                    assert partfile == os.path.basename(partfile)
-                    print(partpath / partfile)
-                    index_tiled_dungeon_part(
-                        src_dir, dst_dir, partpath, partfile, external_tilesets
+                    partpath, partfile = resolve_part(
+                        src_dir, full_dungeon_dir, partfile
                     )
+                    item = seen_tiled.get(partpath / partfile)
+                    if item is not None:
+                        item['deps'].append(full_dungeon_path)
+                        continue
+                    item = {
+                        'type': 'tmx',
+                        'partpath': partpath,
+                        'partfile': partfile,
+                        'deps': [full_dungeon_path]
+                    }
+                    seen_tiled[partpath / partfile] = item
+                    items.append(item)
                 elif partdef[0] == 'image':
                     for partfile in partdef[1]:
-                        partpath = full_dungeon_dir
-                        if partfile[0] == '/':
-                            partpath = src_dir / os.path.dirname(partfile)[1:]
-                            partfile = os.path.basename(partfile)
-                        assert partfile == os.path.basename(partfile)
-                        print(partpath / partfile)
-                        index_png_dungeon_part(
-                            src_dir, dst_dir, partpath, partfile, brushes
+                        partpath, partfile = resolve_part(
+                            src_dir, full_dungeon_dir, partfile
                         )
+                        items.append({
+                            'type': 'png',
+                            'partpath': partpath,
+                            'partfile': partfile,
+                            'brushes': brushes,
+                            'deps': [full_dungeon_path]
+                        })
+    return items
+
+
+def group_work_items(items):
+    '''
+    Groups work items which write to the same index, preserving their
+    relative order, so that each group can be indexed independently of
+    the others with the same result as a sequential run.
+    '''
+    groups = {}
+    for item in items:
+        key = (item['type'], item['partpath'] / item['partfile'])
+        groups.setdefault(key, []).append(item)
+    return list(groups.values())
+
+
+def index_work_items(src_dir, dst_dir, items, preloaded=None):
+    '''
+    Indexes a group of work items, as returned by group_work_items.
+    preloaded is the decoded part file of the group, as returned by
+    preload_part, if it was read ahead.
+
+    Returns a dict containing the list of source files, other than those
+    listed in the work items, on which the index depends, the digest of
+    the index (see sinks.CsvSink.digest), the counts of its entities and
+    its points, tallied as its rows are written (see summary.TallySink),
+    the key of its entry in the result store, if any, the statistics
+    collected while indexing them and, if rows are being collected, the
+    rows of the index.
+    '''
+    rows = [] if worker_collect_rows else None
+    entities = points = None
+    partpath, partfile = items[0]['partpath'], items[0]['partfile']
+    part = os.path.relpath(partpath / partfile, src_dir).replace(os.sep, '/')
+    with stats.part_timer(part):
+        if not grids.enabled:
+            # Any grid exported by an earlier run would be stale.
+            grids.remove_grid(
+                grids.grid_path(src_dir, dst_dir, partpath, partfile)
+            )
+        key = stored = None
+        if worker_store is not None:
+            with stats.timer('store'):
+                key = worker_store.group_key(items)
+                if key is not None:
+                    stored = worker_store.restore(
+                        key, src_dir, dst_dir, partpath, partfile,
+                        worker_sink, worker_collect_rows
+                    )
+        if stored is not None:
+            for item in items:
+                print(item['partpath'] / item['partfile'])
+            deps = stored['deps']
+            entities = stored['entities']
+            points = stored['points']
+            if worker_collect_rows: rows = stored['rows']
+            stats.count('parts reused')
+        else:
+            sink = TallySink(worker_sink)
+            deps = index_group(src_dir, dst_dir, items, rows, preloaded, sink)
+            entities = sink.entities
+            points = sink.points
+            if key is not None:
+                with stats.timer('store'):
+                    worker_store.save(
+                        key, src_dir, dst_dir, partpath, partfile,
+                        worker_sink, deps, rows, entities, points
+                    )
+        with stats.timer('index digest'):
+            digest = worker_sink.digest(
+                worker_sink.index_path(src_dir, dst_dir, partpath, partfile),
+                rows
+            )
+    stats.count('parts')
+    return {'deps': deps, 'rows': rows, 'digest': digest,
+            'entities': entities, 'points': points, 'key': key,
+            'stats': stats.take()}
+
+
+def index_group(src_dir, dst_dir, items, rows, preloaded, sink):
+    '''
+    Indexes the work items of a group in turn into the given sink; see
+    index_work_items. Returns the list of source files on which the
+    index depends.
+    '''
+    deps = []
+    for item in items:
+        partpath, partfile = item['partpath'], item['partfile']
+        print(partpath / partfile)
+        try:
+            if item['type'] == 'tmx':
+                deps.extend(index_tiled_dungeon_part(
+                    src_dir, dst_dir, partpath, partfile,
+                    worker_tiled_parser, rows, sink, preloaded
+                ))
+            else:
+                index_png_dungeon_part(
+                    src_dir, dst_dir, partpath, partfile,
+                    item['brushes'], rows, sink, preloaded
+                )
+        except Exception as e:
+            raise PartIndexError(
+                str(partpath / partfile),
+                '{}: {}'.format(type(e).__name__, e)
+            ) from e
+        # The other items of the group are for the same file, which the
+        # indexers keep after reading it once.
+        preloaded = None
+    return deps
+
+
+def preload_part(item):
+    '''
+    Reads and decodes the part file of a work item: the scan of a PNG
+    part, or the JSON of a Tiled part. Returns None if it cannot be read,
+    leaving the indexer to read it and report any error.
+    '''
+    path = item['partpath'] / item['partfile']
+    try:
+        if item['type'] == 'tmx':
+            return read_tiled_json(path)
+        return read_png_scan(path)
+    except Exception as e:
+        return None
+
+
+def prefetch_groups(groups, depth):
+    '''
+    Yields the given tuples of a group of work items, its output and its
+    dependencies, each extended with its part file as returned by
+    preload_part. A pool of threads reads and decodes the part files of
+    up to depth groups ahead of the one being indexed, overlapping disk
+    reads and image decoding, which release the GIL, with indexing.
+    '''
+    if depth <= 0 or len(groups) <= 1:
+        for entry in groups:
+            yield entry + (None,)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(depth, prefetch_threads))
+    try:
+        entries = iter(groups)
+        pending = deque()
+        for entry in entries:
+            pending.append((entry, executor.submit(preload_part, entry[0][0])))
+            if len(pending) >= depth: break
+        while pending:
+            entry, future = pending.popleft()
+            for next_entry in entries:
+                pending.append((
+                    next_entry, executor.submit(preload_part, next_entry[0][0])
+                ))
+                break
+            with stats.timer('prefetch wait'):
+                preloaded = future.result()
+            yield entry + (preloaded,)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def work_item_deps(items):
+    '''
+    Returns the source files on which a group of work items is known to
+    depend prior to indexing.
+    '''
+    deps = set()
+    for item in items:
+        deps.add(item['partpath'] / item['partfile'])
+        deps.update(item['deps'])
+    return deps
+
+
+def run_work_items(
+    src_dir, dst_dir, items, jobs=1, manifest=None, tiled_parser='native',
+    database=None, sink=None, select=None, database_prefix='', store=None,
+    spatial_builder=None
+):
+    '''
+    Indexes the given work items, either in this process or, if jobs is
+    greater than one, across a pool of worker processes. The resulting
+    indices are identical either way.
+
+    If a manifest is given, work items whose index is up to date are
+    skipped, and the dependencies of the indices written are recorded in
+    the manifest.
+
+    tiled_parser selects how Tiled maps are read; see
+    tiled.load_tiled_map.
+
+    The indices are written to the given sink, by default CSV files. If
+    a database is given, the rows of each index written are also stored
+    in it, under the part path prefixed with database_prefix.
+
+    If select is given, only the groups of work items for which
+    select(output, deps) is true are indexed; see make_layer_selector.
+
+    If a store is given, the indices of parts found in it are written
+    from it rather than indexed, and those indexed are added to it; see
+    store.ResultStore.
+
+    If a spatial.SpatialBuilder is given, the points of the indices
+    written are added to it.
+    '''
+    sink = sink or CsvSink()
+    groups = []
+    for group in group_work_items(items):
+        output = sink.index_path(
+            src_dir, dst_dir, group[0]['partpath'], group[0]['partfile']
+        )
+        deps = work_item_deps(group)
+        if select is not None and not select(output, deps):
+            stats.count('parts in lower layers')
+            continue
+        if manifest is not None:
+            with stats.timer('manifest check'):
+                current = manifest.is_current(output, deps)
+            if current and grids.enabled and not os.path.isfile(
+                grids.grid_path(src_dir, dst_dir, group[0]['partpath'],
+                                group[0]['partfile'])
+            ):
+                # The part was indexed without exporting its grid.
+                current = False
+            if current:
+                stats.count('parts skipped')
+                continue
+        groups.append((group, output, deps))
+
+    def record(group, output, deps, result):
+        stats.merge(result['stats'])
+        if manifest is not None:
+            manifest.record(
+                output, deps.union(result['deps']), result['digest'],
+                result['entities'], result['key']
+            )
+        if spatial_builder is not None:
+            spatial_builder.add(output, result['points'])
+        if database is None and not sink.collects_rows: return
+        part = sink.part_key(
+            os.path.relpath(output, dst_dir).replace(os.sep, '/')
+        )
+        sink.write_part(part, result['rows'])
+        if database is not None:
+            with stats.timer('database'):
+                database.replace_part(database_prefix + part, result['rows'])
+
+    initargs = (
+        tiled_parser, jsonloader.cache_dir,
+        database is not None or sink.collects_rows, sink,
+        stats.profiling_config(), assets.source, png.stream_min_pixels,
+        store, grids.enabled, spatial.enabled
+    )
+    if jobs <= 1 or len(groups) <= 1:
+        init_worker(*initargs)
+        for group, output, deps, preloaded in prefetch_groups(
+            groups, prefetch_depth
+        ):
+            record(group, output, deps,
+                   index_work_items(src_dir, dst_dir, group, preloaded))
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_pool_worker,
+        initargs=initargs
+    ) as executor:
+        futures = {
+            executor.submit(index_work_items, src_dir, dst_dir, group):
+            (group, output, deps)
+            for group, output, deps in groups
+        }
+        try:
+            for future in as_completed(futures):
+                record(*futures[future], future.result())
+        except BaseException:
+            for future in futures: future.cancel()
+            raise
+
+
+def index_all_dungeons(
+    src_dir, dst_dir, jobs=1, manifest=None, tiled_parser='native',
+    database=None, sink=None, select=None, database_prefix='', store=None,
+    spatial_builder=None
+):
+    '''
+    Indexes the parts of the dungeons of the assets in src_dir; see
+    run_work_items. Returns the work items planned.
+    '''
+    ddir = src_dir / 'dungeons'
+    if not assets.is_dir(ddir):
+        # These assets do not contain any dungeon files.
+        return []
+
+    with stats.timer('plan dungeons'):
+        items = plan_all_dungeons(src_dir)
+    run_work_items(
+        src_dir, dst_dir, items, jobs, manifest, tiled_parser, database,
+        sink, select, database_prefix, store, spatial_builder
+    )
+    return items
 
 
 def extract_blockKey(
@@ -95,56 +500,46 @@ def extract_blockKey(
     full_blockKey_path = full_dungeon_dir / blockKeyFilename
     if blockKeyFilename[0] == '/':
         full_blockKey_path = src_dir / blockKeyFilename[1:]
-    blockKey = blockKeys.get(full_blockKey_path)
+    key = (assets.identity(full_blockKey_path), blockKeyKey)
+    blockKey = blockKeys.get(key)
     if not blockKey:
         print(full_blockKey_path)
-        with open(full_blockKey_path, 'rb') as fh:
-            # See above comments on json_minify.
-            try:
-                blockKey = json.loads(fh.read())
-            except json.decoder.JSONDecodeError as e:
-                fh.seek(0)
-                blockKey = json.loads(json_minify(fh.read().decode('utf-8')))
-            blockKey = blockKey[blockKeyKey]
-        blockKeys[full_blockKey_path] = blockKey
-    return blockKey
+        blockKey = jsonloader.load(full_blockKey_path)[blockKeyKey]
+        blockKeys[key] = blockKey
+    return full_blockKey_path, blockKey
 
 
-def index_all_ships(src_dir, dst_dir):
+def plan_all_ships(src_dir):
+    '''
+    Parses all ship structure files and returns the list of work items
+    needed to index their block images.
+    '''
+    items = []
     sdir = src_dir / 'ships'
-    if not sdir.is_dir():
-        # These assets do not contain any ship files.
-        return
-
-    blockKeys = {}
-    for relative_path in sdir.glob('**/*.structure'):
+    for relative_path in assets.glob(sdir, '**/*.structure'):
         full_dungeon_path = sdir / relative_path
         full_dungeon_dir = full_dungeon_path.parent
-        dungeon = None
         print(full_dungeon_path)
-        with open(full_dungeon_path, 'rb') as fh:
-            # See above comments on json_minify.
-            try:
-                dungeon = json.loads(fh.read())
-            except json.decoder.JSONDecodeError as e:
-                fh.seek(0)
-                dungeon = json.loads(json_minify(fh.read().decode('utf-8')))
+        dungeon = jsonloader.load(full_dungeon_path)
 
         blockKey = None
+        blockKeyPath = None
+        deps = [full_dungeon_path]
         if isinstance(dungeon['blockKey'], str):
             blockKeyFilename, blockKeyKey = dungeon['blockKey'].split(':')
             try:
-                blockKey = extract_blockKey(
+                blockKeyPath, blockKey = extract_blockKey(
                     full_dungeon_dir, src_dir,
-                    blockKeys, blockKeyFilename, blockKeyKey
+                    caches.block_keys, blockKeyFilename, blockKeyKey
                 )
             except FileNotFoundError as e:
                 # BETA - incorrect file case.
                 blockKeyFilename = blockKeyFilename.lower()
-                blockKey = extract_blockKey(
+                blockKeyPath, blockKey = extract_blockKey(
                     full_dungeon_dir, src_dir,
-                    blockKeys, blockKeyFilename, blockKeyKey
+                    caches.block_keys, blockKeyFilename, blockKeyKey
                 )
+            deps.append(blockKeyPath)
         elif isinstance(dungeon['blockKey'], list):
             # BETA
             blockKey = dungeon['blockKey']
@@ -152,22 +547,261 @@ def index_all_ships(src_dir, dst_dir):
             print('ERROR: unknown blockKey format')
             sys.exit(1)
 
-        brushes = process_ship_brushes(blockKey)
+        # Ships commonly share a block key, in which case they share its
+        # compiled brushes.
+        brushes = None
+        if blockKeyPath is not None:
+            key = (assets.identity(blockKeyPath), blockKeyKey)
+            brushes = caches.brush_tables.get(key)
+        if brushes is None:
+            brushes = compile_brushes(process_ship_brushes(blockKey))
+            if blockKeyPath is not None:
+                caches.brush_tables[key] = brushes
 
-        partpath = full_dungeon_dir
-        partfile = dungeon['blockImage']
-        if partfile[0] == '/':
-            partpath = src_dir / os.path.dirname(partfile)[1:]
-            partfile = os.path.basename(partfile)
-        assert partfile == os.path.basename(partfile)
-        print(partpath / partfile)
-        index_png_dungeon_part(src_dir, dst_dir, partpath, partfile, brushes)
+        partpath, partfile = resolve_part(
+            src_dir, full_dungeon_dir, dungeon['blockImage']
+        )
+        items.append({
+            'type': 'png',
+            'partpath': partpath,
+            'partfile': partfile,
+            'brushes': brushes,
+            'deps': deps
+        })
+    return items
+
+
+def index_all_ships(
+    src_dir, dst_dir, jobs=1, manifest=None, database=None, sink=None,
+    select=None, database_prefix='', store=None, spatial_builder=None
+):
+    '''
+    Indexes the block images of the ships of the assets in src_dir; see
+    run_work_items. Returns the work items planned.
+    '''
+    sdir = src_dir / 'ships'
+    if not assets.is_dir(sdir):
+        # These assets do not contain any ship files.
+        return []
+
+    with stats.timer('plan ships'):
+        items = plan_all_ships(src_dir)
+    run_work_items(
+        src_dir, dst_dir, items, jobs, manifest, database=database,
+        sink=sink, select=select, database_prefix=database_prefix,
+        store=store, spatial_builder=spatial_builder
+    )
+    return items
+
+
+def layer_names(src_dirs):
+    '''
+    Returns a distinct name for each folder or .pak archive of a mod
+    stack, from which its index folder is named: the folder's own name, or
+    the archive's without its extension, suffixed with a number if it is
+    already taken by a lower layer.
+    '''
+    names = []
+    for src_dir in src_dirs:
+        name = src_dir.name
+        if src_dir.suffix == '.pak' and src_dir.is_file():
+            name = src_dir.stem
+        candidate = name
+        n = 1
+        while candidate in names:
+            n += 1
+            candidate = '{}-{}'.format(name, n)
+        names.append(candidate)
+    return names
+
+
+def make_layer_selector(src_dir, dst_dir, layer, known_deps):
+    '''
+    Returns a function for run_work_items selecting the parts of a layer
+    of a mod stack whose index may differ from that of the layers below:
+    those for which the layer provides a source file. The indices of
+    other parts are left to the layers below.
+
+    known_deps maps the paths of indices, relative to the destination
+    folder of each layer, to the source files recorded for them by the
+    layers below, so that files only found while indexing, such as
+    external tilesets, are also considered.
+    '''
+    def select(output, deps):
+        key = os.path.relpath(output, dst_dir).replace(os.sep, '/')
+        deps = set(deps)
+        deps.update(src_dir / dep for dep in known_deps.get(key, ()))
+        return any(assets.layer(dep) == layer for dep in deps)
+    return select
+
+
+def prune_indices(manifest, sink):
+    '''
+    Deletes the indices of the previous manifest of a destination folder
+    that were not written or carried over to the given manifest, along
+    with their grids and spatial indices. Returns the list of the paths
+    of the indices deleted.
+    '''
+    dst_dir = manifest.dst_dir
+
+    def remove_extras(path):
+        part = manifest.previous_sink.part_key(
+            os.path.relpath(path, dst_dir).replace(os.sep, '/')
+        )
+        grids.remove_grid(dst_dir / (part + grids.grid_suffix))
+        remove_spatial(spatial_path(dst_dir, part))
+
+    deleted = manifest.prune(remove_extras)
+    for path in deleted:
+        print('deleted {}'.format(path))
+    return deleted
+
+
+def index_layer(
+    src_dir, dst_dir, args, jobs, database=None, select=None,
+    database_prefix='', store=None, plans=None
+):
+    '''
+    Indexes the dungeons and ships of the assets in src_dir into dst_dir,
+    with the options given on the command line, reusing and adding to the
+    given result store, and, if enabled, writes the spatial indices of the
+    parts indexed. Returns the manifest of the indices.
+
+    If plans is given, the work items planned for the dungeons and ships
+    are stored in it under 'dungeons' and 'ships'.
+    '''
+    sink = make_sink(args.format, dst_dir)
+    manifest = Manifest.load(src_dir, dst_dir, sink, args.full)
+    if manifest.full: sink.start_over()
+    spatial_builder = SpatialBuilder(manifest)
+
+    if plans is None: plans = {}
+    # Tiled parts are indexed once per layer.
+    caches.seen_tiled_parts.clear()
+    try:
+        plans['dungeons'] = index_all_dungeons(
+            src_dir, dst_dir, jobs, manifest, args.tiled_parser, database,
+            sink, select, database_prefix, store, spatial_builder
+        )
+        plans['ships'] = index_all_ships(
+            src_dir, dst_dir, jobs, manifest, database, sink, select,
+            database_prefix, store, spatial_builder
+        )
+    except PartIndexError as e:
+        print('ERROR: failed to index part: {}'.format(str(e)),
+              file=sys.stderr)
+        sys.exit(1)
+
+    prune_indices(manifest, sink)
+    sink.close(len(manifest.outputs))
+    with stats.timer('summary'):
+        tally_missing(manifest, sink)
+    spatial_builder.save()
+    manifest.save()
+
+    if database is not None:
+        # Parts skipped because their indices are up to date, or deleted,
+        # must still be reflected in the database.
+        with stats.timer('database'):
+            database.sync(dst_dir, manifest.outputs, sink, database_prefix)
+    return manifest
+
+
+def index_sources(src_dirs, sources, dst_dir, args, jobs, database, store):
+    '''
+    Indexes an asset folder or .pak archive, or a stack of them, into
+    dst_dir with the options given on the command line. sources are the
+    sources of src_dirs, as returned by make_source.
+
+    The entity counts of the parts are then summarized into the summary
+    file of dst_dir; see summary.summarize. Those of a stack are of the
+    parts of all of its layers, each from the topmost layer indexing it.
+
+    Returns a list of dicts describing each layer indexed, for
+    watch.WatchedIndex: its source folder, destination folder, database prefix,
+    the asset source from which it was read (see assets.set_source), its
+    manifest, and the work items planned for it (see index_layer).
+    '''
+    layers = []
+    if len(src_dirs) == 1:
+        source = None
+        if isinstance(sources[0], PakSource):
+            source = OverlaySource(sources)
+        layers.append({
+            'src_dir': src_dirs[0], 'dst_dir': dst_dir, 'prefix': '',
+            'source': source, 'plans': {}
+        })
+    else:
+        # Each layer of the stack is indexed into its own folder, and
+        # only for the parts that it adds or changes.
+        names = layer_names(src_dirs)
+        for layer in range(len(src_dirs)):
+            (dst_dir / names[layer]).mkdir(exist_ok=True)
+            layers.append({
+                'src_dir': src_dirs[layer],
+                'dst_dir': dst_dir / names[layer],
+                'prefix': names[layer] + '/',
+                'source': OverlaySource(sources[:layer + 1]),
+                'plans': {}
+            })
+    known_deps = {}
+    parts = {}
+    for index, layer in enumerate(layers):
+        assets.set_source(layer['source'])
+        select = None
+        if index > 0:
+            select = make_layer_selector(
+                layer['src_dir'], layer['dst_dir'], index, known_deps
+            )
+        layer['manifest'] = manifest = index_layer(
+            layer['src_dir'], layer['dst_dir'], args, jobs, database, select,
+            layer['prefix'], store, layer['plans']
+        )
+        for key, entry in manifest.outputs.items():
+            known_deps.setdefault(key, set()).update(entry['deps'])
+        parts.update(manifest_parts(manifest))
+    assets.set_source(None)
+    write_summary(dst_dir, SummaryTally(parts))
+    if store is not None:
+        store.collect(
+            manifest_store_keys(layer['manifest'] for layer in layers)
+        )
+    return layers
+
+
+# The stages of indexing: the folder of the files from which the work
+# items of each are planned, their extension, and the planning function.
+stages = [
+    ('dungeons', '.dungeon', plan_all_dungeons),
+    ('ships', '.structure', plan_all_ships)
+]
 
 
 def main():
+    global prefetch_depth
     parser = argparse.ArgumentParser(
         description="Index the resources used in Starbound dungeons."
     )
+    parser.add_argument(
+        '--cache-dir', default=jsonloader.default_cache_dir(),
+        help='the folder in which to cache parsed files (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=jsonloader.cache_max_size >> 20,
+        metavar='MIB',
+        help='the maximum size of the cache, beyond which the least '
+             'recently used files are deleted (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='do not cache parsed files'
+    )
+    parser.add_argument(
+        '--no-store', action='store_true',
+        help='index every part, rather than reusing the indices of parts '
+             'with identical contents from the store in the destination '
+             'folder, and do not add to the store'
+    )
     parser.add_argument(
         '-d', '--dst', required=True,
         help='the folder in which to write the indices'
@@ -177,28 +811,170 @@ def main():
         help='force parsing if _metadata not found'
     )
     parser.add_argument(
-        '-s', '--src', required=True,
-        help='the folder containing the unpacked assets'
+        '--format', choices=output_formats, default='csv',
+        help='the format of the indices: one CSV file per part (the '
+             'default), one gzip-compressed CSV file per part, or a single '
+             'JSON Lines stream, index.jsonl'
+    )
+    parser.add_argument(
+        '--full', action='store_true',
+        help='re-index all parts, even those whose sources are unchanged'
+    )
+    parser.add_argument(
+        '--grids', action='store_true',
+        help='also export the grid of each part, the brush id of each pixel '
+             'of PNG parts or the gid of each tile of Tiled parts, as a '
+             '.npy file beside its index'
+    )
+    parser.add_argument(
+        '--spatial', action='store_true',
+        help='also write a spatial index of each part with entities with '
+             'coordinates, as a .spatial.json file beside its index; see '
+             'spatial.SpatialIndex'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='the number of worker processes to use; 0 uses one per CPU'
+    )
+    parser.add_argument(
+        '--prefetch', type=int, default=prefetch_depth, metavar='N',
+        help='the number of parts to read and decode ahead of the part '
+             'being indexed, when not using worker processes; 0 disables '
+             'prefetching (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--profile', choices=['cprofile', 'tracemalloc'],
+        help='profile each part, saving the cProfile statistics or '
+             'tracemalloc snapshot of those slower than --profile-threshold '
+             'to --profile-dir'
+    )
+    parser.add_argument(
+        '--profile-dir', default='profiles',
+        help='the folder in which to save profiles (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--profile-threshold', type=float, default=1.0, metavar='SECONDS',
+        help='the time a part must take to index for its profile to be '
+             'saved (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--sqlite', metavar='PATH',
+        help='also store the indices in a single SQLite database, for use '
+             'with pystarbound-dungeons-query'
+    )
+    parser.add_argument(
+        '--stats-json', metavar='PATH',
+        help='write a report of the time spent in each stage, the slowest '
+             'parts and the work done to the given file'
+    )
+    parser.add_argument(
+        '--stream-png', type=int, metavar='PIXELS',
+        help='decode PNG parts of at least PIXELS pixels a few scanlines at '
+             'a time as they are indexed, bounding the memory used for very '
+             'large parts; 0 streams all parts. Streamed parts take about '
+             'twice as long to index: decoding costs about a quarter more, '
+             'and the rest comes from indexing scanline by scanline'
+    )
+    parser.add_argument(
+        '--tiled-parser', choices=['native', 'pytiled', 'validate'],
+        default='native',
+        help='how to read Tiled maps: with the built-in reader (the '
+             'default), with pytiled_parser, or with both, failing if '
+             'they disagree'
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='after indexing, keep watching the source folders, indexing '
+             'the parts affected by each change, until interrupted'
+    )
+    parser.add_argument(
+        '-s', '--src', required=True, action='append',
+        help='the folder containing the unpacked assets, or a .pak archive '
+             'such as packed.pak; repeat to index a stack of mods over the '
+             'base assets, lowest first'
     )
     args = parser.parse_args()
+    start = time.perf_counter()
+    prefetch_depth = args.prefetch
+    png.stream_min_pixels = args.stream_png
+    grids.enabled = args.grids
+    spatial.enabled = args.spatial
 
     dst_dir = Path(args.dst)
     dst_dir.mkdir(parents=True, exist_ok=True)
     dst_dir = dst_dir.resolve(strict=True)
 
-    src_dir = Path(args.src).resolve(strict=True)
+    src_dirs = [Path(src).resolve(strict=True) for src in args.src]
 
-    if dst_dir.samefile(src_dir)\
-       or dst_dir.is_relative_to(src_dir)\
-       or src_dir.is_relative_to(dst_dir):
-        print('ERROR: destination and source folders must be independent',
-              file=sys.stderr)
-        sys.exit(1)
+    for src_dir in src_dirs:
+        if dst_dir.samefile(src_dir)\
+           or dst_dir.is_relative_to(src_dir)\
+           or src_dir.is_relative_to(dst_dir):
+            print('ERROR: destination and source folders must be '
+                  'independent', file=sys.stderr)
+            sys.exit(1)
 
-    if not args.force and not (src_dir / '_metadata').is_file():
-        print('ERROR: source folder does not contain Starbound assets',
-              file=sys.stderr)
+        if not args.force and src_dir.is_dir()\
+           and not (src_dir / '_metadata').is_file()\
+           and not (src_dir / '.metadata').is_file():
+            print('ERROR: source folder does not contain Starbound assets: '
+                  '{}'.format(src_dir), file=sys.stderr)
+            sys.exit(1)
+
+    sources = []
+    for src_dir in src_dirs:
+        try:
+            sources.append(make_source(src_dir))
+        except PakError as e:
+            print('ERROR: invalid .pak archive: {}: {}'.format(
+                src_dir, str(e)), file=sys.stderr)
+            sys.exit(1)
+    if args.watch\
+       and not any(isinstance(source, DirectorySource) for source in sources):
+        print('ERROR: --watch requires an asset folder', file=sys.stderr)
+        sys.exit(1)
+    if args.tiled_parser != 'native'\
+       and any(isinstance(source, PakSource) for source in sources):
+        print('ERROR: --tiled-parser {} cannot read .pak archives'.format(
+            args.tiled_parser), file=sys.stderr)
         sys.exit(1)
 
-    index_all_dungeons(src_dir, dst_dir)
-    index_all_ships(src_dir, dst_dir)
+    jsonloader.set_cache_dir(None if args.no_cache else args.cache_dir)
+    jsonloader.cache_max_size = args.cache_size << 20
+    if args.profile:
+        stats.configure_profiling(
+            args.profile, args.profile_threshold,
+            Path(args.profile_dir).resolve()
+        )
+
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    database = None
+    if args.sqlite:
+        database = IndexDatabase(args.sqlite)
+
+    # The store is shared by all layers of a mod stack, whose copies of
+    # the parts of lower layers are then not indexed again.
+    store = None
+    if not args.no_store:
+        store = ResultStore(dst_dir / store_name)
+
+    layers = index_sources(
+        src_dirs, sources, dst_dir, args, jobs, database, store
+    )
+    jsonloader.trim_cache()
+    if args.watch:
+        watch.watch_sources(
+            src_dirs, sources, dst_dir, args, database, store, layers
+        )
+
+    if database is not None:
+        database.close()
+
+    if args.stats_json:
+        stats.write_report(
+            args.stats_json, time.perf_counter() - start, jobs=jobs,
+            format=args.format, tiled_parser=args.tiled_parser
+        )
@@ -0,0 +1,177 @@
+from . import assets, stats
+
+from pathlib import Path
+
+import hashlib
+import json
+import os
+import re
+
+
+# The folder in which parsed lenient JSON files, and other files derived
+# from asset files such as compiled tilesets, are cached, or None to
+# disable caching. See set_cache_dir and cache_path.
+cache_dir = None
+
+# Bump this whenever a change to the parsing of lenient JSON files
+# changes the values parsed, so that cached files are parsed again.
+loader_version = 1
+
+# The maximum total size, in bytes, of the files in the cache folder,
+# beyond which the least recently used are deleted; see trim_cache.
+cache_max_size = 256 << 20
+
+# Matches strings, which must be passed through untouched, and comments.
+comment_re = re.compile(
+    r'"[^"\\]*(?:\\.[^"\\]*)*"|//[^\n]*|/\*.*?\*/', re.DOTALL
+)
+
+# Matches strings, which must be passed through untouched, and commas
+# followed only by whitespace before the end of an array or object.
+trailing_comma_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|,(?=\s*[\]}])')
+
+
+def default_cache_dir():
+    '''
+    Returns the default cache folder for this package, following the
+    XDG base directory convention.
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'py-starbound-dungeons'
+
+
+def set_cache_dir(path):
+    '''
+    Sets the cache folder, or disables caching if path is None.
+    '''
+    global cache_dir
+    cache_dir = path and Path(path)
+
+
+def cache_path(kind, data, version):
+    '''
+    Returns the path at which the file of the given kind, e.g., 'json',
+    derived from an asset file with the given contents by the given
+    version of its reader is cached, or None if caching is disabled.
+    '''
+    if cache_dir is None: return None
+    key = hashlib.sha256(data).hexdigest()
+    return cache_dir / kind / key[:2] / '{}.v{}.json'.format(key, version)
+
+
+def read_cache(path, counter):
+    '''
+    Returns the decoded contents of a cached file, counting a hit with the
+    given counter, or None if it is not cached.
+    '''
+    if path is None: return None
+    try:
+        with open(path, 'rb') as fh:
+            value = json.loads(fh.read())
+    except (OSError, ValueError) as e:
+        return None
+    try:
+        # Marks the file as recently used; see trim_cache.
+        os.utime(path)
+    except OSError as e:
+        pass
+    stats.count(counter)
+    return value
+
+
+def write_cache(path, value):
+    '''
+    Caches a value at the given path, as returned by cache_path, if
+    caching is enabled.
+    '''
+    if path is None: return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        with open(tmp_path, 'w') as fh:
+            json.dump(value, fh, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print('WARNING: unable to write cache: {}'.format(str(e)))
+
+
+def _strip_comment(match):
+    token = match.group(0)
+    if token[0] == '"': return token
+    # Keep line breaks, so that error positions remain meaningful.
+    return '\n' * token.count('\n') or ' '
+
+
+def _strip_trailing_comma(match):
+    token = match.group(0)
+    if token[0] == '"': return token
+    return ''
+
+
+def loads_lenient(text):
+    '''
+    Parses Starbound's dialect of JSON, which permits comments and
+    trailing commas, in linear time.
+
+    text is a str.
+    '''
+    text = comment_re.sub(_strip_comment, text)
+    text = trailing_comma_re.sub(_strip_trailing_comma, text)
+    return json.loads(text)
+
+
+def loads(data):
+    '''
+    Parses JSON in Starbound's dialect from bytes, caching the result if
+    the data is not strict JSON and a cache folder is set.
+    '''
+    # Most files are strict JSON, which is fastest to parse directly.
+    try:
+        with stats.timer('json'):
+            return json.loads(data)
+    except ValueError as e:
+        pass
+
+    path = cache_path('json', data, loader_version)
+    value = read_cache(path, 'json cache hits')
+    if value is not None: return value
+
+    with stats.timer('json lenient'):
+        value = loads_lenient(data.decode('utf-8-sig'))
+    write_cache(path, value)
+    return value
+
+
+def trim_cache():
+    '''
+    Deletes the least recently used files of the cache folder, such as
+    those of older versions of their readers, until their total size is
+    at most cache_max_size.
+    '''
+    if cache_dir is None: return
+    files = []
+    for folder, dirs, names in os.walk(cache_dir):
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError as e:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, path))
+    total = sum(size for mtime, size, path in files)
+    for mtime, size, path in sorted(files):
+        if total <= cache_max_size: break
+        try:
+            os.unlink(path)
+        except FileNotFoundError as e:
+            pass
+        total -= size
+        stats.count('cache files deleted')
+
+
+def load(path):
+    '''
+    Reads and parses a JSON file in Starbound's dialect. See loads.
+    '''
+    with assets.open_file(path) as fh:
+        return loads(fh.read())
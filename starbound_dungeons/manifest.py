@@ -0,0 +1,280 @@
+from . import assets
+from .sinks import CsvSink, make_sink, output_formats
+
+import hashlib
+import json
+import os
+
+
+# The name of the manifest file written to the destination folder.
+manifest_name = '.manifest.json'
+
+# The name of the journal of the entries changed since the manifest was
+# last written whole; see Manifest.save_changes.
+journal_name = '.manifest.journal'
+
+# Bump this whenever a change to the indexer changes the contents of the
+# indices it writes, so that all indices are rewritten on the next run.
+manifest_version = 2
+
+
+def file_fingerprint(path):
+    '''
+    Returns a dict describing the current state of a file: its size,
+    modification time and a hash of its contents.
+    '''
+    st = assets.stat(path)
+    h = hashlib.sha256()
+    with assets.open_file(path) as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return {
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'sha256': h.hexdigest()
+    }
+
+
+def read_journal(dst_dir, outputs):
+    '''
+    Applies the changes recorded in the journal of the manifest of a
+    destination folder to the given entries of its indices.
+    '''
+    try:
+        with open(dst_dir / journal_name, 'rb') as fh:
+            for line in fh:
+                try:
+                    change = json.loads(line)
+                except ValueError as e:
+                    # The last change may have been cut short.
+                    break
+                if change['entry'] is None:
+                    outputs.pop(change['key'], None)
+                else:
+                    outputs[change['key']] = change['entry']
+    except FileNotFoundError as e:
+        pass
+
+
+def read_manifest(dst_dir):
+    '''
+    Returns the decoded manifest of a destination folder, including the
+    changes recorded in its journal, or None if it is missing or
+    unreadable.
+    '''
+    try:
+        with open(dst_dir / manifest_name, 'rb') as fh:
+            manifest = json.loads(fh.read())
+    except (OSError, ValueError) as e:
+        return None
+    read_journal(dst_dir, manifest.setdefault('outputs', {}))
+    return manifest
+
+
+class Manifest:
+    '''
+    Records, for each index written to a destination folder, the source
+    files that the index was generated from, so that a subsequent run
+    can skip the indices whose sources have not changed and delete the
+    indices whose parts no longer exist.
+
+    Source paths are stored relative to the source folder and index
+    paths relative to the destination folder. sink is the output sink to
+    which the indices are written; see sinks.make_sink. previous_sink is
+    the sink to which the indices of the previous manifest were written,
+    from which those no longer generated are deleted.
+
+    If full is true, or the previous manifest is outdated, no index is
+    current, but those of the previous manifest are still pruned.
+    '''
+    def __init__(self, src_dir, dst_dir, previous=None, sink=None,
+                 previous_sink=None, full=False):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.previous = previous or {}
+        self.sink = sink or CsvSink()
+        self.previous_sink = previous_sink or self.sink
+        self.full = full
+        self.outputs = {}
+        self.fingerprints = {}
+
+    @classmethod
+    def load(cls, src_dir, dst_dir, sink=None, full=False):
+        '''
+        Loads the manifest of a destination folder. A missing or
+        unreadable manifest, or one written in an unknown output format,
+        is treated as empty. The indices of an outdated manifest, or of
+        one written in another output format, are indexed again, and
+        those no longer generated are deleted.
+        '''
+        sink = sink or CsvSink()
+        previous = None
+        previous_sink = sink
+        manifest = read_manifest(dst_dir)
+        if manifest is not None\
+           and manifest.get('format', 'csv') in output_formats:
+            previous = manifest.get('outputs')
+            if manifest.get('format', 'csv') != sink.name:
+                previous_sink = make_sink(manifest['format'], dst_dir)
+                full = True
+            if manifest.get('version') != manifest_version:
+                full = True
+        return cls(src_dir, dst_dir, previous, sink, previous_sink, full)
+
+    def save(self):
+        tmp_path = self.dst_dir / '{}.tmp'.format(manifest_name)
+        with open(tmp_path, 'w') as fh:
+            json.dump({
+                'version': manifest_version,
+                'format': self.sink.name,
+                'outputs': self.outputs
+            }, fh, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.dst_dir / manifest_name)
+        # The journal's changes are now part of the manifest.
+        try:
+            os.unlink(self.dst_dir / journal_name)
+        except FileNotFoundError as e:
+            pass
+
+    def save_changes(self, keys):
+        '''
+        Saves the entries of the indices with the given paths, relative to
+        the destination folder, or their removal, by appending them to the
+        journal of the manifest rather than writing it whole. The manifest
+        is written whole instead once the journal would outgrow it.
+        '''
+        path = self.dst_dir / journal_name
+        try:
+            limit = os.path.getsize(self.dst_dir / manifest_name)
+        except FileNotFoundError as e:
+            limit = 0
+        if path.is_file(): limit -= os.path.getsize(path)
+        lines = [
+            json.dumps(
+                {'key': key, 'entry': self.outputs.get(key)},
+                separators=(',', ':'), sort_keys=True
+            ) + '\n'
+            for key in sorted(keys)
+        ]
+        if sum(map(len, lines)) > limit:
+            self.save()
+            return
+        with open(path, 'a', encoding='utf-8') as fh:
+            fh.write(''.join(lines))
+
+    def source_key(self, path):
+        return os.path.relpath(os.path.normpath(path), self.src_dir)\
+            .replace(os.sep, '/')
+
+    def output_key(self, path):
+        return os.path.relpath(path, self.dst_dir).replace(os.sep, '/')
+
+    def fingerprint(self, key):
+        fingerprint = self.fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = file_fingerprint(self.src_dir / key)
+            self.fingerprints[key] = fingerprint
+        return fingerprint
+
+    def unchanged(self, key, recorded):
+        '''
+        Determines if a source file matches its recorded fingerprint. The
+        contents are hashed only if the size or modification time differ.
+        '''
+        try:
+            st = assets.stat(self.src_dir / key)
+        except OSError as e:
+            return False
+        if st.st_size == recorded['size']\
+           and st.st_mtime_ns == recorded['mtime']:
+            self.fingerprints.setdefault(key, recorded)
+            return True
+        return self.fingerprint(key)['sha256'] == recorded['sha256']
+
+    def is_current(self, output, deps):
+        '''
+        Determines if the index at the given path is up to date with
+        respect to the given source files. If so, its manifest entry is
+        carried over to the new manifest.
+
+        output is the absolute path of the index. deps is an iterable of
+        absolute paths of the source files known before indexing.
+        '''
+        if self.full: return False
+        key = self.output_key(output)
+        entry = self.previous.get(key)
+        if entry is None or not self.sink.exists(output):
+            return False
+        recorded = entry['deps']
+        for dep in deps:
+            if self.source_key(dep) not in recorded:
+                return False
+        for dep_key, fingerprint in recorded.items():
+            if not self.unchanged(dep_key, fingerprint):
+                return False
+        self.outputs[key] = dict(
+            entry, deps={k: self.fingerprints[k] for k in recorded}
+        )
+        return True
+
+    def record(
+        self, output, deps, digest=None, entities=None, store_key=None
+    ):
+        '''
+        Records the source files from which the index at the given path
+        was generated, and the digest of the index, as returned by the
+        sink's digest method, the counts of its entities, as tallied by
+        summary.TallySink, and the key of its entry in the result store,
+        if known.
+        '''
+        deps = sorted(set(self.source_key(dep) for dep in deps))
+        entry = {'deps': {key: self.fingerprint(key) for key in deps}}
+        if digest is not None:
+            entry['digest'] = digest
+        if entities is not None:
+            entry['entities'] = entities
+        if store_key is not None:
+            entry['store'] = store_key
+        self.outputs[self.output_key(output)] = entry
+
+    def reuse(self, keys):
+        '''
+        Moves the entries of the indices with the given paths, relative to
+        the destination folder, back to the previous manifest, so that
+        they are checked again as by a new run, as in --watch. Returns
+        the paths of the entries moved.
+        '''
+        self.previous = {
+            key: self.outputs.pop(key) for key in keys if key in self.outputs
+        }
+        self.previous_sink = self.sink
+        self.full = False
+        return set(self.previous)
+
+    def prune(self, remove_extras=None):
+        '''
+        Deletes the indices recorded in the previous manifest that were
+        not generated or carried over by this run, along with any folders
+        left empty. If given, remove_extras is called with the path of
+        each index deleted to delete the files written along with it.
+
+        Returns the list of deleted index paths.
+        '''
+        deleted = []
+        for key in self.previous:
+            if key in self.outputs: continue
+            path = self.dst_dir / key
+            if not self.previous_sink.remove(path): continue
+            deleted.append(path)
+            if remove_extras is not None: remove_extras(path)
+            # Remove folders left empty by the deletion.
+            try:
+                for parent in path.parents:
+                    if parent == self.dst_dir: break
+                    parent.rmdir()
+            except OSError as e:
+                pass
+        if self.previous_sink is not self.sink:
+            # Nothing is left of the indices in the previous format.
+            self.previous_sink.close(0)
+        return deleted
@@ -0,0 +1,197 @@
+import io
+import mmap
+import struct
+
+
+# The magic number at the start of SBAsset6 archives, such as Starbound's
+# packed.pak and the .pak files of mods.
+pak_magic = b'SBAsset6'
+index_magic = b'INDEX'
+
+
+class PakError(Exception):
+    '''
+    Raised when a file is not a valid SBAsset6 archive.
+    '''
+    pass
+
+
+class IndexReader:
+    '''
+    Reads the values of the SBAsset6 index, which uses Starbound's
+    variable-length integers and binary JSON encoding, from a buffer.
+    '''
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+
+    def read(self, n):
+        end = self.pos + n
+        if end > len(self.buf):
+            raise PakError('truncated index')
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    def read_vlq(self):
+        value = 0
+        while True:
+            byte = self.buf[self.pos]
+            self.pos += 1
+            value = (value << 7) | (byte & 0x7f)
+            if not byte & 0x80: return value
+
+    def read_signed_vlq(self):
+        value = self.read_vlq()
+        if value & 1: return -(value >> 1) - 1
+        return value >> 1
+
+    def read_string(self):
+        return bytes(self.read(self.read_vlq())).decode('utf-8')
+
+    def read_json(self):
+        kind = self.read(1)[0]
+        if kind == 1:
+            return None
+        elif kind == 2:
+            return struct.unpack('>d', self.read(8))[0]
+        elif kind == 3:
+            return self.read(1)[0] != 0
+        elif kind == 4:
+            return self.read_signed_vlq()
+        elif kind == 5:
+            return self.read_string()
+        elif kind == 6:
+            return [self.read_json() for i in range(self.read_vlq())]
+        elif kind == 7:
+            value = {}
+            for i in range(self.read_vlq()):
+                key = self.read_string()
+                value[key] = self.read_json()
+            return value
+        raise PakError('unknown JSON type {}'.format(kind))
+
+
+def read_index(buf):
+    '''
+    Reads the index of an SBAsset6 archive.
+
+    Returns a tuple of the archive's metadata and a dict mapping the path
+    of each file in the archive, such as /dungeons/foo/foo.dungeon, to a
+    tuple of its offset and length.
+    '''
+    if len(buf) < 16 or buf[:8] != pak_magic:
+        raise PakError('not an SBAsset6 archive')
+    index_offset = struct.unpack('>Q', buf[8:16])[0]
+    reader = IndexReader(buf, index_offset)
+    if reader.read(len(index_magic)) != index_magic:
+        raise PakError('index not found')
+    metadata = {}
+    try:
+        for i in range(reader.read_vlq()):
+            key = reader.read_string()
+            metadata[key] = reader.read_json()
+        files = {}
+        for i in range(reader.read_vlq()):
+            path = reader.read_string()
+            files[path] = struct.unpack('>QQ', reader.read(16))
+    except IndexError as e:
+        raise PakError('truncated index')
+    for path, (offset, length) in files.items():
+        if offset + length > len(buf):
+            raise PakError('file out of bounds: {}'.format(path))
+    return metadata, files
+
+
+class MemberFile(io.RawIOBase):
+    '''
+    A read-only, seekable file object over a file in an archive, copying
+    its contents directly from the memory-mapped archive into the buffers
+    of the reader.
+    '''
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def readall(self):
+        data = bytes(self.view[self.pos:])
+        self.pos = len(self.view)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        super(MemberFile, self).close()
+
+
+class PakFile:
+    '''
+    A memory-mapped SBAsset6 archive. The index is read once, and the
+    contents of files are served as views of the mapping, without
+    extracting them.
+    '''
+    def __init__(self, path, index=None):
+        self.path = path
+        with open(path, 'rb') as fh:
+            try:
+                self.mapping = mmap.mmap(
+                    fh.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except ValueError as e:
+                # An empty file cannot be mapped.
+                raise PakError('not an SBAsset6 archive')
+        self.view = memoryview(self.mapping)
+        if index is None:
+            index = read_index(self.view)
+        self.metadata, self.files = index
+
+    def __getstate__(self):
+        # The mapping cannot be pickled; worker processes map the archive
+        # again, but reuse the index.
+        return {'path': self.path, 'index': (self.metadata, self.files)}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['index'])
+
+    def read(self, name):
+        '''
+        Returns a memoryview of the contents of the file with the given
+        path in the archive. Raises FileNotFoundError if there is none.
+        '''
+        try:
+            offset, length = self.files[name]
+        except KeyError as e:
+            raise FileNotFoundError('{} not found in {}'.format(
+                name, self.path)) from None
+        return self.view[offset:offset + length]
+
+    def open(self, name):
+        return io.BufferedReader(MemberFile(self.read(name)))
+
+    def close(self):
+        self.view.release()
+        self.mapping.close()
@@ -1,27 +1,32 @@
-from .common import make_dst_dir
+from . import assets, grids, pngstream, stats
+from .common import IndexRecord, RowRecorder, caches
+from .sinks import CsvSink
 
+from contextlib import nullcontext
 from PIL import Image
 
-import csv
+import hashlib
+import io
+import json
+import numpy as np
 import sys
+import time
+
+
+# Parts with at least this many pixels are decoded one scanline at a time
+# and indexed as they are decoded, in memory bounded by their width, see
+# stream_png_records; None decodes all parts whole.
+stream_min_pixels = None
 
 
 class BrushParseError(Exception):
-    def __init__(category, color):
-        super(BrushParseError, self).__init__()
+    def __init__(self, category, color):
+        super(BrushParseError, self).__init__(category, color)
         self.category = category
         self.color = color
 
-    def __repr__():
-        return 'unknown tile brush ({}): {}'.format(category, color)
-
-
-def png_maybe_output(tile, seen, csvout, rows):
-    if tile['record'] == 'always':
-        for row in rows: csvout.writerow(row)
-    elif tile['record'] == 'once' and tile['color'] not in seen:
-        for row in rows: csvout.writerow(row)
-        seen.add(tile['color'])
+    def __str__(self):
+        return 'unknown tile brush ({}): {}'.format(self.category, self.color)
 
 
 def to_brush_color(rgba):
@@ -335,105 +340,526 @@ def process_ship_brushes(blockKey):
     return brushes
 
 
-def index_png_dungeon_part(src_dir, dst_dir, partpath, partfile, brushes):
-    try:
-        with Image.open(partpath / partfile) as dungeon_part:
-            _index_png_dungeon_part(
-                src_dir, dst_dir, partpath, partfile, brushes, dungeon_part
+def index_png_dungeon_part(
+    src_dir, dst_dir, partpath, partfile, brushes, rows=None, sink=None,
+    scan=None
+):
+    '''
+    Indexes a PNG dungeon part, writing the index to the given sink, by
+    default a CSV file.
+
+    If rows is a list, its contents are replaced by the rows written to
+    the index. It is left unchanged if the index is not rewritten because
+    it was just written with identical brushes.
+
+    scan is the part's scan, as returned by read_png_scan, if it was
+    already read; otherwise the part is read.
+    '''
+    table = compile_brushes(brushes)
+    # PNG dungeon parts may be referenced by multiple dungeons, with the
+    # same or different brushes. References to a part are indexed
+    # consecutively (see indexer.group_work_items), so keep the color scan
+    # of the last part indexed, and the fingerprint of the brushes last
+    # applied to it, so that a repeated reference need not decode the
+    # image again, nor rewrite its index if the brushes are unchanged.
+    last = caches.last_png_part
+    key = (dst_dir, partpath / partfile)
+    if last['key'] == key:
+        if last['fingerprint'] == table.fingerprint:
+            # The index was just written with identical brushes.
+            return
+        if last['scan'] is None:
+            write_streamed_png_index(
+                src_dir, dst_dir, partpath, partfile, table, rows, sink
             )
-    except FileNotFoundError as e:
-        # BETA - incorrect file case.
-        partfile = partfile.lower()
-        with Image.open(partpath / partfile) as dungeon_part:
-            _index_png_dungeon_part(
-                src_dir, dst_dir, partpath, partfile, brushes, dungeon_part
+        else:
+            write_png_index(
+                src_dir, dst_dir, partpath, partfile, table,
+                last['scan'], rows, sink
             )
+        last['fingerprint'] = table.fingerprint
+        return
+
+    if scan is None:
+        try:
+            scan = read_png_scan(partpath / partfile)
+        except FileNotFoundError as e:
+            # BETA - incorrect file case.
+            partfile = partfile.lower()
+            scan = read_png_scan(partpath / partfile)
+    if scan is None:
+        write_streamed_png_index(
+            src_dir, dst_dir, partpath, partfile, table, rows, sink
+        )
+    else:
+        write_png_index(
+            src_dir, dst_dir, partpath, partfile, table, scan, rows, sink
+        )
+    last.update(key=key, scan=scan, fingerprint=table.fingerprint)
+
+
+def read_png_scan(path):
+    '''
+    Reads and scans the PNG dungeon part at the given path. See
+    scan_png_dungeon_part.
+
+    Returns None, without decoding the part, if it is to be streamed
+    instead; see stream_min_pixels.
+    '''
+    with assets.open_file(path) as fh:
+        if is_streamed(fh): return None
+        fh.seek(0)
+        with Image.open(fh) as dungeon_part:
+            return scan_png_dungeon_part(dungeon_part)
+
+
+def is_streamed(fh):
+    '''
+    Returns whether the PNG dungeon part in the given file is to be
+    indexed by stream_png_records, reading its header.
+    '''
+    if stream_min_pixels is None: return False
+    try:
+        header = pngstream.read_header(fh)
+    except pngstream.PngFormatError as e:
+        # Left for PIL to report.
+        return False
+    return pngstream.is_supported(header)\
+        and header['width'] * header['height'] >= stream_min_pixels
+
+
+def png_pixel_keys(dungeon_part):
+    '''
+    Converts the pixels of a PNG dungeon part into a flat array of
+    integer keys, one per pixel in row-major order, without copying
+    the image through PIL's mode conversions.
+
+    For RGB and RGBA images, each key is the pixel's RGBA bytes viewed
+    as a native uint32. For palette images, each key is the pixel's
+    palette index.
+
+    Returns a tuple of the key array and an (n, 4) uint8 array giving
+    the RGBA color of every possible key value, or None for RGB and
+    RGBA images, whose keys are their own colors.
+    '''
+    width, height = dungeon_part.size
+    if dungeon_part.mode == 'P':
+        # Palette images are indexed as though they had been converted to
+        # RGB and given an opaque alpha channel.
+        palette = np.zeros((256, 4), dtype=np.uint8)
+        rgb = np.frombuffer(
+            bytes(dungeon_part.getpalette('RGB')), dtype=np.uint8
+        ).reshape(-1, 3)[:256]
+        palette[:len(rgb), :3] = rgb
+        palette[:, 3] = 255
+        keys = np.asarray(dungeon_part, dtype=np.uint8).reshape(-1)
+        return keys, palette
+    elif dungeon_part.mode == 'RGB':
+        rgba = np.empty((height, width, 4), dtype=np.uint8)
+        rgba[:, :, :3] = np.asarray(dungeon_part, dtype=np.uint8)
+        rgba[:, :, 3] = 255
+    elif dungeon_part.mode == 'RGBA':
+        rgba = np.ascontiguousarray(np.asarray(dungeon_part, dtype=np.uint8))
+    else:
+        print('ERROR: unknown color format: mode: {}'.format(
+            dungeon_part.mode))
+        sys.exit(1)
+    return rgba.view(np.uint32).reshape(-1), None
+
+
+def scan_png_dungeon_part(dungeon_part):
+    '''
+    Scans all pixels of a PNG dungeon part in a single vectorized pass.
+
+    Returns a dict containing the part's width, the RGBA color of each
+    distinct pixel value as an (n, 4) uint8 array, the flat index of the
+    first pixel of each color, and the per-pixel index into the color
+    array.
+    '''
+    with stats.timer('png decode'):
+        keys, palette = png_pixel_keys(dungeon_part)
+    stats.count('pixels', keys.size)
+    start = time.perf_counter()
+    unique_keys, first, inverse = np.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    if palette is None:
+        rgba = unique_keys.astype(np.uint32).view(np.uint8).reshape(-1, 4)
+    else:
+        rgba = palette[unique_keys]
+        # Distinct palette indices may share a color, which must then be
+        # treated as a single color.
+        packed = np.ascontiguousarray(rgba).view(np.uint32).reshape(-1)
+        merged, merged_inverse = np.unique(packed, return_inverse=True)
+        if len(merged) != len(packed):
+            merged_inverse = merged_inverse.reshape(-1)
+            merged_first = np.full(len(merged), len(keys), dtype=first.dtype)
+            np.minimum.at(merged_first, merged_inverse, first)
+            rgba = merged.view(np.uint8).reshape(-1, 4)
+            first = merged_first
+            inverse = merged_inverse[inverse]
+    stats.add_time('png scan', time.perf_counter() - start)
+    return {
+        'width': dungeon_part.size[0],
+        'rgba': rgba,
+        'first': first,
+        # Parts rarely have more than a few hundred colors, so store the
+        # per-pixel color index compactly.
+        'inverse': inverse.astype(np.min_scalar_type(max(len(rgba) - 1, 0)))
+    }
+
+
+def png_tile_rows(tile, color, x, y):
+    if tile['type'] == 'material':
+        rows = []
+        if 'back' in tile:
+            rows.append([
+                'back', color, '', '', '', '', '',
+                'material', tile['back']
+            ])
+        if 'front' in tile:
+            rows.append([
+                'front', color, '', '', '', '', '',
+                'material', tile['front']
+            ])
+        if 'liquid' in tile:
+            rows.append([
+                'front', color, '', '', '', '', '',
+                'liquid', tile['liquid']
+            ])
+        if 'object' in tile:
+            obj = [
+                'objects', color, x, y, '', '', '',
+                'object', tile['object']
+            ]
+            if tile.get('treasurePools'):
+                obj.append(tile['treasurePools'])
+            rows.append(obj)
+        return rows
+    elif tile['type'] == 'monster':
+        return [[
+            'monsters & npcs', color, x, y, '', '', '',
+            'monster', tile['typeName']
+        ]]
+    elif tile['type'] == 'npc':
+        return [[
+            'monsters & npcs', color, x, y, '', '', '',
+            'npc', tile['typeName'],
+            'species={}'.format(tile['species'])
+        ]]
+    elif tile['type'] == 'object':
+        obj = [
+            'objects', color, x, y, '', '', '',
+            'object', tile['object']
+        ]
+        if tile.get('treasurePools'):
+            obj.append(tile['treasurePools'])
+        return [obj]
+    elif tile['type'] == 'stagehand':
+        if tile['typeName'] == 'questlocation':
+            return [[
+                'mods', color, x, y, '', '', '',
+                'stagehand', 'questlocation',
+                'location={}'.format(tile['location'])
+            ]]
+        elif tile['typeName'] == 'radiomessage':
+            return [[
+                'mods', color, x, y, '', '', '',
+                'stagehand', 'radiomessage',
+                'message={}'.format(tile['radioMessage'])
+            ]]
+    return []
+
+
+# The codes used for the record field of brushes in BrushTable.
+record_codes = {'never': 0, 'once': 1, 'always': 2}
+
+# Stands in for the coordinates of index rows when compiling brushes.
+coordinate_placeholder = object()
+
+
+class BrushTable:
+    '''
+    A compiled form of the brushes returned by process_brushes or
+    process_ship_brushes, in which each brush is identified by a small
+    integer and its index rows are prepared in advance.
+
+    * keys: the sorted colors of the brushes, packed in the same way as
+      the keys returned by png_pixel_keys for RGBA images.
+    * ids: the brush id of each key.
+    * colors: the color string of each brush id.
+    * records: the record code of each brush id, see record_codes,
+      followed by 'never', which is therefore also the code of the id -1
+      of colors without a brush.
+    * templates: the index records of each brush id. Records with
+      coordinates are stored as a (prefix, suffix) pair of tuples of the
+      fields surrounding the coordinates; other records are stored as
+      is.
+    * fingerprint: a stable hash of the brushes.
+    '''
+    def __init__(self, brushes):
+        self.colors = sorted(brushes)
+        packed = np.frombuffer(
+            b''.join(bytes.fromhex(color[1:]) for color in self.colors),
+            dtype=np.uint32
+        )
+        order = np.argsort(packed, kind='stable')
+        self.keys = packed[order]
+        self.ids = order.astype(np.int64)
+        self.records = np.array(
+            [record_codes[brushes[color]['record']] for color in self.colors]
+            + [record_codes['never']],
+            dtype=np.int8
+        )
+        self.templates = []
+        for color in self.colors:
+            templates = []
+            for row in png_tile_rows(
+                brushes[color], color,
+                coordinate_placeholder, coordinate_placeholder
+            ):
+                record = IndexRecord.from_row(row)
+                if record.x is coordinate_placeholder:
+                    templates.append((record[:2], record[4:]))
+                else:
+                    templates.append(record)
+            self.templates.append(templates)
+        self.fingerprint = hashlib.sha256(
+            json.dumps(brushes, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
+    def lookup(self, rgba):
+        '''
+        Returns the brush ids of an (n, 4) uint8 array of RGBA colors,
+        with -1 for colors without a brush.
+        '''
+        packed = np.ascontiguousarray(rgba, dtype=np.uint8)\
+            .view(np.uint32).reshape(-1)
+        if not len(self.keys):
+            return np.full(len(packed), -1, dtype=np.int64)
+        idx = np.searchsorted(self.keys, packed)
+        idx[idx == len(self.keys)] = 0
+        return np.where(self.keys[idx] == packed, self.ids[idx], -1)
+
+
+def compile_brushes(brushes):
+    '''
+    Returns the BrushTable of the given brushes. Brushes that are already
+    compiled are returned unchanged.
+    '''
+    if isinstance(brushes, BrushTable):
+        return brushes
+    return BrushTable(brushes)
+
+
+def png_scan_records(scan, table):
+    '''
+    Applies a BrushTable to the result of scan_png_dungeon_part, yielding
+    an IndexRecord for each index row, in the row-major order of the
+    pixels that produce them.
+    Brushes recorded 'once' produce rows only at the first pixel of
+    their color; brushes recorded 'always' produce rows at every pixel.
+    '''
+    brush_ids = table.lookup(scan['rgba'])
+
+    for i in np.flatnonzero(brush_ids < 0)[
+        np.argsort(scan['first'][brush_ids < 0], kind='stable')
+    ].tolist():
+        print('WARNING: unknown tile #{}'.format(bytes(scan['rgba'][i]).hex()))
+
+    records = table.records[brush_ids]
+    positions = np.concatenate([
+        scan['first'][records == record_codes['once']],
+        np.flatnonzero(
+            (records == record_codes['always'])[scan['inverse']]
+        )
+    ])
+    positions.sort()
+
+    width = scan['width']
+    templates = table.templates
+    # IndexRecord._make, without its length check, which matters for
+    # parts with many recorded pixels.
+    new_tuple = tuple.__new__
+    pixel_brush_ids = brush_ids[scan['inverse'][positions]].tolist()
+    for position, brush_id in zip(positions.tolist(), pixel_brush_ids):
+        y, x = divmod(position, width)
+        for template in templates[brush_id]:
+            if isinstance(template, IndexRecord):
+                yield template
+            else:
+                yield new_tuple(
+                    IndexRecord, template[0] + (x, y) + template[1]
+                )
+
+
+def stream_png_records(fh, table, grid=None):
+    '''
+    Indexes a PNG dungeon part as it is decoded, one scanline at a time,
+    yielding the same IndexRecords as png_scan_records, in the same
+    order, and printing the same warnings.
+
+    fh is a binary file object positioned at the start of the image. Only
+    a few scanlines, and the colors seen so far, are kept in memory. If a
+    grids.GridWriter is given, the brush id of each pixel is written to
+    it as each scanline is decoded; see png_grid.
+    '''
+    header = pngstream.read_header(fh)
+    width = header['width']
+    cells = None
+    if grid is not None:
+        cells = grid.open(
+            (header['height'], width), grids.brush_id_dtype(len(table.colors))
+        )
+    if header['color_type'] == 3:
+        # As in png_pixel_keys.
+        palette = np.zeros((256, 4), dtype=np.uint8)
+        rgb = np.frombuffer(
+            header['palette'] or b'', dtype=np.uint8
+        ).reshape(-1, 3)[:256]
+        palette[:len(rgb), :3] = rgb
+        palette[:, 3] = 255
+        palette_keys = palette.view(np.uint32).reshape(-1)
+    else:
+        rgba = np.empty((width, 4), dtype=np.uint8)
+        rgba[:, 3] = 255
+    once = record_codes['once']
+    always = record_codes['always']
+    templates = table.templates
+    new_tuple = tuple.__new__
+    # The brush id of each color seen so far, or -1 if it has none.
+    brush_ids = {}
+    for y, line in enumerate(pngstream.iter_scanlines(fh, header)):
+        pixels = pngstream.scanline_pixels(line, header)
+        if header['color_type'] == 3:
+            keys = palette_keys[pixels]
+        else:
+            rgba[:, :pixels.shape[1]] = pixels
+            keys = rgba.view(np.uint32).reshape(-1)
+        unique_keys, first, inverse = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        unique_list = unique_keys.tolist()
+        new = [i for i, key in enumerate(unique_list) if key not in brush_ids]
+        positions = []
+        if new:
+            # Colors are first seen in the order of their first pixels.
+            new = np.array(new)[np.argsort(first[new], kind='stable')]
+            new_rgba = unique_keys[new].astype(np.uint32)\
+                .view(np.uint8).reshape(-1, 4)
+            new_ids = table.lookup(new_rgba)
+            for i, brush_id, color in zip(
+                new.tolist(), new_ids.tolist(), new_rgba
+            ):
+                brush_ids[unique_list[i]] = brush_id
+                if brush_id < 0:
+                    print('WARNING: unknown tile #{}'.format(
+                        bytes(color).hex()))
+                elif table.records[brush_id] == once:
+                    positions.append(first[i])
+        row_ids = np.array(
+            [brush_ids[key] for key in unique_list], dtype=np.int64
+        )
+        if cells is not None:
+            cells[y] = row_ids[inverse]
+        records = table.records[row_ids]
+        recorded = records == always
+        if positions or recorded.any():
+            positions = np.concatenate([
+                np.array(positions, dtype=np.int64),
+                np.flatnonzero(recorded[inverse])
+            ])
+            positions.sort()
+            for x, brush_id in zip(
+                positions.tolist(), row_ids[inverse[positions]].tolist()
+            ):
+                for template in templates[brush_id]:
+                    if isinstance(template, IndexRecord):
+                        yield template
+                    else:
+                        yield new_tuple(
+                            IndexRecord, template[0] + (x, y) + template[1]
+                        )
+    stats.count('pixels', width * header['height'])
+    stats.count('png parts streamed')
+
+
+def write_streamed_png_index(
+    src_dir, dst_dir, partpath, partfile, table, rows=None, sink=None
+):
+    sink = sink or CsvSink()
+    grid = grids.part_grid(
+        src_dir, dst_dir, partpath, partfile, png_grid_legend(table)
+    )
+    with stats.timer('png stream'), \
+         assets.open_file(partpath / partfile) as fh, \
+         sink.open_part(src_dir, dst_dir, partpath, partfile) as csvout, \
+         grid or nullcontext():
+        if rows is not None:
+            rows.clear()
+            csvout = RowRecorder(csvout, rows)
+        for record in stream_png_records(fh, table, grid):
+            csvout.writerow(record.row())
 
 
 def _index_png_dungeon_part(
     src_dir, dst_dir, partpath, partfile, brushes, dungeon_part
 ):
-    if dungeon_part.mode == 'P':
-        dungeon_part = dungeon_part.convert('RGB')
-    if dungeon_part.mode == 'RGB':
-        dungeon_part.putalpha(255)
+    write_png_index(
+        src_dir, dst_dir, partpath, partfile, compile_brushes(brushes),
+        scan_png_dungeon_part(dungeon_part)
+    )
 
-    width, height = dungeon_part.size
 
-    dst_path = make_dst_dir(src_dir, dst_dir, partpath)
-    with open(dst_path / "{}.csv".format(partfile), 'w') as fh:
-        csvout = csv.writer(fh, lineterminator='\n')
-
-        seen_colors = set()
-        seen_error_colors = set()
-        for y in range(height):
-            for x in range(width):
-                color = '#' + bytearray(dungeon_part.getpixel((x, y))).hex()
-                if len(color) != 9:
-                    print('ERROR: unknown color format: {} mode: {}'.format(
-                        color, dungeon_part.mode))
-                    sys.exit(1)
-                tile = brushes.get(color)
-                if not tile:
-                    if color not in seen_error_colors:
-                        print('WARNING: unknown tile {}'.format(color))
-                        seen_error_colors.add(color)
-                    continue
-                if tile['type'] == 'material':
-                    rows = []
-                    if 'back' in tile:
-                        rows.append([
-                            'back', color, '', '', '', '', '',
-                            'material', tile['back']
-                        ])
-                    if 'front' in tile:
-                        rows.append([
-                            'front', color, '', '', '', '', '',
-                            'material', tile['front']
-                        ])
-                    if 'liquid' in tile:
-                        rows.append([
-                            'front', color, '', '', '', '', '',
-                            'liquid', tile['liquid']
-                        ])
-                    if 'object' in tile:
-                        obj = [
-                            'objects', color, x, y, '', '', '',
-                            'object', tile['object']
-                        ]
-                        if tile.get('treasurePools'):
-                            obj.append(tile['treasurePools'])
-                        rows.append(obj)
-                    png_maybe_output(tile, seen_colors, csvout, rows)
-                elif tile['type'] == 'monster':
-                    png_maybe_output(tile, seen_colors, csvout, [[
-                        'monsters & npcs', color, x, y, '', '', '',
-                        'monster', tile['typeName']
-                    ]])
-                elif tile['type'] == 'npc':
-                    png_maybe_output(tile, seen_colors, csvout, [[
-                        'monsters & npcs', color, x, y, '', '', '',
-                        'npc', tile['typeName'],
-                        'species={}'.format(tile['species'])
-                    ]])
-                elif tile['type'] == 'object':
-                    obj = [
-                        'objects', color, x, y, '', '', '',
-                        'object', tile['object']
-                    ]
-                    if tile.get('treasurePools'):
-                        obj.append(tile['treasurePools'])
-                    png_maybe_output(tile, seen_colors, csvout, [obj])
-                elif tile['type'] == 'stagehand':
-                    if tile['typeName'] == 'questlocation':
-                        png_maybe_output(tile, seen_colors, csvout, [[
-                            'mods', color, x, y, '', '', '',
-                            'stagehand', 'questlocation',
-                            'location={}'.format(tile['location'])
-                        ]])
-                    elif tile['typeName'] == 'radiomessage':
-                        png_maybe_output(tile, seen_colors, csvout, [[
-                            'mods', color, x, y, '', '', '',
-                            'stagehand', 'radiomessage',
-                            'message={}'.format(tile['radioMessage'])
-                        ]])
+def write_png_index(
+    src_dir, dst_dir, partpath, partfile, table, scan, rows=None, sink=None
+):
+    sink = sink or CsvSink()
+    with stats.timer('png rows'), \
+         sink.open_part(src_dir, dst_dir, partpath, partfile) as csvout:
+        if rows is not None:
+            rows.clear()
+            csvout = RowRecorder(csvout, rows)
+        for record in png_scan_records(scan, table):
+            csvout.writerow(record.row())
+    grid = grids.part_grid(
+        src_dir, dst_dir, partpath, partfile, png_grid_legend(table)
+    )
+    if grid is not None:
+        with stats.timer('png grid'), grid:
+            grid.save(png_grid(scan, table))
+
+
+def png_grid_legend(table):
+    return {'type': 'png', 'colors': table.colors}
+
+
+def png_grid(scan, table):
+    '''
+    Returns the grid of a PNG dungeon part from the result of
+    scan_png_dungeon_part: a (height, width) array of the brush id of
+    each pixel, an index into the colors of the BrushTable, or -1 for
+    pixels without a brush.
+    '''
+    brush_ids = table.lookup(scan['rgba'])\
+        .astype(grids.brush_id_dtype(len(table.colors)))
+    return brush_ids[scan['inverse']].reshape(-1, scan['width'])
+
+
+def iter_png_records(source, brushes):
+    '''
+    Indexes a PNG dungeon part without writing an index, lazily yielding
+    an IndexRecord for each index row.
+
+    source is the path of the part, its contents as bytes, or a binary
+    file object. brushes are those returned by process_brushes or
+    process_ship_brushes, or a BrushTable compiled from them.
+    '''
+    table = compile_brushes(brushes)
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as dungeon_part:
+        scan = scan_png_dungeon_part(dungeon_part)
+    yield from png_scan_records(scan, table)
@@ -0,0 +1,200 @@
+from PIL import Image
+
+import io
+import numpy as np
+import struct
+import zlib
+
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+# The number of channels of each supported color type: RGB, palette and
+# RGBA.
+color_type_channels = {2: 3, 3: 1, 6: 4}
+
+# The color types of 8-bit grayscale, RGB and RGBA images, keyed by their
+# number of bytes per pixel, as whose scanlines those of any supported
+# image are unfiltered; see unfilter_scanlines.
+bpp_color_types = {1: 0, 3: 2, 4: 6}
+
+# The number of bytes of compressed image data read at a time, and the
+# number of scanlines decompressed and unfiltered at a time.
+read_size = 1 << 16
+decompress_lines = 16
+
+
+class PngFormatError(Exception):
+    '''
+    Raised when a file is not a PNG image, or its image data is invalid.
+    '''
+    pass
+
+
+def read_chunk_header(fh):
+    data = fh.read(8)
+    if len(data) < 8:
+        raise PngFormatError('truncated file')
+    length, chunk_type = struct.unpack('>I4s', data)
+    return length, chunk_type
+
+
+def read_header(fh):
+    '''
+    Reads the chunks of a PNG image preceding its image data, leaving the
+    file positioned in the first IDAT chunk.
+
+    Returns a dict of the image's width, height, bit_depth, color_type
+    and interlace method from its IHDR chunk, its palette as bytes of RGB
+    triples, or None, and the length of the first IDAT chunk, idat.
+    '''
+    if fh.read(8) != png_signature:
+        raise PngFormatError('not a PNG image')
+    header = {'palette': None}
+    while True:
+        length, chunk_type = read_chunk_header(fh)
+        if chunk_type == b'IDAT':
+            if 'width' not in header:
+                raise PngFormatError('IHDR not found')
+            header['idat'] = length
+            return header
+        if chunk_type == b'IEND':
+            raise PngFormatError('image data not found')
+        data = fh.read(length)
+        fh.read(4)
+        if len(data) < length:
+            raise PngFormatError('truncated file')
+        if chunk_type == b'IHDR':
+            (header['width'], header['height'], header['bit_depth'],
+             header['color_type'], compression, filter_method,
+             header['interlace']) = struct.unpack('>IIBBBBB', data[:13])
+        elif chunk_type == b'PLTE':
+            header['palette'] = data
+
+
+def is_supported(header):
+    '''
+    Returns whether iter_scanlines can decode an image: 8-bit RGB or RGBA,
+    or palette images of any bit depth, without interlacing.
+    '''
+    if header['interlace'] != 0: return False
+    if header['color_type'] == 3:
+        return header['bit_depth'] in (1, 2, 4, 8)
+    return header['color_type'] in color_type_channels\
+        and header['bit_depth'] == 8
+
+
+def iter_idat(fh, length):
+    '''
+    Yields the contents of the consecutive IDAT chunks of a PNG image in
+    pieces of at most read_size bytes, starting in the first, of the
+    given length.
+    '''
+    while True:
+        while length > 0:
+            data = fh.read(min(length, read_size))
+            if not data:
+                raise PngFormatError('truncated file')
+            length -= len(data)
+            yield data
+        fh.read(4)
+        length, chunk_type = read_chunk_header(fh)
+        if chunk_type != b'IDAT': return
+
+
+def make_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data\
+        + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def unfilter_scanlines(data, count, prior, bpp):
+    '''
+    Reverses the filters of consecutive scanlines, given as bytes with
+    their filter type bytes, and the previous scanline once unfiltered,
+    or zeros for the first. bpp is the number of bytes per complete
+    pixel, rounded up to 1. Returns the list of the scanlines as bytes.
+
+    The filters are reversed by PIL, in C, by decoding the scanlines as
+    those of an image of 8-bit pixels of bpp bytes, whose unfiltered
+    first scanline is the previous one. The Average and Paeth filters
+    cannot otherwise be reversed a scanline at a time without a loop over
+    its bytes.
+    '''
+    length = len(prior)
+    stride = length + 1
+    for filter_type in data[::stride]:
+        if filter_type > 4:
+            raise PngFormatError(
+                'unknown filter type {}'.format(filter_type)
+            )
+    if not length: return [b''] * count
+    image = png_signature + make_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', length // bpp, count + 1, 8, bpp_color_types[bpp],
+        0, 0, 0
+    )) + make_chunk(
+        b'IDAT', zlib.compress(b'\0' + bytes(prior) + bytes(data), 0)
+    ) + make_chunk(b'IEND', b'')
+    with Image.open(io.BytesIO(image)) as decoded:
+        pixels = decoded.tobytes()
+    return [
+        pixels[i:i + length] for i in range(length, len(pixels), length)
+    ]
+
+
+def iter_scanlines(fh, header):
+    '''
+    Decompresses and unfilters the image data of a PNG image one scanline
+    at a time, given the header read from the file by read_header.
+
+    Yields each scanline as bytes, without its filter type byte. Only a
+    few compressed scanlines, and at most decompress_lines decompressed
+    ones, are kept in memory.
+    '''
+    channels = color_type_channels[header['color_type']]
+    bits = channels * header['bit_depth']
+    stride = (header['width'] * bits + 7) // 8 + 1
+    bpp = max(1, bits // 8)
+    remaining = header['height']
+    prior = bytes(stride - 1)
+    decompressor = zlib.decompressobj()
+    pending = bytearray()
+    max_length = stride * decompress_lines
+    for data in iter_idat(fh, header['idat']):
+        while remaining:
+            try:
+                output = decompressor.decompress(data, max_length)
+            except zlib.error as e:
+                raise PngFormatError('invalid image data: {}'.format(e))
+            data = decompressor.unconsumed_tail
+            pending += output
+            count = min(remaining, len(pending) // stride)
+            if count:
+                lines = unfilter_scanlines(
+                    pending[:count * stride], count, prior, bpp
+                )
+                del pending[:count * stride]
+                remaining -= count
+                prior = lines[-1]
+                yield from lines
+            # Output may remain buffered in the decompressor only if it
+            # was cut short.
+            if not data and len(output) < max_length: break
+        if not remaining: return
+    if remaining:
+        raise PngFormatError('truncated image data')
+
+
+def scanline_pixels(line, header):
+    '''
+    Returns the pixels of a scanline returned by iter_scanlines: a
+    (width, channels) uint8 array for RGB and RGBA images, or a uint8
+    array of palette indices for palette images.
+    '''
+    width = header['width']
+    pixels = np.frombuffer(line, dtype=np.uint8)
+    if header['color_type'] != 3:
+        return pixels.reshape(width, -1)
+    bit_depth = header['bit_depth']
+    if bit_depth == 8:
+        return pixels[:width]
+    weights = (1 << np.arange(bit_depth - 1, -1, -1)).astype(np.uint8)
+    return np.unpackbits(pixels).reshape(-1, bit_depth)[:width] @ weights
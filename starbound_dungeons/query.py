@@ -0,0 +1,73 @@
+from .database import IndexDatabase
+from pathlib import Path
+
+import argparse
+import csv
+import sys
+
+
+def parse_modifier(text):
+    '''
+    Parses a --modifier argument, e.g., "treasurePools=basicTreasure",
+    into a (key, value) pair. An empty value matches any value.
+    '''
+    key, _, value = text.partition('=')
+    if not key:
+        raise argparse.ArgumentTypeError(
+            'invalid modifier: {}'.format(text)
+        )
+    return key, value or None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Search an SQLite index of Starbound dungeons."
+    )
+    parser.add_argument(
+        '-i', '--database', required=True,
+        help='the SQLite database written by pystarbound-dungeons-indexer'
+    )
+    parser.add_argument(
+        '--layer',
+        help='match only entities in the given layer'
+    )
+    parser.add_argument(
+        '--modifier', action='append', default=[], type=parse_modifier,
+        metavar='KEY=VALUE',
+        help='match only entities with the given modifier; may be given '
+             'more than once. An empty VALUE matches any value'
+    )
+    parser.add_argument(
+        '--name',
+        help='match only entities with the given name'
+    )
+    parser.add_argument(
+        '--part',
+        help='match only parts whose path begins with the given prefix'
+    )
+    parser.add_argument(
+        '--prefix',
+        help='match only entities whose name begins with the given prefix'
+    )
+    parser.add_argument(
+        '--type',
+        help='match only entities of the given type, e.g., object'
+    )
+    args = parser.parse_args()
+
+    if not Path(args.database).is_file():
+        print('ERROR: database not found: {}'.format(args.database),
+              file=sys.stderr)
+        sys.exit(1)
+
+    with IndexDatabase(args.database) as database:
+        csvout = csv.writer(sys.stdout, lineterminator='\n')
+        for row in database.query(
+            args.name, args.prefix, args.type, args.layer, args.modifier,
+            args.part
+        ):
+            csvout.writerow(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+from . import stats
+from .common import get_dst_dir, make_dst_dir
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+
+
+# The number of rows buffered by an index writer before they are written
+# to its file in one batch.
+row_batch_size = 4096
+
+# The buffer size of index files, and the number of bytes buffered by the
+# JSON Lines stream before they are written in one batch.
+write_buffer_size = 1 << 20
+
+
+def link_or_copy(src, dst):
+    '''
+    Hard-links the file src to dst, or copies it where hard links are not
+    supported, such as across file systems.
+    '''
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        shutil.copyfile(src, dst)
+
+
+def rows_digest(rows):
+    '''
+    Returns the SHA-256 hash of the CSV text of the given index rows, as
+    a hex string, which is the digest of an index with these rows in any
+    format; see CsvSink.digest.
+    '''
+    text = io.StringIO()
+    csv.writer(text, lineterminator='\n').writerows(rows)
+    return hashlib.sha256(text.getvalue().encode('utf-8')).hexdigest()
+
+
+class IndexWriter:
+    '''
+    Writes the rows of one index to a file object, buffering them and
+    writing them in batches.
+    '''
+    def __init__(self, fh):
+        self.fh = fh
+        self.csvout = csv.writer(fh, lineterminator='\n')
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writerow(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= row_batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows: self.writerow(row)
+
+    def flush(self):
+        if self.pending:
+            with stats.timer('write index'):
+                self.csvout.writerows(self.pending)
+            stats.count('rows', len(self.pending))
+            self.pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.fh.close()
+
+
+class NullWriter:
+    '''
+    Discards the rows of an index, counting them. Used where the rows are
+    collected and written elsewhere.
+    '''
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stats.count('rows', self.count)
+
+    def writerow(self, row):
+        self.count += 1
+
+    def writerows(self, rows):
+        for row in rows: self.writerow(row)
+
+
+class CsvSink:
+    '''
+    Writes one CSV index per dungeon part, under the same folder
+    structure as the parts, optionally compressed with gzip.
+    '''
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.name = 'csv.gz' if compress else 'csv'
+        self.extension = '.csv.gz' if compress else '.csv'
+        # Whether the rows of each index must be returned to the main
+        # process for write_part.
+        self.collects_rows = False
+
+    def index_path(self, src_dir, dst_dir, partpath, partfile):
+        return get_dst_dir(src_dir, dst_dir, partpath)\
+            / '{}{}'.format(partfile, self.extension)
+
+    def part_key(self, output_key):
+        '''
+        Returns the path of the part, relative to the source folder, of
+        the index with the given path relative to the destination folder.
+        '''
+        return output_key[:-len(self.extension)]
+
+    def open_part(self, src_dir, dst_dir, partpath, partfile):
+        '''
+        Returns an IndexWriter for the index of the given part.
+        '''
+        dst_path = make_dst_dir(src_dir, dst_dir, partpath)
+        path = dst_path / '{}{}'.format(partfile, self.extension)
+        # The index may be a hard link to an entry of the result store,
+        # which must not be overwritten.
+        self.remove(path)
+        if self.compress:
+            fh = io.TextIOWrapper(
+                io.BufferedWriter(
+                    gzip.GzipFile(path, 'wb', compresslevel=6, mtime=0),
+                    write_buffer_size
+                ),
+                newline=''
+            )
+        else:
+            fh = open(path, 'w', newline='', buffering=write_buffer_size)
+        return IndexWriter(fh)
+
+    def write_part(self, part, rows):
+        pass
+
+    def start_over(self):
+        pass
+
+    def store_index(self, path, stored_path):
+        '''
+        Saves the index at the given path to stored_path as an uncompressed
+        CSV file, for store.ResultStore, by hard-linking it if possible.
+        '''
+        if self.compress:
+            with gzip.open(path, 'rb') as src, open(stored_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, write_buffer_size)
+        else:
+            link_or_copy(path, stored_path)
+
+    def restore_index(self, stored_path, src_dir, dst_dir, partpath, partfile):
+        '''
+        Writes the index of the given part from a CSV file saved by
+        store_index, by hard-linking it if possible, as open_part would.
+        '''
+        with open(stored_path, 'rb') as src:
+            dst_path = make_dst_dir(src_dir, dst_dir, partpath)
+            path = dst_path / '{}{}'.format(partfile, self.extension)
+            self.remove(path)
+            if self.compress:
+                with gzip.GzipFile(path, 'wb', compresslevel=6, mtime=0) \
+                     as dst:
+                    shutil.copyfileobj(src, dst, write_buffer_size)
+            else:
+                link_or_copy(stored_path, path)
+
+    def digest(self, path, rows=None):
+        '''
+        Returns the SHA-256 hash of the CSV text of the index at the given
+        path, as a hex string, or None if it does not exist. Indices with
+        the same rows have the same digest whether compressed or not.
+        '''
+        try:
+            if self.compress:
+                fh = gzip.open(path, 'rb')
+            else:
+                fh = open(path, 'rb')
+        except FileNotFoundError as e:
+            return None
+        h = hashlib.sha256()
+        with fh:
+            for chunk in iter(lambda: fh.read(write_buffer_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def remove(self, path):
+        '''
+        Deletes the index at the given path. Returns False if it did not
+        exist.
+        '''
+        try:
+            path.unlink()
+        except FileNotFoundError as e:
+            return False
+        return True
+
+    def read_rows(self, path):
+        '''
+        Returns the rows of the index at the given path, or None if it
+        does not exist.
+        '''
+        try:
+            if self.compress:
+                fh = gzip.open(path, 'rt', newline='')
+            else:
+                fh = open(path, newline='')
+        except FileNotFoundError as e:
+            return None
+        with fh:
+            return list(csv.reader(fh))
+
+    def close(self, live=None):
+        pass
+
+
+class JsonLinesSink:
+    '''
+    Appends the indices of all dungeon parts to a single JSON Lines
+    stream, index.jsonl, in the destination folder. Each line is an
+    object giving the path of a part relative to the source folder and
+    its rows; a later line for the same part supersedes earlier ones,
+    and rows of null mark a part that has been deleted.
+
+    The stream is written anew by runs which index all parts (see
+    start_over), and compacted when closed once its superseded lines
+    outnumber those of the parts it holds.
+
+    The stream is written only by the main process, from the rows
+    collected by the workers.
+    '''
+    name = 'jsonl'
+    extension = ''
+    collects_rows = True
+    stream_name = 'index.jsonl'
+
+    def __init__(self, dst_dir):
+        self.path = dst_dir / self.stream_name
+        self.fh = None
+        self.pending = []
+        self.pending_size = 0
+        self.parts = None
+        # The number of lines of the stream, once known.
+        self.lines = None
+        # Whether the stream is being written anew, to write_path.
+        self.rewriting = False
+
+    def __getstate__(self):
+        # Workers need only the path; they never write the stream.
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'].parent)
+
+    @property
+    def write_path(self):
+        if self.rewriting:
+            return self.path.with_name(self.stream_name + '.tmp')
+        return self.path
+
+    def index_path(self, src_dir, dst_dir, partpath, partfile):
+        # The path does not exist; it identifies the part in the
+        # manifest.
+        return get_dst_dir(src_dir, dst_dir, partpath) / partfile
+
+    def part_key(self, output_key):
+        return output_key
+
+    def open_part(self, src_dir, dst_dir, partpath, partfile):
+        return NullWriter()
+
+    def start_over(self):
+        '''
+        Writes the stream anew, with only the parts written from now on,
+        replacing the existing stream when closed.
+        '''
+        self.close()
+        self.rewriting = True
+        self.parts = None
+        self.lines = 0
+
+    def write_part(self, part, rows):
+        if rows is None and self.rewriting:
+            # The part is absent from the new stream.
+            if self.parts is not None: self.parts.pop(part, None)
+            return
+        if self.parts is not None:
+            # Keeps the parts read by read_rows current.
+            self.parts[part] = rows
+        line = json.dumps(
+            {'part': part, 'rows': rows}, separators=(',', ':')
+        ) + '\n'
+        self.pending.append(line)
+        self.pending_size += len(line)
+        if self.lines is not None: self.lines += 1
+        if self.pending_size >= write_buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending\
+           and not (self.rewriting and self.fh is None):
+            # A stream written anew is created even if empty.
+            return
+        with stats.timer('write index'):
+            if self.fh is None:
+                self.fh = open(
+                    self.write_path, 'w' if self.rewriting else 'a',
+                    encoding='utf-8'
+                )
+            self.fh.write(''.join(self.pending))
+            self.fh.flush()
+        self.pending = []
+        self.pending_size = 0
+
+    def digest(self, path, rows=None):
+        # The stream is written by the main process, so the digest is
+        # that of the rows collected.
+        if rows is None: return None
+        return rows_digest(rows)
+
+    def exists(self, path):
+        return self.path.is_file()
+
+    def remove(self, path):
+        self.write_part(self.part_key_of(path), None)
+        return True
+
+    def part_key_of(self, path):
+        return os.path.relpath(path, self.path.parent).replace(os.sep, '/')
+
+    def load(self):
+        '''
+        Returns the rows of the parts of the stream, keyed by part path,
+        None for deleted parts, reading the stream on first use.
+        '''
+        if self.parts is None:
+            self.flush()
+            self.parts = {}
+            self.lines = 0
+            try:
+                with open(self.write_path, encoding='utf-8') as fh:
+                    for line in fh:
+                        record = json.loads(line)
+                        self.parts[record['part']] = record['rows']
+                        self.lines += 1
+            except FileNotFoundError as e:
+                pass
+        return self.parts
+
+    def read_rows(self, path):
+        return self.load().get(self.part_key_of(path))
+
+    def count_lines(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                return sum(
+                    chunk.count(b'\n')
+                    for chunk in iter(lambda: fh.read(write_buffer_size), b'')
+                )
+        except FileNotFoundError as e:
+            return 0
+
+    def delete(self):
+        '''
+        Deletes the stream.
+        '''
+        self.close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError as e:
+            pass
+        self.parts = {}
+        self.lines = 0
+
+    def compact(self):
+        '''
+        Writes the stream anew with only the last line of each part it
+        holds, or deletes it if it holds none.
+        '''
+        parts = {
+            part: rows for part, rows in self.load().items()
+            if rows is not None
+        }
+        if not parts:
+            self.delete()
+            return
+        self.start_over()
+        with stats.timer('compact index'):
+            for part, rows in parts.items(): self.write_part(part, rows)
+            self.close()
+        self.parts = parts
+
+    def close(self, live=None):
+        '''
+        Writes the pending lines of the stream, and replaces the stream by
+        the one written anew, if it was. If given, live is the number of
+        parts the stream holds, according to the manifest; the stream is
+        compacted if more of its lines are superseded.
+        '''
+        self.flush()
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if self.rewriting:
+            os.replace(self.write_path, self.path)
+            self.rewriting = False
+        elif live == 0:
+            self.delete()
+        elif live is not None:
+            if self.lines is None: self.lines = self.count_lines()
+            if self.lines - live > live: self.compact()
+
+
+output_formats = ['csv', 'csv.gz', 'jsonl']
+
+
+def make_sink(output_format, dst_dir):
+    '''
+    Returns the sink writing indices in the given format, one of
+    output_formats, to the given destination folder.
+    '''
+    if output_format == 'jsonl':
+        return JsonLinesSink(dst_dir)
+    return CsvSink(compress=(output_format == 'csv.gz'))
@@ -0,0 +1,291 @@
+from . import stats
+from .diff import Destination
+
+from collections import namedtuple
+from pathlib import Path
+
+import json
+import os
+
+
+# Whether to write the spatial indices of parts; see SpatialBuilder.
+enabled = False
+
+# The suffix of the spatial index of a part, appended to its part path in
+# the destination folder.
+spatial_suffix = '.spatial.json'
+
+# Bump this whenever the layout of the spatial index changes.
+spatial_version = 3
+
+# The width and height, in tiles, of the buckets of the spatial index.
+bucket_size = 16
+
+
+class SpatialPoint(namedtuple('SpatialPoint', [
+    'x', 'y', 'entity_type', 'entity_name', 'row'
+])):
+    '''
+    An entity with coordinates found in a spatial index, with the position
+    of its row in the index of its part, from 0.
+    '''
+    __slots__ = ()
+
+
+def row_point(row, number):
+    '''
+    Returns the point of an index row with coordinates, such as an
+    object, monster, NPC, stagehand or vehicle, as stored in the spatial
+    index: its integer coordinates, its entity type and name and the
+    given row number. Returns None for rows without coordinates.
+    '''
+    if len(row) < 9 or row[2] in ('', None) or row[3] in ('', None):
+        return None
+    return [int(row[2]), int(row[3]), str(row[7]), str(row[8]), number]
+
+
+def rows_points(rows):
+    '''
+    Returns the points of the rows of an index; see row_point.
+    '''
+    points = (row_point(row, number) for number, row in enumerate(rows))
+    return [point for point in points if point is not None]
+
+
+def bucket_points(points):
+    '''
+    Returns the spatial index of a part: its points, in index order, and
+    the positions in that list of the points of each non-empty bucket,
+    keyed by "<bucket x>,<bucket y>".
+    '''
+    buckets = {}
+    for i, point in enumerate(points):
+        key = '{},{}'.format(point[0] // bucket_size, point[1] // bucket_size)
+        buckets.setdefault(key, []).append(i)
+    return {
+        'version': spatial_version,
+        'bucket_size': bucket_size,
+        'points': points,
+        'buckets': buckets
+    }
+
+
+def spatial_path(dst_dir, part):
+    '''
+    Returns the path of the spatial index of the given part, beside its
+    index.
+    '''
+    return Path(dst_dir) / (part + spatial_suffix)
+
+
+def write_spatial(path, points):
+    '''
+    Writes the spatial index of a part with the given points, or deletes
+    it if there are none.
+    '''
+    if not points:
+        remove_spatial(path)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(bucket_points(points), fh, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    stats.count('spatial indices')
+
+
+def read_spatial(path):
+    '''
+    Returns the decoded spatial index of a part, with its buckets keyed by
+    tuples of coordinates, or None if it is missing, unreadable or of
+    another version.
+    '''
+    try:
+        with open(path, 'rb') as fh:
+            spatial = json.loads(fh.read())
+    except (OSError, ValueError) as e:
+        return None
+    if spatial.get('version') != spatial_version\
+       or spatial.get('bucket_size') != bucket_size:
+        return None
+    spatial['buckets'] = {
+        tuple(map(int, key.split(','))): positions
+        for key, positions in spatial['buckets'].items()
+    }
+    return spatial
+
+
+def remove_spatial(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError as e:
+        pass
+
+
+class SpatialBuilder:
+    '''
+    Writes the spatial indices of the parts recorded in a manifest, if
+    enabled, from the points returned with the results of the indexer's
+    workers, and deletes them otherwise. Parts without points get none.
+
+    The manifest entry of each part whose spatial index is up to date
+    records its version under 'spatial', so that those of parts not
+    indexed again are left as they are.
+    '''
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def path(self, key):
+        return spatial_path(
+            self.manifest.dst_dir, self.manifest.sink.part_key(key)
+        )
+
+    def add(self, output, points):
+        '''
+        Writes the spatial index of the index at the given path, just
+        recorded in the manifest, given its points, or if they are None,
+        when saving, from the index.
+        '''
+        key = self.manifest.output_key(output)
+        if not enabled:
+            remove_spatial(self.path(key))
+        elif points is not None:
+            with stats.timer('spatial index'):
+                write_spatial(self.path(key), points)
+            self.manifest.outputs[key]['spatial'] = spatial_version
+
+    def save(self, keys=None):
+        '''
+        Brings the spatial indices of the indices with the given paths,
+        relative to the destination folder, or of all those recorded in
+        the manifest, up to date: those whose points were unknown, or
+        which were carried over from a run with another version or
+        without spatial indices, are written from the indices, and all
+        are deleted if spatial indices are disabled.
+        '''
+        outputs = self.manifest.outputs
+        if keys is None: keys = outputs
+        with stats.timer('spatial index'):
+            for key in sorted(keys):
+                entry = outputs[key]
+                if not enabled:
+                    if entry.pop('spatial', None) is not None:
+                        remove_spatial(self.path(key))
+                    continue
+                if entry.get('spatial') == spatial_version: continue
+                rows = self.manifest.sink.read_rows(
+                    self.manifest.dst_dir / key
+                ) or []
+                write_spatial(self.path(key), rows_points(rows))
+                entry['spatial'] = spatial_version
+
+
+class SpatialIndex:
+    '''
+    The spatial indices of the parts of a destination folder, for finding
+    their entities with coordinates by position, without reading their
+    indices. The spatial index of each part is read only once it is
+    searched. The parts of a mod stack are those of all of its layer
+    folders, under part paths prefixed with the layer's name, as in
+    diff.Destination.
+
+    Entities are returned as tuples of their part path and their
+    SpatialPoint, whose row number gives their full row in the index of
+    the part (see diff.Destination.read_rows). Coordinates are those of the
+    index rows, and so relative to each part; searches apply to each part
+    separately. Searches may be restricted to some parts, and to
+    entities of a given type and name.
+    '''
+    def __init__(self, dst_dir):
+        self.dst_dir = Path(dst_dir)
+        # The spatial indices of the parts searched so far, keyed by part
+        # path, or None for parts without one.
+        self.parts = {}
+        # The paths of the parts of the destination folder, once listed.
+        self.listed = None
+
+    def part_index(self, part):
+        '''
+        Returns the spatial index of a part, reading it on first use, or
+        None if it has none.
+        '''
+        if part not in self.parts:
+            self.parts[part] = read_spatial(spatial_path(self.dst_dir, part))
+        return self.parts[part]
+
+    def all_parts(self):
+        '''
+        Returns the sorted paths of the parts recorded in the manifests of
+        the destination folder, those of a mod stack being found in its
+        layer folders; see diff.Destination.
+        '''
+        if self.listed is None:
+            self.listed = sorted(Destination(self.dst_dir).parts)
+        return self.listed
+
+    def select_parts(self, parts):
+        '''
+        Yields the given parts, or all of them if None, with their spatial
+        indices, skipping those without one.
+        '''
+        if parts is None: parts = self.all_parts()
+        for part in parts:
+            spatial = self.part_index(part)
+            if spatial is not None: yield part, spatial
+
+    @staticmethod
+    def matches(point, entity_type, name):
+        return (entity_type is None or point[2] == entity_type)\
+            and (name is None or point[3] == name)
+
+    def find(self, entity_type=None, name=None, parts=None):
+        '''
+        Yields the entities with coordinates of the given type and name,
+        in index order.
+        '''
+        for part, spatial in self.select_parts(parts):
+            for point in spatial['points']:
+                if self.matches(point, entity_type, name):
+                    yield part, SpatialPoint(*point)
+
+    def rectangle(
+        self, x0, y0, x1, y1, entity_type=None, name=None, parts=None
+    ):
+        '''
+        Yields the entities within the rectangle from (x0, y0) to (x1, y1),
+        inclusive, in index order.
+        '''
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        bx0, bx1 = int(x0 // bucket_size), int(x1 // bucket_size)
+        by0, by1 = int(y0 // bucket_size), int(y1 // bucket_size)
+        for part, spatial in self.select_parts(parts):
+            buckets = spatial['buckets']
+            if (bx1 - bx0 + 1) * (by1 - by0 + 1) <= len(buckets):
+                found = [
+                    buckets.get((bx, by), ())
+                    for by in range(by0, by1 + 1)
+                    for bx in range(bx0, bx1 + 1)
+                ]
+            else:
+                # Fewer buckets exist than the rectangle covers.
+                found = [
+                    positions for (bx, by), positions in buckets.items()
+                    if bx0 <= bx <= bx1 and by0 <= by <= by1
+                ]
+            points = spatial['points']
+            for i in sorted(i for positions in found for i in positions):
+                point = points[i]
+                if x0 <= point[0] <= x1 and y0 <= point[1] <= y1\
+                   and self.matches(point, entity_type, name):
+                    yield part, SpatialPoint(*point)
+
+    def radius(self, x, y, r, entity_type=None, name=None, parts=None):
+        '''
+        Yields the entities within distance r of (x, y), in index order.
+        '''
+        for part, record in self.rectangle(
+            x - r, y - r, x + r, y + r, entity_type, name, parts
+        ):
+            if (record.x - x) ** 2 + (record.y - y) ** 2 <= r * r:
+                yield part, record
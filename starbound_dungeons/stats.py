@@ -0,0 +1,211 @@
+from contextlib import contextmanager
+from pathlib import Path
+
+import cProfile
+import heapq
+import json
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError as e:
+    # Not available on Windows.
+    resource = None
+
+
+# Timers and counters of the work done by this process, since the last
+# call to take. Worker processes return theirs to the main process with
+# each result, to be merged into its own.
+stage_totals = {}
+counters = {}
+slowest_parts = []
+
+# Guards the timers and counters, which are also updated by the threads
+# prefetching parts.
+lock = threading.Lock()
+
+# The number of slowest parts kept for the report.
+slowest_count = 20
+
+# How slow parts are profiled: None, 'cprofile' or 'tracemalloc'. See
+# configure_profiling.
+profile_mode = None
+profile_threshold = 1.0
+profile_dir = None
+profile_paths = []
+
+
+def configure_profiling(mode, threshold=1.0, directory=None):
+    '''
+    Enables profiling of every part, keeping the profile of each part
+    which takes at least threshold seconds to index. mode is 'cprofile'
+    to save cProfile statistics, 'tracemalloc' to save a snapshot of the
+    memory allocated while indexing the part, or None to disable
+    profiling.
+    '''
+    global profile_mode, profile_threshold, profile_dir
+    profile_mode = mode
+    profile_threshold = threshold
+    profile_dir = directory and Path(directory)
+
+
+def profiling_config():
+    return (profile_mode, profile_threshold, profile_dir)
+
+
+def add_time(stage, seconds):
+    with lock:
+        total = stage_totals.get(stage)
+        if total is None:
+            stage_totals[stage] = [seconds, 1]
+        else:
+            total[0] += seconds
+            total[1] += 1
+
+
+def count(name, n=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(stage):
+    '''
+    Adds the time spent in the block to the total of the given stage.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start)
+
+
+def record_part(path, seconds):
+    entry = (seconds, path)
+    if len(slowest_parts) < slowest_count:
+        heapq.heappush(slowest_parts, entry)
+    elif entry > slowest_parts[0]:
+        heapq.heapreplace(slowest_parts, entry)
+
+
+def profile_path(path, extension):
+    name = re.sub(r'[^\w.-]+', '_', path).strip('_')
+    return profile_dir / '{}.{}'.format(name, extension)
+
+
+@contextmanager
+def part_timer(path):
+    '''
+    Times the indexing of a part, given its path relative to the source
+    folder, and profiles it if profiling is enabled.
+    '''
+    profiler = None
+    if profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile_mode == 'tracemalloc':
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record_part(path, elapsed)
+        if profiler is not None:
+            profiler.disable()
+        if profile_mode is not None:
+            save = elapsed >= profile_threshold
+            if save: profile_dir.mkdir(parents=True, exist_ok=True)
+            if profiler is not None and save:
+                dump = profile_path(path, 'prof')
+                profiler.dump_stats(str(dump))
+                profile_paths.append(str(dump))
+            elif profile_mode == 'tracemalloc':
+                if save:
+                    dump = profile_path(path, 'tracemalloc')
+                    tracemalloc.take_snapshot().dump(str(dump))
+                    profile_paths.append(str(dump))
+                tracemalloc.stop()
+
+
+def take():
+    '''
+    Returns the statistics collected by this process since the last
+    call, and resets them.
+    '''
+    global stage_totals, counters, slowest_parts, profile_paths
+    with lock:
+        taken = {
+            'stages': stage_totals,
+            'counters': counters,
+            'slowest_parts': slowest_parts,
+            'profiles': profile_paths
+        }
+        stage_totals, counters, slowest_parts, profile_paths = {}, {}, [], []
+    return taken
+
+
+def merge(taken):
+    '''
+    Adds statistics returned by take, possibly in another process, to
+    those of this process.
+    '''
+    with lock:
+        for stage, (seconds, calls) in taken['stages'].items():
+            total = stage_totals.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+    for name, n in taken['counters'].items():
+        count(name, n)
+    for seconds, path in taken['slowest_parts']:
+        record_part(path, seconds)
+    profile_paths.extend(taken['profiles'])
+
+
+def peak_memory():
+    '''
+    Returns the peak resident set size, in bytes, of this process and of
+    the largest of its terminated child processes, or None if it cannot
+    be determined on this platform.
+    '''
+    if resource is None: return None
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+
+def make_report(wall_seconds, **extra):
+    '''
+    Returns the statistics of this process, including those merged from
+    workers, as a dict suitable for writing as JSON.
+    '''
+    report = dict(extra)
+    report.update({
+        'wall_seconds': wall_seconds,
+        'peak_rss': peak_memory(),
+        'counters': dict(sorted(counters.items())),
+        'stages': {
+            stage: {'seconds': seconds, 'calls': calls}
+            for stage, (seconds, calls) in sorted(
+                stage_totals.items(), key=lambda s: -s[1][0]
+            )
+        },
+        'slowest_parts': [
+            {'path': path, 'seconds': seconds}
+            for seconds, path in sorted(slowest_parts, reverse=True)
+        ],
+        'profiles': sorted(profile_paths)
+    })
+    return report
+
+
+def write_report(path, wall_seconds, **extra):
+    with open(path, 'w') as fh:
+        json.dump(make_report(wall_seconds, **extra), fh, indent=1)
@@ -0,0 +1,223 @@
+from . import assets, grids, spatial, stats
+from .common import caches
+from .manifest import manifest_version
+from .png import compile_brushes
+
+from pathlib import Path
+
+import hashlib
+import json
+import os
+
+
+# The name of the folder of the store, in the destination folder.
+store_name = '.store'
+
+# Bump this whenever the layout of entries changes.
+store_version = 2
+
+
+def content_hash(path):
+    '''
+    Returns the SHA-256 hash of the contents of the file read for the
+    given asset path, as a hex string.
+    '''
+    key = assets.identity(path)
+    digest = caches.content_hashes.get(key)
+    if digest is None:
+        with stats.timer('store hash'):
+            h = hashlib.sha256()
+            with assets.open_file(path) as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b''):
+                    h.update(chunk)
+        digest = h.hexdigest()
+        caches.content_hashes[key] = digest
+    return digest
+
+
+class ResultStore:
+    '''
+    A content-addressed store of the indices of parts, kept in a folder
+    of the destination folder, so that a part is indexed only once
+    however many byte-identical copies of it the assets contain, in this
+    run or a later one.
+
+    Each entry is keyed by a hash of the contents of a part file and of
+    the brushes applied to it; see group_key. It is made of two files:
+
+    * <key>.json: the files other than the part on which the index
+      depends, such as external tilesets, as paths relative to the
+      part's folder and hashes of their contents, the counts of the
+      entities of the index and its points (see spatial.row_point) and
+      rows, if they were collected.
+    * <key>.csv: the index as a CSV file, if it was written as one.
+    * <key>.grid.npy and <key>.grid.json: the grid of the part and its
+      legend, if grids were exported; see grids.GridWriter.
+
+    The manifest entry of each index records the key of its entry under
+    'store'; entries which no manifest references are deleted at the end
+    of each run (see collect).
+    '''
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def entry_path(self, key, suffix):
+        return self.root / key[:2] / '{}{}'.format(key, suffix)
+
+    def group_key(self, items):
+        '''
+        Returns the key of the index written by a group of work items, as
+        returned by indexer.group_work_items, or None if the part cannot
+        be read. The brushes of the last item are those of the index.
+        '''
+        item = items[-1]
+        h = hashlib.sha256(json.dumps(
+            [store_version, manifest_version, item['type']]
+        ).encode('utf-8'))
+        try:
+            h.update(content_hash(item['partpath'] / item['partfile'])
+                     .encode('utf-8'))
+        except OSError as e:
+            # Left for the indexer to report.
+            return None
+        if item['type'] == 'png':
+            h.update(compile_brushes(item['brushes']).fingerprint
+                     .encode('utf-8'))
+        return h.hexdigest()
+
+    def restore(
+        self, key, src_dir, dst_dir, partpath, partfile, sink, collect_rows
+    ):
+        '''
+        Writes the index of a part to the given sink from the entry with
+        the given key, if there is one whose dependencies are unchanged
+        relative to the part. Returns a dict containing the list of the
+        dependencies, the entity counts and points of the index, if known,
+        and, if collect_rows is true, its rows, or None if there is no
+        such entry.
+        '''
+        try:
+            with open(self.entry_path(key, '.json'), 'rb') as fh:
+                entry = json.loads(fh.read())
+        except (OSError, ValueError) as e:
+            return None
+        if collect_rows and entry.get('rows') is None:
+            return None
+        deps = []
+        for relative_path, digest in entry['deps'].items():
+            path = Path(os.path.normpath(partpath / relative_path))
+            try:
+                if content_hash(path) != digest: return None
+            except OSError as e:
+                return None
+            deps.append(path)
+        if spatial.enabled and entry.get('points') is None:
+            # The part was stored without collecting its points.
+            return None
+        if grids.enabled:
+            try:
+                grids.restore_grid(
+                    self.entry_path(key, grids.grid_suffix),
+                    grids.grid_path(src_dir, dst_dir, partpath, partfile)
+                )
+            except FileNotFoundError as e:
+                return None
+        if not sink.collects_rows:
+            try:
+                sink.restore_index(
+                    self.entry_path(key, '.csv'),
+                    src_dir, dst_dir, partpath, partfile
+                )
+            except FileNotFoundError as e:
+                return None
+        return {
+            'deps': deps, 'entities': entry.get('entities'),
+            'points': entry.get('points'), 'rows': entry.get('rows')
+        }
+
+    def save(
+        self, key, src_dir, dst_dir, partpath, partfile, sink, deps, rows,
+        entities=None, points=None
+    ):
+        '''
+        Adds the index of a part just written to the given sink to the
+        store, with its dependencies other than the part file, its entity
+        counts and points and, if they were collected, its rows.
+        '''
+        entry_dir = self.root / key[:2]
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        if grids.enabled:
+            grids.store_grid(
+                grids.grid_path(src_dir, dst_dir, partpath, partfile),
+                self.entry_path(key, grids.grid_suffix)
+            )
+        if not sink.collects_rows:
+            path = sink.index_path(src_dir, dst_dir, partpath, partfile)
+            if not sink.exists(path):
+                # The part could not be indexed.
+                return
+            tmp_path = self.entry_path(key, '.csv.{}.tmp'.format(os.getpid()))
+            sink.store_index(path, tmp_path)
+            os.replace(tmp_path, self.entry_path(key, '.csv'))
+        entry = {
+            'deps': {
+                os.path.relpath(dep, partpath).replace(os.sep, '/'):
+                content_hash(dep)
+                for dep in deps
+            },
+            'entities': entities,
+            'points': points,
+            'rows': rows
+        }
+        tmp_path = self.entry_path(key, '.json.{}.tmp'.format(os.getpid()))
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(entry, fh, separators=(',', ':'))
+        os.replace(tmp_path, self.entry_path(key, '.json'))
+
+    def remove(self, keys):
+        '''
+        Deletes the entries with the given keys.
+        '''
+        for key in keys:
+            entry_dir = self.root / key[:2]
+            try:
+                names = os.listdir(entry_dir)
+            except FileNotFoundError as e:
+                continue
+            for name in names:
+                if name.partition('.')[0] == key:
+                    os.unlink(entry_dir / name)
+                    stats.count('store entries deleted')
+
+    def collect(self, keys):
+        '''
+        Deletes the entries whose keys are not among the given ones, with
+        any temporary files left by interrupted runs.
+        '''
+        with stats.timer('store'):
+            try:
+                folders = os.listdir(self.root)
+            except FileNotFoundError as e:
+                return
+            for folder in folders:
+                entry_dir = self.root / folder
+                for name in os.listdir(entry_dir):
+                    key = name.partition('.')[0]
+                    if key not in keys or name.endswith('.tmp'):
+                        os.unlink(entry_dir / name)
+                        stats.count('store entries deleted')
+                try:
+                    entry_dir.rmdir()
+                except OSError as e:
+                    pass
+
+
+def manifest_store_keys(manifests):
+    '''
+    Returns the set of the keys of the store entries referenced by the
+    given manifests.
+    '''
+    return set(
+        entry['store'] for manifest in manifests
+        for entry in manifest.outputs.values() if 'store' in entry
+    )
@@ -0,0 +1,226 @@
+from . import stats
+from .common import row_entities
+from . import spatial
+
+from collections import Counter
+
+import json
+import os
+
+
+# The name of the summary file written to the destination folder.
+summary_name = 'summary.json'
+
+# The extensions of the source files listed as the dungeons of a part.
+dungeon_extensions = ('.dungeon', '.structure')
+
+
+def count_row(entities, row):
+    '''
+    Adds the entities of an index row to the counts of a part: a dict
+    mapping each entity type to a dict mapping each entity name to a dict
+    of the number of occurrences of the entity in each layer, e.g.,
+    {'material': {'dirt': {'front': 12, 'back': 30}}}.
+    '''
+    layer = row[0]
+    for entity_type, name in row_entities(row):
+        layers = entities.setdefault(entity_type, {}).setdefault(name, {})
+        layers[layer] = layers.get(layer, 0) + 1
+
+
+def count_rows(rows):
+    '''
+    Returns the entity counts of the rows of an index; see count_row.
+    '''
+    entities = {}
+    for row in rows: count_row(entities, row)
+    return entities
+
+
+class TallyWriter:
+    '''
+    Wraps the writer of an index, counting the entities of each row
+    written into a dict (see count_row), and appending the point of each
+    row with coordinates to a list, if given (see spatial.row_point).
+    '''
+    def __init__(self, writer, entities, points=None):
+        self.writer = writer
+        self.entities = entities
+        self.points = points
+        self.count = 0
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def writerow(self, row):
+        count_row(self.entities, row)
+        if self.points is not None:
+            point = spatial.row_point(row, self.count)
+            if point is not None: self.points.append(point)
+        self.count += 1
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows: self.writerow(row)
+
+
+class TallySink:
+    '''
+    Wraps a sink, counting the entities of the index of a part and
+    collecting its points, if spatial indices are enabled, as its rows are
+    written. entities and points hold those of the last index opened, or
+    None if none was.
+    '''
+    def __init__(self, sink):
+        self.sink = sink
+        self.entities = None
+        self.points = None
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+    def open_part(self, src_dir, dst_dir, partpath, partfile):
+        self.entities = {}
+        self.points = [] if spatial.enabled else None
+        return TallyWriter(
+            self.sink.open_part(src_dir, dst_dir, partpath, partfile),
+            self.entities, self.points
+        )
+
+
+def tally_missing(manifest, sink):
+    '''
+    Adds the entity counts of the indices recorded in a manifest without
+    them, such as those carried over from older manifests, by reading
+    the indices from the given sink.
+    '''
+    for key, entry in manifest.outputs.items():
+        if entry.get('entities') is None:
+            rows = sink.read_rows(manifest.dst_dir / key) or []
+            entry['entities'] = count_rows(rows)
+
+
+def manifest_part(entry):
+    '''
+    Returns a tuple of the entity counts of the index with the given
+    manifest entry and the sorted list of its dungeons: the dungeon and
+    ship files from which it was indexed.
+    '''
+    return (
+        entry.get('entities') or {},
+        [dep for dep in sorted(entry['deps'])
+         if dep.endswith(dungeon_extensions)]
+    )
+
+
+def manifest_parts(manifest):
+    '''
+    Returns the parts recorded in a manifest, as a dict mapping the path
+    of each index, relative to the destination folder, to a tuple of its
+    entity counts and dungeons; see manifest_part.
+    '''
+    return {
+        key: manifest_part(entry) for key, entry in manifest.outputs.items()
+    }
+
+
+class SummaryTally:
+    '''
+    The entity counts of a set of parts, as returned by manifest_parts,
+    merged as parts are added and removed, so that the summary of a few
+    changed parts is updated without merging those of all of them again.
+    '''
+    def __init__(self, parts=None):
+        self.parts = 0
+        # The number of parts of each dungeon.
+        self.dungeons = Counter()
+        # The totals of each entity, keyed by its type and name.
+        self.entities = {}
+        for part in (parts or {}).values(): self.add(part)
+
+    def add(self, part, sign=1):
+        '''
+        Adds a tuple of the entity counts and dungeons of a part, or
+        removes it if sign is -1.
+        '''
+        counts, dungeons = part
+        self.parts += sign
+        for dungeon in dungeons: self.dungeons[dungeon] += sign
+        for entity_type, names in counts.items():
+            for name, layers in names.items():
+                entity = self.entities.get((entity_type, name))
+                if entity is None:
+                    entity = self.entities[(entity_type, name)] = {
+                        'parts': 0, 'layers': Counter(),
+                        'dungeons': Counter()
+                    }
+                entity['parts'] += sign
+                for layer, count in layers.items():
+                    entity['layers'][layer] += sign * count
+                for dungeon in dungeons: entity['dungeons'][dungeon] += sign
+                if entity['parts'] == 0:
+                    del self.entities[(entity_type, name)]
+
+    def remove(self, part):
+        self.add(part, -1)
+
+    def summary(self):
+        '''
+        Returns the summary of the parts; see summarize.
+        '''
+        entities = []
+        for key in sorted(self.entities):
+            entity = self.entities[key]
+            layers = {
+                layer: count
+                for layer, count in sorted(entity['layers'].items())
+                if count
+            }
+            entities.append({
+                'type': key[0],
+                'name': key[1],
+                'parts': entity['parts'],
+                'occurrences': sum(layers.values()),
+                'layers': layers,
+                'dungeons': sorted(
+                    dungeon for dungeon, count in entity['dungeons'].items()
+                    if count
+                )
+            })
+        return {
+            'parts': self.parts,
+            'dungeons': sum(1 for count in self.dungeons.values() if count),
+            'entities': entities
+        }
+
+
+def summarize(parts):
+    '''
+    Merges the entity counts of parts, as returned by manifest_parts, into
+    a summary giving the number of parts and dungeons, and for each
+    entity the number of parts in which it occurs, its number of
+    occurrences in total and in each layer, and the dungeons in which it
+    occurs.
+
+    The summary depends only on the counts of each part, not on the order
+    in which they were indexed.
+    '''
+    return SummaryTally(parts).summary()
+
+
+def write_summary(dst_dir, tally):
+    '''
+    Writes the summary of the parts of a SummaryTally to the summary file
+    of the destination folder; see summarize.
+    '''
+    with stats.timer('summary'):
+        path = dst_dir / summary_name
+        tmp_path = path.with_name('{}.{}.tmp'.format(
+            summary_name, os.getpid()))
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(tally.summary(), fh, indent=1)
+        os.replace(tmp_path, path)
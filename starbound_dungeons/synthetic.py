@@ -0,0 +1,538 @@
+from PIL import Image
+
+from pathlib import Path
+
+import argparse
+import json
+import os
+import random
+
+
+# Generates a synthetic Starbound asset tree, for measuring and testing
+# the indexer without a copy of the game's assets. The tree is determined
+# entirely by the options given, including the random seed.
+
+
+# Brushes exercising every kind understood by png.process_brushes.
+dungeon_brushes = [
+    {'value': [0, 0, 0, 0], 'connector': True},
+    {'value': [255, 255, 255, 255]},
+    {'value': [255, 0, 220, 255], 'brush': [['clear']]},
+    {'value': [10, 20, 30, 255],
+     'brush': [['clear'], ['object', 'woodenchair']]},
+    {'value': [11, 21, 31, 255],
+     'brush': [['clear'], ['object', 'basicchest',
+               {'parameters': {'treasurePools': ['basicTreasure', 'gold']}}]]},
+    {'value': [40, 40, 40, 255], 'brush': [['clear'], ['front', 'dirt']]},
+    {'value': [50, 50, 50, 255],
+     'brush': [['clear'], ['back', 'cobblestone']]},
+    {'value': [51, 51, 51, 255],
+     'brush': [['clear'], ['back', 'cobblestone'], ['front', 'brick']]},
+    {'value': [52, 52, 52, 255],
+     'brush': [['clear'], ['back', 'cobblestone'], ['object', 'torch']]},
+    {'value': [0, 0, 200, 255], 'brush': [['clear'], ['liquid', 'water']]},
+    {'value': [0, 0, 201, 255],
+     'brush': [['clear'], ['liquid', 'water'], ['object', 'bubbler']]},
+    {'value': [0, 0, 202, 255], 'brush': [['clear'], ['lava']]},
+    {'value': [60, 60, 60, 255], 'brush': [['clear'], ['surfacebackground']]},
+    {'value': [70, 10, 10, 255], 'brush': [['object', 'walltorch']]},
+    {'value': [71, 11, 11, 255],
+     'brush': [['object', 'crate',
+                {'parameters': {'treasurePools': ['crateTreasure']}}]]},
+    {'value': [80, 80, 80, 255], 'brush': [['back', 'dirt']]},
+    {'value': [81, 81, 81, 255],
+     'brush': [['back', 'dirt'], ['front', 'stone']]},
+    {'value': [82, 82, 82, 255],
+     'brush': [['back', 'dirt'], ['object', 'lantern']]},
+    {'value': [90, 0, 90, 255],
+     'brush': [['random', [['object', 'pot1'], ['object', 'pot2']]]]},
+    {'value': [100, 0, 0, 255],
+     'brush': [['npc', {'kind': 'monster', 'typeName': 'poptop'}]]},
+    {'value': [101, 0, 0, 255],
+     'brush': [['npc', {'kind': 'npc', 'typeName': 'villager',
+                        'species': 'human'}]]},
+    {'value': [110, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'questlocation',
+                'parameters': {'locationType': 'bossroom'}}]]},
+    {'value': [111, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'radiomessage',
+                'parameters': {'radioMessage': 'welcome'}}]]},
+    {'value': [112, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'radiomessage',
+                'parameters': {'radioMessages': ['one', 'two']}}]]},
+    {'value': [113, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'objecttracker', 'parameters': {}}]]},
+    {'value': [114, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'messenger',
+                'parameters': {'messageType': 'open'}}]]},
+    {'value': [115, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'bossmusic',
+                'parameters': {'uniqueId': 'boss'}}]]},
+    {'value': [116, 110, 0, 255],
+     'brush': [['stagehand', {'type': 'aimessage',
+                'parameters': {'broadcastAction': {'id': 'hello'}}}]]},
+    {'value': [120, 0, 120, 255], 'brush': [['wire', {'group': 'a'}]]},
+    {'value': [121, 0, 120, 255], 'brush': [['biometree']]},
+    {'value': [122, 0, 120, 255], 'brush': [['biomeitems']]},
+    {'value': [123, 0, 120, 255], 'brush': [['playerstart']]},
+    {'value': [124, 0, 120, 255], 'brush': [['surface']]},
+]
+
+# Weights of the brushes above when painting PNG parts. Materials
+# dominate real parts; entities are sparse.
+dungeon_brush_weights = [
+    2, 2, 30, 1, 1, 200, 100, 40, 1, 30, 1, 5, 5, 1, 1, 60, 20, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 5
+]
+
+material_names = [
+    'dirt', 'stone', 'cobblestone', 'brick', 'sand', 'snow', 'ice', 'glass'
+]
+liquid_names = ['water', 'lava', 'poison']
+object_names = [
+    'woodenchair', 'basicchest', 'torch', 'lantern', 'crate', 'pot1',
+    'monsterspawner', 'door', 'bed', 'table'
+]
+mod_names = ['grass', 'moss', 'snow']
+monster_names = ['poptop', 'gleap', 'smallbiped']
+npc_names = ['villager', 'guard', 'merchant']
+
+
+def write_json(path, data, comment=None):
+    '''
+    Writes a JSON asset file, optionally preceded by a line comment and
+    containing a block comment, as Starbound assets frequently do.
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    text = json.dumps(data, indent=2)
+    if comment:
+        # Starbound assets frequently contain comments.
+        text = '// {}\n{}'.format(comment, text.replace(
+            '\n', '\n  /* block comment */\n', 1))
+    path.write_text(text)
+
+
+def make_tileset(name, kind, names, tilecount):
+    '''
+    Returns a Tiled tileset whose tiles have the given kind of property,
+    e.g., material, naming one of the given entities.
+    '''
+    tileproperties = {}
+    tiles = {}
+    for offset in range(tilecount):
+        if offset == 0:
+            props = {'invalid': 'true'}
+        elif kind == 'liquid':
+            props = {'liquid': names[offset % len(names)]}
+        elif kind == 'misc':
+            props = {}
+        else:
+            props = {kind: '{}{}'.format(names[offset % len(names)], offset)}
+        tileproperties[str(offset)] = props
+        tiles[str(offset)] = {'image': '../../tiles/{}.png'.format(offset)}
+    return {
+        'name': name, 'tilecount': tilecount, 'tilewidth': 8,
+        'tileheight': 8, 'margin': 0, 'spacing': 0,
+        'tileproperties': tileproperties, 'tiles': tiles,
+    }
+
+
+def generate_tilesets(root, tilecount):
+    '''
+    Writes the external tilesets. Returns a list of (name, tile count)
+    tuples, in the order in which Tiled maps reference them.
+    '''
+    tilesets = [
+        ('materials', make_tileset('materials', 'material', material_names,
+                                   tilecount)),
+        ('liquids', make_tileset('liquids', 'liquid', liquid_names, 8)),
+        ('objects', make_tileset('objects', 'object', object_names,
+                                 tilecount)),
+        ('miscellaneous', make_tileset('miscellaneous', 'misc', [], 8)),
+    ]
+    for name, tileset in tilesets:
+        write_json(root / 'tilesets' / 'packed' / '{}.json'.format(name),
+                   tileset)
+    return [(name, tileset['tilecount']) for name, tileset in tilesets]
+
+
+def png_part(rng, width, height, mode, brushes, weights):
+    '''
+    Returns a PNG dungeon part painted with the colors of the given
+    brushes, in the given image mode: RGB, RGBA or P.
+    '''
+    colors = [tuple(brush['value']) for brush in brushes]
+    if mode == 'RGB':
+        keep = [i for i, c in enumerate(colors) if c[3] == 255]
+        colors = [colors[i][:3] for i in keep]
+        weights = [weights[i] for i in keep]
+    elif mode == 'P':
+        keep = [i for i, c in enumerate(colors) if c[3] == 255][:255]
+        colors = [colors[i][:3] for i in keep]
+        weights = [weights[i] for i in keep]
+    # Paint horizontal runs so the part resembles real dungeon parts.
+    data = []
+    while len(data) < width * height:
+        run = rng.randint(1, 24)
+        data.extend([rng.choices(range(len(colors)), weights)[0]] * run)
+    data = data[:width * height]
+    # A handful of colors without a brush.
+    for i in range(rng.randint(0, 3)):
+        data[rng.randrange(len(data))] = -1
+    if mode == 'P':
+        image = Image.new('P', (width, height))
+        palette = [v for c in colors for v in c]
+        palette.extend([7, 7, 7])
+        image.putpalette(palette)
+        image.putdata([len(colors) if i < 0 else i for i in data])
+    else:
+        stray = (7, 7, 7) if mode == 'RGB' else (7, 7, 7, 7)
+        image = Image.new(mode, (width, height))
+        image.putdata([stray if i < 0 else colors[i] for i in data])
+    return image
+
+
+def generate_dungeon(root, rng, index, args, tilesets, shared):
+    '''
+    Writes a dungeon file and its PNG and Tiled parts. Every dungeon also
+    references the shared PNG and Tiled parts.
+    '''
+    name = 'synthetic{}'.format(index)
+    ddir = root / 'dungeons' / 'synthetic' / name
+    ddir.mkdir(parents=True, exist_ok=True)
+    brushes = dungeon_brushes
+    if index % 3 == 2:
+        # Some dungeons redefine a shared color.
+        brushes = [dict(b) for b in brushes]
+        brushes[5] = {'value': [40, 40, 40, 255],
+                      'brush': [['clear'], ['front', 'snow']]}
+    parts = []
+    modes = ['RGBA', 'RGB', 'P']
+    for p in range(args.png_parts):
+        partfile = '{}_{}.png'.format(name, p)
+        width, height = args.png_size
+        image = png_part(rng, width, height, modes[(index + p) % 3],
+                         brushes, dungeon_brush_weights)
+        image.save(ddir / partfile)
+        parts.append({'name': partfile, 'rules': [],
+                      'def': ['image', [partfile]]})
+    parts.append({'name': 'shared', 'rules': [],
+                  'def': ['image', [shared['png']]]})
+    for p in range(args.tmx_parts):
+        partfile = '{}_{}.json'.format(name, p)
+        generate_tiled_map(root, ddir / partfile, rng, args.tmx_size, tilesets,
+                           embedded=(p == 0 and index % 2 == 0))
+        parts.append({'name': partfile, 'rules': [],
+                      'def': ['tmx', partfile]})
+    parts.append({'name': 'sharedtmx', 'rules': [],
+                  'def': ['tmx', [shared['tmx']]]})
+    write_json(ddir / '{}.dungeon'.format(name), {
+        'metadata': {'name': name, 'species': 'generic'},
+        'tiles': brushes,
+        'parts': parts,
+    }, comment=(index % 2 == 1) and 'synthetic dungeon' or None)
+
+
+def generate_unbrushed_dungeon(root, rng, args):
+    '''
+    Writes a dungeon file without brushes, and a PNG part of which every
+    color is therefore unknown, for which the indexer must only warn.
+    '''
+    name = 'unbrushed'
+    ddir = root / 'dungeons' / 'synthetic' / name
+    ddir.mkdir(parents=True, exist_ok=True)
+    partfile = '{}_0.png'.format(name)
+    width, height = args.png_size
+    png_part(rng, width, height, 'RGBA', dungeon_brushes,
+             dungeon_brush_weights).save(ddir / partfile)
+    write_json(ddir / '{}.dungeon'.format(name), {
+        'metadata': {'name': name, 'species': 'generic'},
+        'tiles': [],
+        'parts': [{'name': partfile, 'rules': [],
+                   'def': ['image', [partfile]]}],
+    })
+
+
+def tile_object(rng, gid, x, y, tile_size, props=None):
+    obj = {
+        'gid': gid, 'height': tile_size, 'width': tile_size, 'id': 0,
+        'name': '', 'rotation': 0, 'type': '', 'visible': True,
+        'x': x, 'y': y,
+    }
+    if props is not None:
+        obj['properties'] = props
+    return obj
+
+
+def shape_object(x, y, tile_size, props, new_style):
+    if new_style:
+        props = [{'name': k, 'type': 'string', 'value': v}
+                 for k, v in props.items()]
+    return {
+        'height': tile_size, 'width': tile_size, 'id': 0, 'name': '',
+        'rotation': 0, 'type': '', 'visible': True, 'x': x, 'y': y,
+        'properties': props,
+    }
+
+
+def generate_tiled_map(root, path, rng, size, tilesets, embedded=False):
+    '''
+    Writes a Tiled map with back, front and liquid tile layers, and
+    object layers containing objects, entities and mods.
+    '''
+    width, height = size
+    tsdir = os.path.relpath(root / 'tilesets', path.parent)
+    tile_size = 8
+    refs = []
+    firstgid = 1
+    firstgids = {}
+    for name, tilecount in tilesets:
+        firstgids[name] = (firstgid, tilecount)
+        refs.append({'firstgid': firstgid,
+                     'source': '{}/packed/{}.json'.format(tsdir, name)})
+        firstgid += tilecount
+    if embedded:
+        tileset = make_tileset('embedded', 'object', ['embeddedthing'], 4)
+        tileset['firstgid'] = firstgid
+        refs.append(tileset)
+        firstgids['embedded'] = (firstgid, 4)
+
+    def gid(name, flip=True):
+        first, count = firstgids[name]
+        g = first + rng.randrange(1, count)
+        if flip and rng.random() < 0.1:
+            g |= rng.choice([0x80000000, 0x40000000, 0x20000000])
+        return g
+
+    layers = []
+    for layer_name, tileset in [('back', 'materials'), ('front', 'materials'),
+                                ('liquid', 'liquids')]:
+        data = []
+        while len(data) < width * height:
+            run = rng.randint(1, 16)
+            value = 0 if rng.random() < 0.3 else gid(tileset)
+            data.extend([value] * run)
+        layers.append({
+            'name': layer_name, 'type': 'tilelayer', 'data':
+            data[:width * height], 'width': width, 'height': height,
+            'opacity': 1, 'visible': True, 'x': 0, 'y': 0,
+        })
+
+    objects = []
+    for i in range(max(1, width * height // 200)):
+        x = rng.randrange(width) * tile_size
+        y = rng.randrange(1, height + 1) * tile_size
+        props = None
+        roll = rng.random()
+        if roll < 0.2:
+            props = {'parameters': json.dumps(
+                {'treasurePools': ['basicTreasure', 'money']})}
+        elif roll < 0.3:
+            props = {'parameters': json.dumps(
+                {'spawner': {'monsterTypes': ['poptop', 'gleap']}})}
+        tileset = 'objects'
+        if embedded and rng.random() < 0.2:
+            tileset = 'embedded'
+        objects.append(tile_object(rng, gid(tileset), x, y, tile_size, props))
+    layers.append({
+        'name': 'objects', 'type': 'objectgroup', 'objects': objects,
+        'draworder': 'topdown', 'opacity': 1, 'visible': True, 'x': 0,
+        'y': 0,
+    })
+
+    entities = []
+    for i in range(max(1, width * height // 400)):
+        x = rng.randrange(width) * tile_size + rng.random() * tile_size
+        y = rng.randrange(height) * tile_size
+        new_style = rng.random() < 0.5
+        roll = rng.random()
+        if roll < 0.3:
+            props = {'monster': rng.choice(monster_names)}
+        elif roll < 0.6:
+            props = {'npc': 'human, avian', 'typeName': rng.choice(npc_names)}
+        elif roll < 0.7:
+            props = {'stagehand': 'questlocation', 'parameters': json.dumps(
+                {'locationType': 'camp'})}
+        elif roll < 0.8:
+            props = {'stagehand': 'radiomessage', 'parameters': json.dumps(
+                {'radioMessages': ['hi', 'there']})}
+        elif roll < 0.85:
+            props = {'stagehand': 'bossmusic'}
+        elif roll < 0.9:
+            props = {'vehicle': 'hoverbike'}
+        else:
+            props = {'anchor': 'true'}
+        entities.append(shape_object(x, y, tile_size, props, new_style))
+    layers.append({
+        'name': 'monsters & npcs', 'type': 'objectgroup',
+        'objects': entities, 'draworder': 'topdown', 'opacity': 1,
+        'visible': True, 'x': 0, 'y': 0,
+    })
+
+    mods = []
+    for i in range(max(1, width * height // 300)):
+        x = rng.randrange(width) * tile_size
+        y = rng.randrange(height) * tile_size
+        props = {'mod': rng.choice(mod_names)}
+        roll = rng.random()
+        if roll < 0.4:
+            props['material'] = rng.choice(material_names)
+        elif roll < 0.7:
+            props['back'] = rng.choice(material_names)
+            props['front'] = rng.choice(material_names)
+        mods.append(shape_object(x, y, tile_size, props, rng.random() < 0.5))
+    layers.append({
+        'name': 'mods', 'type': 'objectgroup', 'objects': mods,
+        'draworder': 'topdown', 'opacity': 1, 'visible': True, 'x': 0,
+        'y': 0,
+    })
+
+    write_json(path, {
+        'height': height, 'width': width, 'layers': layers,
+        'nextobjectid': 1, 'orientation': 'orthogonal',
+        'renderorder': 'right-down', 'tileheight': tile_size,
+        'tilewidth': tile_size, 'tilesets': refs, 'version': 1,
+    })
+
+
+def generate_ship(root, rng, index, args):
+    '''
+    Writes a ship structure file and its block image, with the block key
+    either inline or in a separate file.
+    '''
+    race = 'race{}'.format(index)
+    sdir = root / 'ships' / race
+    sdir.mkdir(parents=True, exist_ok=True)
+    blockKey = []
+    colors = []
+    for i in range(16):
+        value = [10 * i, 255 - 10 * i, (37 * i) % 256]
+        tile = {
+            'value': value, 'comment': 'tile {}'.format(i),
+            'foregroundBlock': False, 'backgroundBlock': False,
+        }
+        kind = i % 5
+        if kind == 1:
+            tile['object'] = rng.choice(object_names)
+            if i % 2:
+                tile['objectParameters'] = {'treasurePools': ['shipTreasure']}
+        elif kind == 2:
+            tile['backgroundBlock'] = True
+            tile['backgroundMat'] = rng.choice(material_names)
+        elif kind == 3:
+            tile['backgroundBlock'] = True
+            tile['foregroundBlock'] = True
+            tile['backgroundMat'] = rng.choice(material_names)
+            tile['foregroundMat'] = rng.choice(material_names)
+        elif kind == 4:
+            tile['foregroundBlock'] = True
+            tile['foregroundMat'] = rng.choice(material_names)
+        blockKey.append(tile)
+        colors.append(tuple(value) + (255,))
+    width, height = args.png_size
+    image = Image.new('RGBA', (width, height))
+    image.putdata([rng.choice(colors) for i in range(width * height)])
+    image.save(sdir / '{}T0blocks.png'.format(race))
+    if index % 2:
+        write_json(sdir / 'blockKey.config', {'blockKey': blockKey},
+                   comment='ship block key')
+        key = 'blockKey.config:blockKey'
+    else:
+        key = blockKey
+    write_json(sdir / '{}T0.structure'.format(race), {
+        'config': {}, 'backgroundOverlays': [], 'foregroundOverlays': [],
+        'blockKey': key, 'blockImage': '{}T0blocks.png'.format(race),
+    })
+
+
+def generate(root, args):
+    '''
+    Writes a synthetic asset tree to root. args holds the options added
+    by add_corpus_arguments.
+    '''
+    rng = random.Random(args.seed)
+    root.mkdir(parents=True, exist_ok=True)
+    write_json(root / '_metadata', {
+        'name': 'synthetic', 'friendlyName': 'Synthetic Assets',
+        'version': '1.0',
+    })
+    tilesets = generate_tilesets(root, args.tilecount)
+
+    shared_dir = root / 'dungeons' / 'shared'
+    shared_dir.mkdir(parents=True, exist_ok=True)
+    width, height = args.png_size
+    png_part(rng, width, height, 'RGBA', dungeon_brushes,
+             dungeon_brush_weights).save(shared_dir / 'shared.png')
+    generate_tiled_map(root, shared_dir / 'shared.json', rng, args.tmx_size,
+                       tilesets)
+    shared = {'png': '/dungeons/shared/shared.png',
+              'tmx': '/dungeons/shared/shared.json'}
+
+    for index in range(args.dungeons):
+        generate_dungeon(root, rng, index, args, tilesets, shared)
+    for index in range(args.ships):
+        generate_ship(root, rng, index, args)
+    generate_unbrushed_dungeon(root, rng, args)
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def add_corpus_arguments(parser):
+    '''
+    Adds the options controlling the size and shape of the generated
+    tree to an argument parser.
+    '''
+    parser.add_argument(
+        '--dungeons', type=int, default=6,
+        help='the number of dungeon files (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--png-parts', type=int, default=3,
+        help='the number of PNG parts per dungeon (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--png-size', type=parse_size, default=(96, 64), metavar='WxH',
+        help='the size of PNG parts and ship block images, in pixels '
+             '(default: 96x64)'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=1,
+        help='the random seed (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--ships', type=int, default=3,
+        help='the number of ships (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--tilecount', type=int, default=64,
+        help='the number of tiles in the material and object tilesets '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--tmx-parts', type=int, default=2,
+        help='the number of Tiled parts per dungeon (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--tmx-size', type=parse_size, default=(64, 48), metavar='WxH',
+        help='the size of Tiled parts, in tiles (default: 64x48)'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic Starbound asset tree."
+    )
+    parser.add_argument(
+        '-d', '--dst', required=True,
+        help='the folder in which to write the assets'
+    )
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+    generate(Path(args.dst), args)
+
+
+if __name__ == '__main__':
+    main()
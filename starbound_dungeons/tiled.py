@@ -1,12 +1,19 @@
-from .common import make_dst_dir
+from . import assets, grids, jsonloader, stats
+from .common import IndexRecord, RowRecorder, caches
+from .sinks import CsvSink
 
-from bisect import bisect_left
+from pathlib import Path
 
-import csv
+import base64
+import gzip
 import json
+import numpy as np
+import os
 import pytiled_parser
 import re
 import sys
+import time
+import zlib
 
 
 # Ignore uninteresting vanilla stagehands.
@@ -21,24 +28,28 @@ ignored_stagehands = [
     'scanclue', 'storageclue', 'vaultitemspawn', 'vaultnpcspawn', 'waypoint'
 ]
 
-# Some Tiled dungeon parts are referenced by multiple dungeons. Indexing
-# them multiple times provides no benefit and takes time, so keep a list
-# of which parts were already seen.
-seen_tiled_parts = set()
+# Tiled stores tile flipping flags in the three most significant bits of
+# each gid.
+# https://doc.mapeditor.org/en/stable/reference/tmx-map-format/#tile-flipping
+gid_flip_mask = 0xE0000000
 
 
-def clearBit(i, offset):
-    mask = ~(1 << offset)
-    return(i & mask)
+class UnsupportedMapError(Exception):
+    '''
+    Raised by read_tiled_map for maps using features that it does not
+    support, which are read with pytiled_parser instead.
+    '''
+    pass
 
 
 def get_tiled_property(obj, name, ptype='string'):
-    if isinstance(obj.properties, dict):
+    properties = obj['properties']
+    if isinstance(properties, dict):
         # old style properties
-        if ptype == 'string': return obj.properties.get(name)
-    elif isinstance(obj.properties, list):
+        if ptype == 'string': return properties.get(name)
+    elif isinstance(properties, list):
         # new style properties
-        for prop in obj.properties:
+        for prop in properties:
             if isinstance(prop, dict):
                 if prop['name'] == name and prop['type'] == ptype:
                     return prop['value']
@@ -50,47 +61,44 @@ def get_tiled_property(obj, name, ptype='string'):
         raise Exception('Invalid Tiled property')
 
 
-def make_dungeon_part_tileset_index(dungeon_tilesets):
-    tilesets = []
-    tileset_firstgid_index = []
-    tileset_lastgid_index = []
-    prev_tileset = None
-    for firstgid, tileset in dungeon_tilesets.items():
-        tileset_firstgid_index.append(firstgid)
-        if prev_tileset is not None:
-            tilesets.append(prev_tileset)
-            tileset_lastgid_index.append(firstgid - 1)
-        prev_tileset = tileset
-    if prev_tileset is not None:
-        tilesets.append(prev_tileset)
-        tileset_lastgid_index.append(2 ** 32 - 1)
-    assert len(tilesets) == len(tileset_firstgid_index)
-    assert len(tilesets) == len(tileset_lastgid_index)
-    return {
-        'tilesets': tilesets,
-        'firstgids': tileset_firstgid_index,
-        'lastgids': tileset_lastgid_index
-    }
+def unflip_object(raw_gid):
+    return raw_gid & ~gid_flip_mask
 
 
-def unflip_object(raw_gid):
-    # This should be handled by the pytiled_parser library.
-    # https://doc.mapeditor.org/en/stable/reference/tmx-map-format/#tile-flipping
-    return clearBit(clearBit(clearBit(raw_gid, 29), 31), 30)
+def tile_layer_gids(data):
+    '''
+    Returns the distinct non-empty gids of a tile layer, with their flip
+    bits cleared, as a uint32 array in order of first appearance.
+    '''
+    gids = np.asarray(data, dtype=np.uint32).reshape(-1)\
+        & np.uint32(~gid_flip_mask & 0xFFFFFFFF)
+    gids, first = np.unique(gids, return_index=True)
+    gids = gids[np.argsort(first, kind='stable')]
+    return gids[gids != 0]
 
 
-def unflip_tile_layer(data):
-    tile_grid = []
-    for row in data:
-        row_data = []
-        for val in row:
-            # This should be handled by the pytiled_parser library.
-            # https://doc.mapeditor.org/en/stable/reference/tmx-map-format/#tile-flipping
-            row_data.append(clearBit(clearBit(clearBit(val, 29), 31), 30))
-        assert len(row) == len(row_data)
-        tile_grid.append(row_data)
-    assert len(data) == len(tile_grid)
-    return tile_grid
+def compile_tiles(tileset):
+    '''
+    Returns the type and content of each tile of a tileset, keyed by its
+    offset as a string.
+    '''
+    tiles = {}
+    for offset, tile in tileset['tileproperties'].items():
+        tiles[offset] = {
+            'offset': offset, 'content': '', 'type': 'unknown'
+        }
+        if tile.get('invalid', '') == 'true':
+            tiles[offset]['type'] = 'invalid'
+        elif tile.get('liquid'):
+            tiles[offset]['type'] = 'liquid'
+            tiles[offset]['content'] = tile['liquid']
+        elif tile.get('material'):
+            tiles[offset]['type'] = 'material'
+            tiles[offset]['content'] = tile['material']
+        elif tile.get('object'):
+            tiles[offset]['type'] = 'object'
+            tiles[offset]['content'] = tile['object']
+    return tiles
 
 
 def add_tileset(tilesets, tileset):
@@ -105,21 +113,7 @@ def add_tileset(tilesets, tileset):
         print('WARNING: duplicate tileset names: {}'.format(tileset['name']))
     else:
         tilesets[tileset['name']] = {}
-    for offset, tile in tileset['tileproperties'].items():
-        tilesets[tileset['name']][offset] = {
-            'offset': offset, 'content': '', 'type': 'unknown'
-        }
-        if tile.get('invalid', '') == 'true':
-            tilesets[tileset['name']][offset]['type'] = 'invalid'
-        elif tile.get('liquid'):
-            tilesets[tileset['name']][offset]['type'] = 'liquid'
-            tilesets[tileset['name']][offset]['content'] = tile['liquid']
-        elif tile.get('material'):
-            tilesets[tileset['name']][offset]['type'] = 'material'
-            tilesets[tileset['name']][offset]['content'] = tile['material']
-        elif tile.get('object'):
-            tilesets[tileset['name']][offset]['type'] = 'object'
-            tilesets[tileset['name']][offset]['content'] = tile['object']
+    tilesets[tileset['name']].update(compile_tiles(tileset))
 
 
 def process_embedded_tilesets(dungeon_json):
@@ -130,25 +124,285 @@ def process_embedded_tilesets(dungeon_json):
     return tilesets
 
 
-def process_external_tilesets(src_dir):
-    tilesets = {}
+# Bump this whenever compile_tileset changes, so that compiled tilesets
+# cached on disk by earlier versions are ignored.
+compiled_tileset_version = 1
 
-    tsdir = src_dir / 'tilesets'
-    if not tsdir.is_dir():
-        # These assets do not contain any tilesets. This will become an
-        # error if Tiled dungeons with external tilesets exist in these
-        # assets.
-        return tilesets
 
-    for relative_path in tsdir.glob('**/*.json'):
-        tileset = None
-        with open(tsdir / relative_path, 'rb') as fh:
-            tileset = json.loads(fh.read())
-        add_tileset(tilesets, tileset)
+def compile_tileset(tileset):
+    '''
+    Returns the fields of a decoded external tileset needed for indexing:
+    its name, tile count and compiled tiles.
+    '''
+    return {
+        'name': tileset['name'],
+        # BETA - Some tilesets are missing parameters; see
+        # read_external_tileset_header.
+        'tile_count': tileset.get('tilecount'),
+        'tiles': compile_tiles(tileset)
+    }
 
+
+def load_external_tileset(path):
+    '''
+    Returns the compiled form of an external tileset file, as returned by
+    compile_tileset, loading it on first use. Compiled tilesets are also
+    cached on disk, keyed by the hash of the file, alongside parsed JSON
+    files; see jsonloader.cache_path.
+    '''
+    key = assets.identity(path)
+    tileset = caches.tilesets.get(key)
+    if tileset is not None: return tileset
+
+    with stats.timer('tileset load'):
+        with assets.open_file(path) as fh:
+            data = fh.read()
+        cache_path = jsonloader.cache_path(
+            'tilesets', data, compiled_tileset_version
+        )
+        tileset = jsonloader.read_cache(cache_path, 'tileset cache hits')
+        if tileset is None:
+            tileset = compile_tileset(jsonloader.loads(data))
+            jsonloader.write_cache(cache_path, tileset)
+    stats.count('tilesets loaded')
+    caches.tilesets[key] = tileset
+    return tileset
+
+
+def read_external_tileset_header(path):
+    tileset = load_external_tileset(path)
+    if tileset['tile_count'] is None:
+        raise KeyError('tilecount')
+    return {'name': tileset['name'], 'tile_count': tileset['tile_count']}
+
+
+def load_external_tilesets(paths):
+    '''
+    Returns the tiles of the external tilesets with the given paths,
+    keyed by tileset name, as expected by make_gid_table. No tileset is
+    read until a map references it; see load_external_tileset.
+    '''
+    tilesets = {}
+    for path in paths:
+        tileset = load_external_tileset(path)
+        if tileset['name'] in tilesets:
+            # BETA - Some tileset names are duplicated.
+            print('WARNING: duplicate tileset names: {}'.format(
+                tileset['name']))
+            tilesets[tileset['name']] = dict(
+                tilesets[tileset['name']], **tileset['tiles']
+            )
+        else:
+            tilesets[tileset['name']] = tileset['tiles']
     return tilesets
 
 
+def read_tiled_properties(raw_properties):
+    '''
+    Converts either style of Tiled properties into a dict of property
+    values, converting values in the same way as pytiled_parser.
+    '''
+    if raw_properties is None:
+        return {}
+    elif isinstance(raw_properties, dict):
+        # old style properties
+        return dict(raw_properties)
+    properties = {}
+    for prop in raw_properties:
+        value = prop['value']
+        if prop['type'] == 'int':
+            value = round(value)
+        properties[prop['name']] = value
+    return properties
+
+
+def read_tile_layer_data(raw_layer):
+    '''
+    Returns the raw (possibly flipped) gids of a tile layer as a uint32
+    array of rows.
+    '''
+    if raw_layer.get('chunks') is not None:
+        raise UnsupportedMapError('infinite maps are not supported')
+    width = raw_layer['width']
+    data = raw_layer['data']
+    if raw_layer.get('encoding') == 'base64':
+        data = base64.b64decode(data)
+        compression = raw_layer.get('compression')
+        if compression == 'zlib':
+            data = zlib.decompress(data)
+        elif compression == 'gzip':
+            data = gzip.decompress(data)
+        elif compression:
+            raise UnsupportedMapError(
+                'unsupported layer compression: {}'.format(compression))
+        data = np.frombuffer(data, dtype='<u4')
+    elif raw_layer.get('encoding') not in (None, 'csv'):
+        raise UnsupportedMapError(
+            'unsupported layer encoding: {}'.format(raw_layer['encoding']))
+    return np.asarray(data, dtype=np.uint32).reshape(-1, width)
+
+
+def read_tiled_object(raw_object):
+    if raw_object.get('template') is not None:
+        raise UnsupportedMapError('object templates are not supported')
+    return {
+        # Only tile objects have a (nonzero) gid.
+        'gid': raw_object.get('gid') or None,
+        'x': raw_object['x'],
+        'y': raw_object['y'],
+        'properties': read_tiled_properties(raw_object.get('properties'))
+    }
+
+
+def read_tiled_map(partpath, dungeon_json):
+    '''
+    Reads the parts of an already decoded Tiled JSON map that are needed
+    for indexing: the tile size, the tilesets by firstgid, and the tile
+    and object layers. This avoids re-reading and fully modelling the map
+    with pytiled_parser.
+
+    Raises UnsupportedMapError for map features that only pytiled_parser
+    supports.
+    '''
+    tilesets = {}
+    for raw_tileset in dungeon_json['tilesets']:
+        firstgid = raw_tileset['firstgid']
+        if raw_tileset.get('source') is not None:
+            header = read_external_tileset_header(
+                os.path.normpath(partpath / raw_tileset['source'])
+            )
+        else:
+            header = {
+                'name': raw_tileset['name'],
+                'tile_count': raw_tileset['tilecount']
+            }
+        tilesets[firstgid] = dict(header, firstgid=firstgid)
+
+    layers = []
+    for raw_layer in dungeon_json['layers']:
+        if raw_layer['type'] == 'tilelayer':
+            layers.append({
+                'type': 'tile',
+                'name': raw_layer['name'],
+                'data': read_tile_layer_data(raw_layer)
+            })
+        elif raw_layer['type'] == 'objectgroup':
+            layers.append({
+                'type': 'object',
+                'name': raw_layer['name'],
+                'objects': [
+                    read_tiled_object(raw_object)
+                    for raw_object in raw_layer['objects']
+                ]
+            })
+
+    return {
+        'tile_width': dungeon_json['tilewidth'],
+        'tile_height': dungeon_json['tileheight'],
+        'tilesets': tilesets,
+        'layers': layers
+    }
+
+
+def read_pytiled_map(path):
+    '''
+    Reads a Tiled map with pytiled_parser, returning the same structure
+    as read_tiled_map.
+    '''
+    real_path = assets.file_path(path)
+    if real_path is None:
+        raise Exception(
+            'pytiled_parser cannot read maps in .pak archives: {}'.format(
+                path))
+    dungeon_part = pytiled_parser.parse_map(real_path)
+    layers = []
+    for layer in dungeon_part.layers:
+        if isinstance(layer, pytiled_parser.TileLayer):
+            layers.append({
+                'type': 'tile',
+                'name': layer.name,
+                'data': np.array(layer.data, dtype=np.uint32)
+            })
+        elif isinstance(layer, pytiled_parser.ObjectLayer):
+            layers.append({
+                'type': 'object',
+                'name': layer.name,
+                'objects': [{
+                    'gid': getattr(obj, 'gid', None),
+                    'x': obj.coordinates.x,
+                    'y': obj.coordinates.y,
+                    'properties': {
+                        name: str(value) if isinstance(value, Path) else value
+                        for name, value in obj.properties.items()
+                    }
+                } for obj in layer.tiled_objects]
+            })
+    return {
+        'tile_width': dungeon_part.tile_size.width,
+        'tile_height': dungeon_part.tile_size.height,
+        'tilesets': {
+            firstgid: {
+                'name': tileset.name,
+                'tile_count': tileset.tile_count,
+                'firstgid': firstgid
+            } for firstgid, tileset in dungeon_part.tilesets.items()
+        },
+        'layers': layers
+    }
+
+
+def tiled_maps_equal(a, b):
+    '''
+    Compares two maps as returned by read_tiled_map.
+    '''
+    if {k: v for k, v in a.items() if k != 'layers'}\
+       != {k: v for k, v in b.items() if k != 'layers'}:
+        return False
+    if len(a['layers']) != len(b['layers']):
+        return False
+    for layer_a, layer_b in zip(a['layers'], b['layers']):
+        if layer_a['type'] == 'tile' and layer_b['type'] == 'tile':
+            if layer_a['name'] != layer_b['name']\
+               or not np.array_equal(layer_a['data'], layer_b['data']):
+                return False
+        elif layer_a != layer_b:
+            return False
+    return True
+
+
+def load_tiled_map(partpath, partfile, dungeon_json, tiled_parser='native'):
+    '''
+    Reads a Tiled map with the given parser:
+    * native: read_tiled_map, falling back to pytiled_parser for maps
+      using features it does not support.
+    * pytiled: read_pytiled_map.
+    * validate: both, raising an exception if they disagree.
+    '''
+    if tiled_parser == 'pytiled':
+        return read_pytiled_map(partpath / partfile)
+    try:
+        dungeon_part = read_tiled_map(partpath, dungeon_json)
+    except UnsupportedMapError as e:
+        print('INFO: using pytiled_parser for {}: {}'.format(
+            partpath / partfile, str(e)))
+        return read_pytiled_map(partpath / partfile)
+    if tiled_parser == 'validate':
+        if not tiled_maps_equal(
+            dungeon_part, read_pytiled_map(partpath / partfile)
+        ):
+            raise Exception('Tiled map readers disagree: {}'.format(
+                partpath / partfile))
+    return dungeon_part
+
+
+class RowBuffer(list):
+    '''
+    A list with the writerow method of a csv writer.
+    '''
+    def writerow(self, row):
+        self.append(row)
+
+
 def tiled_parse_mod(csvout, partialRow, obj, mods):
     modType = get_tiled_property(obj, 'mod')
     if modType:
@@ -250,128 +504,310 @@ def tiled_parse_vehicle(csvout, partialRow, obj):
         return True
 
 
-def get_tile(embedded_tilesets, external_tilesets, tileset_name, offset):
-    try:
-        return embedded_tilesets[tileset_name][offset]
-    except KeyError as e:
-        return external_tilesets[tileset_name][offset]
+def find_tile(embedded_tilesets, external_tilesets, tileset_name, offset):
+    '''
+    Returns the tile at the given offset, a string, of the named tileset,
+    looking first in the tilesets embedded in a map, or None if there is
+    no such tile.
+    '''
+    tile = embedded_tilesets.get(tileset_name, {}).get(offset)
+    if tile is None:
+        tile = external_tilesets.get(tileset_name, {}).get(offset)
+    return tile
 
 
-def index_tiled_dungeon_part(
-    src_dir, dst_dir, partpath, partfile, external_tilesets
-):
-    if partpath / partfile in seen_tiled_parts: return
+def make_gid_table(dungeon_tilesets, embedded_tilesets, external_tilesets):
+    '''
+    Compiles the tilesets of a Tiled map into a list indexed by gid. The
+    entry of each gid is a tuple of the name, firstgid and offset of its
+    tileset and the type and content of its tile, or None if the gid has
+    no tile. See lookup_gid.
+
+    dungeon_tilesets are the tilesets of a map, as returned by
+    load_tiled_map, in order of firstgid. Maps which use the same external
+    tilesets at the same firstgids, and no embedded tilesets, share a
+    table.
+    '''
+    key = None
+    if not embedded_tilesets:
+        used = tuple(
+            external_tilesets.get(tileset['name'])
+            for tileset in dungeon_tilesets.values()
+        )
+        key = tuple(
+            (firstgid, tileset['name'], tileset['tile_count'], id(tiles))
+            for (firstgid, tileset), tiles
+            in zip(dungeon_tilesets.items(), used)
+        )
+        cached = caches.gid_tables.get(key)
+        if cached is not None:
+            stats.count('gid table hits')
+            return cached[1]
+
+    table = []
+    layout = list(dungeon_tilesets.items())
+    for i, (firstgid, tileset) in enumerate(layout):
+        count = tileset['tile_count']
+        if i + 1 < len(layout):
+            # A tileset ends where the next begins.
+            count = min(count, layout[i + 1][0] - firstgid)
+        if len(table) < firstgid:
+            table.extend([None] * (firstgid - len(table)))
+        del table[firstgid:]
+        name = tileset['name']
+        for offset in range(count):
+            tile = find_tile(
+                embedded_tilesets, external_tilesets, name, str(offset)
+            )
+            table.append(tile and (
+                name, firstgid, offset, tile['type'], tile['content']
+            ))
+    if key is not None:
+        # The tilesets are kept with the table, so that the ids in its key
+        # remain theirs.
+        caches.gid_tables[key] = (used, table)
+    return table
+
+
+def lookup_gid(table, raw_gid):
+    '''
+    Returns the entry of a gid table for a gid, ignoring its flip bits.
+    Raises KeyError if the gid has no tile.
+    '''
+    gid = unflip_object(raw_gid)
+    entry = table[gid] if gid < len(table) else None
+    if entry is None:
+        raise KeyError('no tile for gid {}'.format(gid))
+    return entry
+
 
-    dst_path = make_dst_dir(src_dir, dst_dir, partpath)
+def get_external_tileset_paths(partpath, dungeon_json):
+    '''
+    Returns the paths of the external tileset files referenced by a Tiled
+    map.
+    '''
+    return [
+        Path(os.path.normpath(partpath / tileset['source']))
+        for tileset in dungeon_json['tilesets'] if tileset.get('source')
+    ]
+
+
+def read_tiled_json(path):
+    with assets.open_file(path) as fh:
+        return json.loads(fh.read())
 
+
+def index_tiled_dungeon_part(
+    src_dir, dst_dir, partpath, partfile, tiled_parser='native', rows=None,
+    sink=None, dungeon_json=None
+):
+    '''
+    Indexes a Tiled dungeon part, writing the index to the given sink, by
+    default a CSV file. tiled_parser selects how the map is read; see
+    load_tiled_map. If rows is a list, its contents are replaced by the
+    rows written to the index. dungeon_json is the decoded map, if it was
+    already read; otherwise the part is read.
+
+    Returns the list of paths of the external tileset files referenced by
+    the part.
+    '''
+    # Some Tiled dungeon parts are referenced by multiple dungeons. Indexing
+    # them multiple times provides no benefit and takes time.
+    if partpath / partfile in caches.seen_tiled_parts: return []
+
+    if dungeon_json is None:
+        try:
+            dungeon_json = read_tiled_json(partpath / partfile)
+        except FileNotFoundError as e:
+            # BETA - incorrect file case.
+            partfile = partfile.lower()
+            dungeon_json = read_tiled_json(partpath / partfile)
     # BETA - Some beta assets contain embedded, rather than external,
     # tileset definitions.
-    dungeon_json = None
-    try:
-        with open(partpath / partfile, 'rb') as fh:
-            dungeon_json = json.loads(fh.read())
-    except FileNotFoundError as e:
-        # BETA - incorrect file case.
-        partfile = partfile.lower()
-        with open(partpath / partfile, 'rb') as fh:
-            dungeon_json = json.loads(fh.read())
     embedded_tilesets = process_embedded_tilesets(dungeon_json)
+    external_tileset_paths = get_external_tileset_paths(partpath, dungeon_json)
 
     try:
-        dungeon_part = pytiled_parser.parse_map(partpath / partfile)
+        with stats.timer('tiled read ({})'.format(tiled_parser)):
+            dungeon_part = load_tiled_map(
+                partpath, partfile, dungeon_json, tiled_parser
+            )
     except KeyError as e:
         # BETA - Some embedded tilesets are missing parameters.
         if e.args and e.args[0] == 'tilecount':
             print('ERROR: Malformed tilesets in Tiled map: {}'.format(
                 partpath / partfile))
-            return
+            return external_tileset_paths
         else: raise
-    tileset_index = make_dungeon_part_tileset_index(dungeon_part.tilesets)
-
-    with open(dst_path / "{}.csv".format(partfile), 'w') as fh:
-        csvout = csv.writer(fh, lineterminator='\n')
-
-        layer_idx = 0
-        for layer in dungeon_part.layers:
-            if isinstance(layer, pytiled_parser.TileLayer):
-                tile_data = unflip_tile_layer(layer.data)
-                layer_tiles = set()
-                for row in tile_data:
-                    for gid in row:
-                        if gid == 0:
-                            # 0 == no tile at this coordinate
-                            continue
-                        if gid in layer_tiles:
-                            # Index only one instance of each tile type
-                            # in each layer to save space and time.
-                            continue
-                        tileset_idx = bisect_left(tileset_index['lastgids'], gid)
-                        tileset = tileset_index['tilesets'][tileset_idx]
-                        tileset_firstgid = tileset_index['firstgids'][tileset_idx]
-                        tileset_offset = gid - tileset_firstgid
-                        assert tileset_offset >= 0
-                        assert tileset_offset < tileset.tile_count
-                        tile = get_tile(
-                            embedded_tilesets, external_tilesets,
-                            tileset.name, str(tileset_offset)
-                        )
-                        csvout.writerow([
-                            layer.name, gid, '', '',
-                            tileset.name, tileset_firstgid, tileset_offset,
-                            tile['type'], tile['content']
-                        ])
-                        layer_tiles.add(gid)
-            elif isinstance(layer, pytiled_parser.ObjectLayer):
-                layer_mods = set()
-                obj_idx = 0
-                for obj in layer.tiled_objects:
-                    if not hasattr(obj, 'gid'):
-                        row = [
-                            layer.name, '',
-                            int(obj.coordinates.x / dungeon_part.tile_size.width),
-                            int(obj.coordinates.y / dungeon_part.tile_size.height),
-                            '', '', ''
-                        ]
-                        tiled_parse_mod(csvout, row, obj, layer_mods)\
-                            or tiled_parse_monster(csvout, row, obj)\
-                            or tiled_parse_npc(csvout, row, obj)\
-                            or tiled_parse_stagehand(csvout, row, obj)\
-                            or tiled_parse_vehicle(csvout, row, obj)
-                    else:
-                        gid = unflip_object(obj.gid)
-                        tileset_idx = bisect_left(tileset_index['lastgids'], gid)
-                        tileset = tileset_index['tilesets'][tileset_idx]
-                        tileset_firstgid = tileset_index['firstgids'][tileset_idx]
-                        tileset_offset = gid - tileset_firstgid
-                        assert tileset_offset >= 0
-                        assert tileset_offset < tileset.tile_count
-                        tile = get_tile(
-                            embedded_tilesets, external_tilesets,
-                            tileset.name, str(tileset_offset)
-                        )
-                        row = [
-                            layer.name, obj.gid,
-                            int(obj.coordinates.x / dungeon_part.tile_size.width),
-                            int(obj.coordinates.y / dungeon_part.tile_size.height),
-                            tileset.name, tileset_firstgid, tileset_offset,
-                            tile['type'], tile['content']
-                        ]
-                        if tile['type'] == 'object':
-                            parameters = get_tiled_property(obj, 'parameters')
-                            if parameters:
-                                parameters = json.loads(parameters)
-                                if 'spawner' in parameters:
-                                    monsterTypes = parameters['spawner']\
-                                        .get('monsterTypes')
-                                    if not monsterTypes:
-                                        raise Exception('Malformed spawner')
-                                    row.append('monsterTypes={}'.format(';'\
-                                        .join(monsterTypes)))
-                                elif 'treasurePools' in parameters:
-                                    row.append('treasurePools={}'.format(';'\
-                                        .join(parameters['treasurePools'])))
-                        csvout.writerow(row)
-                    obj_idx += 1
-            layer_idx += 1
-
-    seen_tiled_parts.add(partpath / partfile)
+    # The decoded JSON is no longer needed, and may be large.
+    dungeon_json = None
+    external_tilesets = load_external_tilesets(external_tileset_paths)
+
+    sink = sink or CsvSink()
+    with sink.open_part(src_dir, dst_dir, partpath, partfile) as csvout:
+        if rows is not None:
+            rows.clear()
+            csvout = RowRecorder(csvout, rows)
+        for record in tiled_records(
+            dungeon_part, embedded_tilesets, external_tilesets
+        ):
+            csvout.writerow(record.row())
+    grid = grids.part_grid(
+        src_dir, dst_dir, partpath, partfile, tiled_grid_legend(dungeon_part)
+    )
+    if grid is not None:
+        with stats.timer('tiled grid'), grid:
+            grid.save(tiled_grid(dungeon_part))
+
+    caches.seen_tiled_parts.add(partpath / partfile)
+    return external_tileset_paths
+
+
+def tile_layers(dungeon_part):
+    return [
+        layer for layer in dungeon_part['layers'] if layer['type'] == 'tile'
+    ]
+
+
+def tiled_grid_legend(dungeon_part):
+    return {
+        'type': 'tiled',
+        'layers': [layer['name'] for layer in tile_layers(dungeon_part)]
+    }
+
+
+def tiled_grid(dungeon_part):
+    '''
+    Returns the grid of a Tiled map, as returned by load_tiled_map: a
+    (layers, height, width) array of the gid of each tile of each of its
+    tile layers, without flip bits, or 0 for no tile, in the smallest
+    unsigned integer type holding them. Layers smaller than the largest
+    are padded with 0.
+    '''
+    layers = [
+        np.asarray(layer['data'], dtype=np.uint32)
+        & np.uint32(~gid_flip_mask & 0xFFFFFFFF)
+        for layer in tile_layers(dungeon_part)
+    ]
+    height = max([data.shape[0] for data in layers], default=0)
+    width = max([data.shape[1] for data in layers], default=0)
+    top = max([int(data.max()) for data in layers if data.size], default=0)
+    grid = np.zeros(
+        (len(layers), height, width), dtype=np.min_scalar_type(top)
+    )
+    for i, data in enumerate(layers):
+        grid[i, :data.shape[0], :data.shape[1]] = data
+    return grid
+
+
+def tiled_records(dungeon_part, embedded_tilesets, external_tilesets):
+    '''
+    Indexes a Tiled map, as returned by load_tiled_map, yielding an
+    IndexRecord for each index row as it is produced.
+
+    embedded_tilesets are the tilesets defined in the map, as returned by
+    process_embedded_tilesets, and external_tilesets those it references,
+    as returned by load_external_tilesets.
+    '''
+    gid_table = make_gid_table(
+        dungeon_part['tilesets'], embedded_tilesets, external_tilesets
+    )
+    tile_width = dungeon_part['tile_width']
+    tile_height = dungeon_part['tile_height']
+    # Collects the rows of the tiled_parse_* functions.
+    pending = RowBuffer()
+
+    layer_idx = 0
+    for layer in dungeon_part['layers']:
+        layer_start = time.perf_counter()
+        if layer['type'] == 'tile':
+            # Index only one instance of each tile type in each
+            # layer to save space and time. 0 == no tile at a
+            # coordinate, and is skipped.
+            stats.count('tiles', layer['data'].size)
+            prefix = (layer['name'],)
+            for gid in tile_layer_gids(layer['data']).tolist():
+                yield tuple.__new__(IndexRecord, prefix + (gid, None, None)
+                                    + lookup_gid(gid_table, gid) + ((),))
+        elif layer['type'] == 'object':
+            layer_mods = set()
+            obj_idx = 0
+            for obj in layer['objects']:
+                if not obj['gid']:
+                    row = [
+                        layer['name'], '',
+                        int(obj['x'] / tile_width),
+                        int(obj['y'] / tile_height),
+                        '', '', ''
+                    ]
+                    tiled_parse_mod(pending, row, obj, layer_mods)\
+                        or tiled_parse_monster(pending, row, obj)\
+                        or tiled_parse_npc(pending, row, obj)\
+                        or tiled_parse_stagehand(pending, row, obj)\
+                        or tiled_parse_vehicle(pending, row, obj)
+                    for row in pending:
+                        yield IndexRecord.from_row(row)
+                    pending.clear()
+                else:
+                    entry = lookup_gid(gid_table, obj['gid'])
+                    row = [
+                        layer['name'], obj['gid'],
+                        int(obj['x'] / tile_width),
+                        int(obj['y'] / tile_height),
+                        *entry
+                    ]
+                    if entry[3] == 'object':
+                        parameters = get_tiled_property(obj, 'parameters')
+                        if parameters:
+                            parameters = json.loads(parameters)
+                            if 'spawner' in parameters:
+                                monsterTypes = parameters['spawner']\
+                                    .get('monsterTypes')
+                                if not monsterTypes:
+                                    raise Exception('Malformed spawner')
+                                row.append('monsterTypes={}'.format(';'\
+                                    .join(monsterTypes)))
+                            elif 'treasurePools' in parameters:
+                                row.append('treasurePools={}'.format(';'\
+                                    .join(parameters['treasurePools'])))
+                    yield IndexRecord.from_row(row)
+                obj_idx += 1
+            stats.count('objects', obj_idx)
+        stats.add_time(
+            'tiled {} layers'.format(layer['type']),
+            time.perf_counter() - layer_start
+        )
+        layer_idx += 1
+
+
+def iter_tiled_records(source, base_dir=None, tiled_parser='native'):
+    '''
+    Indexes a Tiled dungeon part without writing an index, lazily
+    yielding an IndexRecord for each index row.
+
+    source is either the path of the part or its contents as bytes. The
+    tileset files referenced by a part given as bytes are found relative
+    to base_dir, by default the current folder. tiled_parser selects how
+    the map is read; see load_tiled_map. Maps given as bytes can only be
+    read natively.
+    '''
+    if isinstance(source, (bytes, bytearray)):
+        partpath = Path(base_dir or '.')
+        dungeon_json = json.loads(source)
+        dungeon_part = read_tiled_map(partpath, dungeon_json)
+    else:
+        path = Path(source)
+        partpath = path.parent
+        with open(path, 'rb') as fh:
+            dungeon_json = json.loads(fh.read())
+        dungeon_part = load_tiled_map(
+            partpath, path.name, dungeon_json, tiled_parser
+        )
+    embedded_tilesets = process_embedded_tilesets(dungeon_json)
+    external_tilesets = load_external_tilesets(
+        get_external_tileset_paths(partpath, dungeon_json)
+    )
+    dungeon_json = None
+    yield from tiled_records(
+        dungeon_part, embedded_tilesets, external_tilesets
+    )
@@ -0,0 +1,514 @@
+from . import assets, indexer, stats
+from .assets import DirectorySource
+from .common import caches
+from .spatial import SpatialBuilder
+from .store import manifest_store_keys
+from .summary import SummaryTally, manifest_part, manifest_parts, \
+                     tally_missing, write_summary
+
+from pathlib import Path
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+# The time to wait after a change for further changes, such as the other
+# files written when an editor saves, before they are all indexed.
+debounce_seconds = 0.25
+
+# The interval at which PollingWatcher scans the watched folders.
+poll_interval = 1.0
+
+# The inotify events of interest: files written, moved or deleted, and
+# folders created.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+watch_mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO\
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+event_header = struct.Struct('iIII')
+
+
+def is_ignored(name):
+    '''
+    Returns whether changes to a file with the given name are ignored:
+    hidden files and the backups and swap files of editors.
+    '''
+    return name.startswith('.') or name.endswith('~')\
+        or name.endswith('.swp') or name.endswith('.tmp')
+
+
+class InotifyWatcher:
+    '''
+    Watches folders and all of their subfolders for changes with Linux's
+    inotify, through the C library. Raises OSError if inotify is not
+    available, or the folders cannot all be watched.
+    '''
+    def __init__(self, roots):
+        name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(name, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = {}
+        try:
+            for root in roots:
+                self.add_tree(Path(root))
+        except OSError as e:
+            self.close()
+            raise
+
+    def add_tree(self, folder):
+        self.add_folder(folder)
+        for parent, dirs, files in os.walk(folder):
+            dirs[:] = [name for name in dirs if not is_ignored(name)]
+            for name in dirs:
+                self.add_folder(Path(parent) / name)
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(folder), watch_mask
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOENT: return
+            raise OSError(error, 'unable to watch folder: {}'.format(
+                os.strerror(error)), str(folder))
+        self.folders[wd] = folder
+
+    def changes(self, timeout):
+        '''
+        Waits up to timeout seconds, or indefinitely if None, for changes.
+        Returns the set of paths of the files changed, or None if
+        changes were lost.
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable: return set()
+        data = os.read(self.fd, 1 << 16)
+        paths = set()
+        lost = False
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                lost = True
+                continue
+            folder = self.folders.get(wd)
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            if folder is None or not name or is_ignored(name): continue
+            path = folder / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files written to a new folder before it is watched
+                    # are found by the scan of the folder.
+                    self.add_tree(path)
+                    paths.update(
+                        Path(parent) / name
+                        for parent, dirs, files in os.walk(path)
+                        for name in files
+                    )
+                continue
+            paths.add(path)
+        return None if lost else paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    '''
+    Watches folders and all of their subfolders for changes by scanning
+    them periodically and comparing the size and modification time of
+    each file.
+    '''
+    def __init__(self, roots):
+        self.roots = [Path(root) for root in roots]
+        self.files = self.scan()
+
+    def scan(self):
+        files = {}
+        for root in self.roots:
+            for parent, dirs, names in os.walk(root):
+                dirs[:] = [name for name in dirs if not is_ignored(name)]
+                for name in names:
+                    if is_ignored(name): continue
+                    path = Path(parent) / name
+                    try:
+                        st = os.stat(path)
+                    except OSError as e:
+                        continue
+                    files[path] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def changes(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = poll_interval
+            if deadline is not None:
+                delay = min(delay, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+            files = self.scan()
+            paths = set(
+                path for path in set(files) | set(self.files)
+                if files.get(path) != self.files.get(path)
+            )
+            self.files = files
+            if paths or (deadline is not None
+                         and time.monotonic() >= deadline):
+                return paths
+
+    def close(self):
+        pass
+
+
+def make_watcher(roots):
+    '''
+    Returns an InotifyWatcher of the given folders where inotify is
+    available, and a PollingWatcher otherwise.
+    '''
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            print('WARNING: unable to use inotify, polling instead: {}'
+                  .format(str(e)))
+    return PollingWatcher(roots)
+
+
+def wait_for_changes(watcher):
+    '''
+    Waits for changes to the watched folders, then for debounce_seconds
+    without further changes. Returns the set of paths of the files
+    changed, or None if changes were lost and all files must be
+    considered changed.
+    '''
+    paths = set()
+    while not paths:
+        paths = watcher.changes(None)
+        if paths is None: break
+    while paths is not None:
+        more = watcher.changes(debounce_seconds)
+        if more is None: return None
+        if not more: break
+        paths.update(more)
+    return paths
+
+
+class WatchedIndex:
+    '''
+    The indices of an asset folder or a stack of them, as written by
+    index_sources, kept in memory by watch_sources so that a change
+    re-indexes only the parts depending on the files changed. For each
+    layer, it keeps its manifest and the groups of work items planned
+    for it, and for each source file, the indices depending on it in any
+    layer.
+
+    layers is the list returned by index_sources. Source files are keyed
+    by their paths relative to the folder of their layer, and indices by
+    their paths relative to the destination folder of their layer, as in
+    the manifests.
+    '''
+    def __init__(self, src_dirs, dst_dir, args, database, store, layers):
+        self.src_dirs = src_dirs
+        self.dst_dir = dst_dir
+        self.args = args
+        self.database = database
+        self.store = store
+        self.layers = layers
+        # The source files of each index, and the indices depending on
+        # each source file.
+        self.deps = {}
+        self.dependents = {}
+        keys = set()
+        for index, layer in enumerate(layers):
+            manifest = layer['manifest']
+            layer['spatial'] = SpatialBuilder(manifest)
+            layer['groups'] = {}
+            layer['inputs'] = {}
+            for stage, extension, plan in indexer.stages:
+                self.plan_groups(layer, stage, layer['plans'].get(stage, []))
+                keys.update(layer['groups'][stage])
+            keys.update(manifest.outputs)
+            layer['select'] = None
+            if index > 0:
+                layer['known_deps'] = {}
+                layer['select'] = indexer.make_layer_selector(
+                    layer['src_dir'], layer['dst_dir'], index,
+                    layer['known_deps']
+                )
+        for index in range(1, len(layers)):
+            self.update_known_deps(index, keys)
+        for key in keys: self.link(key)
+        self.parts = {}
+        for layer in layers:
+            self.parts.update(manifest_parts(layer['manifest']))
+        self.tally = SummaryTally(self.parts)
+
+    def plan_groups(self, layer, stage, items):
+        '''
+        Keeps the work items planned for a stage of a layer, grouped by
+        the path of their index, and the source files from which they
+        were planned. Returns the paths of the indices whose groups
+        differ from those planned before.
+        '''
+        manifest = layer['manifest']
+        groups = {}
+        for group in indexer.group_work_items(items):
+            output = manifest.sink.index_path(
+                layer['src_dir'], layer['dst_dir'], group[0]['partpath'],
+                group[0]['partfile']
+            )
+            groups[manifest.output_key(output)] = group
+        previous = layer['groups'].get(stage, {})
+        layer['groups'][stage] = groups
+        layer['inputs'][stage] = set(
+            manifest.source_key(dep) for item in items for dep in item['deps']
+        )
+        return set(
+            key for key in set(previous) | set(groups)
+            if previous.get(key) != groups.get(key)
+        )
+
+    def update_known_deps(self, index, keys):
+        '''
+        Updates the source files of the given indices recorded by the
+        layers below the given layer, for its selector; see
+        make_layer_selector.
+        '''
+        known_deps = self.layers[index]['known_deps']
+        for key in keys:
+            deps = set()
+            for layer in self.layers[:index]:
+                entry = layer['manifest'].outputs.get(key)
+                if entry is not None: deps.update(entry['deps'])
+            known_deps[key] = deps
+
+    def link(self, key):
+        '''
+        Updates the source files of the index with the given path, those
+        of its work items and those recorded by its manifests, and the
+        indices depending on them.
+        '''
+        deps = set()
+        for layer in self.layers:
+            manifest = layer['manifest']
+            for groups in layer['groups'].values():
+                group = groups.get(key)
+                if group is not None:
+                    deps.update(
+                        manifest.source_key(dep)
+                        for dep in indexer.work_item_deps(group)
+                    )
+            entry = manifest.outputs.get(key)
+            if entry is not None: deps.update(entry['deps'])
+        for dep in self.deps.pop(key, set()) - deps:
+            self.dependents[dep].discard(key)
+            if not self.dependents[dep]: del self.dependents[dep]
+        for dep in deps:
+            self.dependents.setdefault(dep, set()).add(key)
+        if deps: self.deps[key] = deps
+
+    def update(self, paths):
+        '''
+        Indexes the parts depending on the given changed files, given as
+        paths in the filesystem, in each layer which may read them, and
+        updates the manifests, spatial indices and summary for those
+        parts only.
+        '''
+        keys = set()
+        lowest = len(self.layers)
+        for path in paths:
+            for index, src_dir in enumerate(self.src_dirs):
+                try:
+                    key = Path(path).relative_to(src_dir).as_posix()
+                except ValueError as e:
+                    continue
+                keys.add(key)
+                lowest = min(lowest, index)
+        affected = set()
+        for key in keys:
+            affected.update(self.dependents.get(key, ()))
+        replaced = set()
+        try:
+            # Files of a layer are read by it and the layers above it.
+            for index in range(lowest, len(self.layers)):
+                self.update_layer(index, keys, affected, replaced)
+        finally:
+            assets.set_source(None)
+        for key in affected: self.link(key)
+        if affected: self.update_summary(affected)
+        if self.store is not None and replaced:
+            self.store.remove(replaced - manifest_store_keys(
+                layer['manifest'] for layer in self.layers
+            ))
+
+    def update_layer(self, index, keys, affected, replaced):
+        '''
+        Updates a layer for the given changed source files, planning its
+        stages again if they are among the files from which they were
+        planned, and indexing the given indices, to which the indices
+        whose groups of work items changed are added. The keys of the
+        store entries of the indices checked again are added to replaced.
+        '''
+        layer = self.layers[index]
+        manifest = layer['manifest']
+        sink = manifest.sink
+        assets.set_source(layer['source'])
+        if layer['source'] is not None: layer['source'].forget()
+        for key in keys:
+            manifest.fingerprints.pop(key, None)
+        for stage, extension, plan in indexer.stages:
+            if not keys & layer['inputs'][stage] and not any(
+                key.startswith(stage + '/') and key.endswith(extension)
+                for key in keys
+            ):
+                continue
+            items = []
+            if assets.is_dir(layer['src_dir'] / stage):
+                with stats.timer('plan ' + stage):
+                    items = plan(layer['src_dir'])
+            affected.update(self.plan_groups(layer, stage, items))
+        if not affected: return
+        if index > 0: self.update_known_deps(index, affected)
+
+        # The manifest entries of the indices affected are checked again
+        # as if loaded from the previous manifest.
+        changed = manifest.reuse(affected)
+        replaced.update(
+            entry['store'] for entry in manifest.previous.values()
+            if 'store' in entry
+        )
+        caches.seen_tiled_parts.clear()
+        try:
+            for stage, extension, plan in indexer.stages:
+                items = [
+                    item for key, group in layer['groups'][stage].items()
+                    if key in affected for item in group
+                ]
+                if not items: continue
+                indexer.run_work_items(
+                    layer['src_dir'], layer['dst_dir'], items, 1, manifest,
+                    self.args.tiled_parser, self.database, sink,
+                    layer['select'], layer['prefix'], self.store,
+                    layer['spatial']
+                )
+        except indexer.PartIndexError as e:
+            print('ERROR: failed to index part: {}'.format(str(e)),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        deleted = indexer.prune_indices(manifest, sink)
+        manifest.previous = {}
+        sink.close(len(manifest.outputs))
+        with stats.timer('summary'):
+            tally_missing(manifest, sink)
+        changed.update(key for key in affected if key in manifest.outputs)
+        layer['spatial'].save(
+            key for key in changed if key in manifest.outputs
+        )
+        manifest.save_changes(changed)
+        if self.database is not None:
+            with stats.timer('database'):
+                for path in deleted:
+                    self.database.remove_part(
+                        layer['prefix']
+                        + sink.part_key(manifest.output_key(path))
+                    )
+
+    def update_summary(self, keys):
+        '''
+        Updates the summary for the given indices, each from the topmost
+        layer indexing it.
+        '''
+        for key in keys:
+            part = self.parts.pop(key, None)
+            if part is not None: self.tally.remove(part)
+            for layer in reversed(self.layers):
+                entry = layer['manifest'].outputs.get(key)
+                if entry is not None:
+                    self.parts[key] = part = manifest_part(entry)
+                    self.tally.add(part)
+                    break
+        write_summary(self.dst_dir, self.tally)
+
+
+def watch_sources(src_dirs, sources, dst_dir, args, database, store, layers):
+    '''
+    Watches the asset folders among src_dirs for changes until
+    interrupted, indexing the parts affected by each change, as well as
+    those depending on a changed dungeon file, block key or tileset.
+    layers is the list returned by index_sources for the last run.
+
+    The plan and manifests of the indices, and the parsed files which
+    have not changed, are kept in memory by a WatchedIndex, and parts are
+    indexed in this process, so that each change is indexed quickly.
+    Should changes be lost, or indexing fail, all parts are checked again
+    on the next change, as by index_sources.
+    '''
+    folders = [
+        src_dir for src_dir, source in zip(src_dirs, sources)
+        if isinstance(source, DirectorySource)
+    ]
+    watcher = make_watcher(folders)
+    print('watching {} for changes; press Ctrl+C to stop'.format(
+        ', '.join(str(folder) for folder in folders)))
+    index = WatchedIndex(src_dirs, dst_dir, args, database, store, layers)
+    try:
+        while True:
+            paths = wait_for_changes(watcher)
+            start = time.perf_counter()
+            parts = stats.counters.get('parts', 0)
+            caches.forget(paths)
+            try:
+                if index is None or paths is None:
+                    index = None
+                    layers = indexer.index_sources(
+                        src_dirs, sources, dst_dir, args, 1, database, store
+                    )
+                    index = WatchedIndex(
+                        src_dirs, dst_dir, args, database, store, layers
+                    )
+                else:
+                    index.update(paths)
+            except SystemExit as e:
+                # The error has been reported; it may be fixed by a
+                # further change.
+                index = None
+                continue
+            except Exception as e:
+                print('ERROR: {}: {}'.format(type(e).__name__, e),
+                      file=sys.stderr)
+                index = None
+                continue
+            if database is not None:
+                database.flush()
+            print('indexed {} parts in {:.0f} ms'.format(
+                stats.counters.get('parts', 0) - parts,
+                1000 * (time.perf_counter() - start)))
+    except KeyboardInterrupt as e:
+        pass
+    finally:
+        watcher.close()